@@ -26,7 +26,7 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
 import modules.globals
 import modules.metadata
-from modules.processors.frame.core import get_frame_processors_modules
+from modules.processors.frame.core import get_frame_processors_modules, process_video_fan_out
 from modules.utilities import (
     has_image_extension,
     is_image,
@@ -522,6 +522,78 @@ class BatchFaceSwap:
                 pass
             return False
 
+    def process_fan_out_video(
+        self, source_paths: List[str], target_path: str, output_paths: List[str]
+    ) -> List[bool]:
+        """一次解码同一个视频，为每张源人脸图片各输出一个视频"""
+        results = [False] * len(source_paths)
+        # 检查帧处理器时会逐个设置源图片，结束后恢复原值
+        previous_source_path = modules.globals.source_path
+        try:
+            print(
+                f"📹 开始处理: {os.path.basename(target_path)} ({len(source_paths)} 张源人脸)"
+            )
+
+            # 设置全局变量
+            modules.globals.target_path = target_path
+
+            # 初始化帧处理器，每张源人脸都要检查一次
+            frame_processors = get_frame_processors_modules(
+                modules.globals.frame_processors
+            )
+            for source_path in source_paths:
+                modules.globals.source_path = source_path
+                for frame_processor in frame_processors:
+                    if not frame_processor.pre_start():
+                        print(
+                            f"❌ 帧处理器初始化失败: {frame_processor.NAME} ({os.path.basename(source_path)})"
+                        )
+                        return results
+
+            print("   📁 创建临时资源...")
+            create_temp(target_path)
+
+            fps = 30.0
+            if modules.globals.keep_fps:
+                print("   📊 检测原始FPS...")
+                fps = detect_fps(target_path)
+
+            # 每帧只解码和检测一次，然后分别换脸并送入各自的编码器
+            print(f"   🔄 使用 {fps} FPS 同时渲染 {len(source_paths)} 个视频...")
+            done = process_video_fan_out(
+                source_paths, target_path, frame_processors, fps
+            )
+
+            for output_index, output_path in enumerate(output_paths):
+                if not done[output_index]:
+                    print(f"   ❌ 编码失败: {os.path.basename(output_path)}")
+                    continue
+                if modules.globals.keep_audio:
+                    restore_audio(target_path, output_path, output_index)
+                else:
+                    move_temp(target_path, output_path, output_index)
+                results[output_index] = os.path.isfile(output_path)
+                if results[output_index]:
+                    print(f"   ✅ 处理完成: {os.path.basename(output_path)}")
+                else:
+                    print(f"   ❌ 处理失败: 输出文件未生成 {os.path.basename(output_path)}")
+
+            # 清理临时文件
+            if not modules.globals.keep_frames:
+                clean_temp(target_path)
+            return results
+
+        except Exception as e:
+            print(f"   ❌ 处理过程中出现错误: {str(e)}")
+            # 清理临时文件
+            try:
+                clean_temp(target_path)
+            except:
+                pass
+            return results
+        finally:
+            modules.globals.source_path = previous_source_path
+
     def process_batch(
         self,
         source_path: str,
@@ -530,11 +602,13 @@ class BatchFaceSwap:
         recursive: bool = True,
         rest_time: int = 180,
         auto_clean: bool = True,
+        source_paths: Optional[List[str]] = None,
     ) -> None:
-        """批量处理视频"""
+        """批量处理视频，提供多张源人脸图片时每个视频只解码一次"""
+        source_paths = source_paths or [source_path]
         print("🚀 开始批量视频换脸处理")
         print("=" * 50)
-        print(f"📷 源人脸图片: {source_path}")
+        print(f"📷 源人脸图片: {', '.join(source_paths)}")
         print(f"📁 输入目录: {input_dir}")
         print(f"📁 输出目录: {output_dir}")
         print(f"🔄 递归搜索: {'是' if recursive else '否'}")
@@ -551,8 +625,9 @@ class BatchFaceSwap:
             return
 
         # 验证输入
-        if not self.validate_inputs(source_path, input_dir, output_dir):
-            return
+        for path in source_paths:
+            if not self.validate_inputs(path, input_dir, output_dir):
+                return
 
         # 获取视频文件列表
         print("🔍 搜索视频文件...")
@@ -607,9 +682,30 @@ class BatchFaceSwap:
             # 创建输出子目录
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-            # 处理视频
-            if self.process_single_video(source_path, video_path, output_path):
-                success_count += 1
+            # 处理视频，多张源人脸时按序号和源图片名区分输出文件（不同目录下的源图片可能同名）
+            if len(source_paths) > 1:
+                output_paths = [
+                    os.path.join(
+                        output_dir,
+                        video_dir,
+                        f"{video_name}-{index}-{os.path.splitext(os.path.basename(path))[0]}-swapped-iroop.mp4",
+                    )
+                    for index, path in enumerate(source_paths, 1)
+                ]
+                results = self.process_fan_out_video(
+                    source_paths, video_path, output_paths
+                )
+            else:
+                results = [
+                    self.process_single_video(source_path, video_path, output_path)
+                ]
+
+            # 每个输出视频单独计数，部分输出失败时成功的输出仍然计入
+            success_count += sum(results)
+            failed_count += len(results) - sum(results)
+            succeeded = all(results)
+
+            if succeeded:
                 print(f"✅ 成功完成第 {i} 个视频")
 
                 # 根据最佳实践指南，每个任务完成后进行系统监控和维护
@@ -627,8 +723,12 @@ class BatchFaceSwap:
                     self.system_rest(rest_seconds=rest_time)
                     print("=" * 60)
             else:
-                failed_count += 1
-                print(f"❌ 第 {i} 个视频处理失败")
+                if any(results):
+                    print(
+                        f"❌ 第 {i} 个视频有 {len(results) - sum(results)}/{len(results)} 个输出处理失败"
+                    )
+                else:
+                    print(f"❌ 第 {i} 个视频处理失败")
 
                 # 即使失败也要进行系统检查和清理
                 if auto_clean and i < len(video_files):
@@ -646,8 +746,8 @@ class BatchFaceSwap:
         # 输出统计结果
         print("\n" + "=" * 50)
         print("📊 批量处理完成!")
-        print(f"✅ 成功: {success_count} 个")
-        print(f"❌ 失败: {failed_count} 个")
+        print(f"✅ 成功: {success_count} 个输出视频")
+        print(f"❌ 失败: {failed_count} 个输出视频")
         print(f"📁 输出目录: {output_dir}")
 
         # 最终系统状态检查和清理
@@ -772,10 +872,13 @@ def main():
   python batch_face_swap.py -s face.jpg -i videos/ -o output/
   python batch_face_swap.py -s face.jpg -i videos/ -o output/ --no-recursive
   python batch_face_swap.py -s face.jpg -i videos/ -o output/ --no-audio --no-enhancer
+  python batch_face_swap.py -s face1.jpg face2.jpg face3.jpg -i videos/ -o output/
         """,
     )
 
-    parser.add_argument("-s", "--source", help="源人脸图片路径")
+    parser.add_argument(
+        "-s", "--source", nargs="+", help="源人脸图片路径，可提供多张，每个视频只解码一次"
+    )
     parser.add_argument("-i", "--input", help="输入视频目录")
     parser.add_argument("-o", "--output", help="输出视频目录")
     parser.add_argument("--no-recursive", action="store_true", help="不递归搜索子目录")
@@ -833,12 +936,13 @@ def main():
 
     # 开始批量处理
     batch_processor.process_batch(
-        source_path=args.source,
+        source_path=args.source[0],
         input_dir=args.input,
         output_dir=args.output,
         recursive=not args.no_recursive,
         rest_time=args.rest_time,
         auto_clean=not args.no_auto_clean,
+        source_paths=args.source,
     )
 
 
@@ -0,0 +1,131 @@
+import os
+import shutil
+import hashlib
+import threading
+from typing import Dict, List, Optional
+import numpy
+
+import modules.globals
+from modules.typing import Face
+from modules.face_analyser import get_face_analyser, FACE_ANALYSER_NAME, SOURCE_FACE_FIELDS
+
+TARGET_ANALYSIS = None
+TARGET_FACE_FIELDS = SOURCE_FACE_FIELDS + ['pose']
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class TargetAnalysis:
+    """
+    Per frame face analysis of one target video, shared between runs.
+
+    The analysis lives in a directory of .npy files: every face field is one
+    flat array over all faces of the video and frame_offsets maps a frame to
+    its slice. Loaded files are memory mapped, so a run only pages in the
+    frames it touches. A run without a complete analysis records one while it
+    detects faces and saves it when the job finishes. Recorded frames are kept
+    as compact per frame arrays of TARGET_FACE_FIELDS, not as Face objects.
+    """
+
+    def __init__(self, cache_path: str) -> None:
+        self.cache_path = cache_path
+        self.fields: Dict[str, numpy.ndarray] = {}
+        self.frame_offsets: Optional[numpy.ndarray] = None
+        self.recorded: Dict[int, Dict[str, numpy.ndarray]] = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    @property
+    def frame_total(self) -> int:
+        return 0 if self.frame_offsets is None else len(self.frame_offsets) - 1
+
+    def load(self) -> None:
+        offsets_path = os.path.join(self.cache_path, 'frame_offsets.npy')
+        if not os.path.isfile(offsets_path):
+            return
+        try:
+            fields = {name: numpy.load(os.path.join(self.cache_path, name + '.npy'), mmap_mode='r') for name in TARGET_FACE_FIELDS if os.path.isfile(os.path.join(self.cache_path, name + '.npy'))}
+            self.frame_offsets = numpy.load(offsets_path)
+            self.fields = fields
+        except Exception as exception:
+            print(f'Failed to load target analysis {self.cache_path}: {exception}')
+            self.frame_offsets = None
+
+    def get_faces(self, frame_index: int) -> Optional[List[Face]]:
+        if frame_index >= self.frame_total:
+            return None
+        start, end = int(self.frame_offsets[frame_index]), int(self.frame_offsets[frame_index + 1])
+        return [Face(**{name: values[index] for name, values in self.fields.items()}) for index in range(start, end)]
+
+    def add_faces(self, frame_index: int, faces: List[Face]) -> None:
+        if self.frame_total:
+            return
+        fields = {'count': numpy.asarray(len(faces))}
+        for name in TARGET_FACE_FIELDS:
+            values = [face.get(name) for face in faces]
+            if faces and all(value is not None for value in values):
+                fields[name] = numpy.stack([numpy.asarray(value) for value in values])
+        with self.lock:
+            self.recorded[frame_index] = fields
+
+    def save(self) -> bool:
+        with self.lock:
+            recorded, self.recorded = self.recorded, {}
+        # only a recording of every frame from the first one on is worth keeping
+        if self.frame_total or not recorded or sorted(recorded) != list(range(len(recorded))):
+            return False
+        frames = [recorded[frame_index] for frame_index in range(len(recorded))]
+        frame_offsets = numpy.cumsum([0] + [int(fields['count']) for fields in frames]).astype(numpy.int64)
+        temp_path = self.cache_path + '.tmp'
+        try:
+            os.makedirs(temp_path, exist_ok=True)
+            for name in TARGET_FACE_FIELDS:
+                # a field is kept only when every face of the video has it
+                values = [fields.get(name) for fields in frames if int(fields['count'])]
+                if values and all(value is not None for value in values):
+                    numpy.save(os.path.join(temp_path, name + '.npy'), numpy.concatenate(values))
+            # frame_offsets is written last, a directory without it is never loaded
+            numpy.save(os.path.join(temp_path, 'frame_offsets.npy'), frame_offsets)
+            shutil.rmtree(self.cache_path, ignore_errors=True)
+            os.replace(temp_path, self.cache_path)
+        except Exception as exception:
+            print(f'Failed to save target analysis {self.cache_path}: {exception}')
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return False
+        self.load()
+        return True
+
+
+def get_target_analysis_key(target_path: str) -> str:
+    face_analyser = get_face_analyser()
+    digest = hashlib.sha1()
+    with open(target_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    det_size = tuple(getattr(face_analyser, 'det_size', ()) or ())
+    det_thresh = getattr(face_analyser, 'det_thresh', None)
+    # keyframe and ROI detection record the faces they followed, which differ from detecting every frame
+    detection = (modules.globals.keyframe_interval, modules.globals.roi_detection, modules.globals.roi_refresh_interval)
+    digest.update(repr((FACE_ANALYSER_NAME, det_size, det_thresh, detection)).encode())
+    return digest.hexdigest()
+
+
+def open_target_analysis(target_path: str) -> Optional[TargetAnalysis]:
+    global TARGET_ANALYSIS
+    # whatever an earlier, unfinished job recorded is incomplete
+    close_target_analysis(save=False)
+    if not modules.globals.target_analysis_cache_path or not target_path or not os.path.isfile(target_path):
+        return None
+    cache_path = os.path.join(modules.globals.target_analysis_cache_path, get_target_analysis_key(target_path))
+    TARGET_ANALYSIS = TargetAnalysis(cache_path)
+    return TARGET_ANALYSIS
+
+
+def get_target_analysis() -> Optional[TargetAnalysis]:
+    return TARGET_ANALYSIS
+
+
+def close_target_analysis(save: bool = True) -> None:
+    global TARGET_ANALYSIS
+    if TARGET_ANALYSIS is not None and save:
+        TARGET_ANALYSIS.save()
+    TARGET_ANALYSIS = None
@@ -1,4 +1,6 @@
-from typing import Any
+import time
+import threading
+from typing import Any, Dict, Optional, Tuple
 import cv2
 
 
@@ -30,3 +32,113 @@ def get_video_frame_total(video_path: str) -> int:
     video_frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
     capture.release()
     return video_frame_total
+
+
+class CameraCapture:
+    """
+    Reads a camera on its own thread and keeps only the newest frame.
+
+    The reader thread drains the camera as fast as it delivers frames, so
+    frames never queue up in the driver while a frame is being processed.
+    read() hands out the newest frame once and waits for the next one;
+    frames that were replaced before anybody read them are counted as dropped.
+    """
+
+    def __init__(self, camera_index: int, width: int, height: int, fps: int = 60) -> None:
+        self.camera_index = camera_index
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.capture: Optional[cv2.VideoCapture] = None
+        self.capture_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+        self.frame: Any = None
+        self.frame_number = 0
+        self.frame_time = 0.0
+        self.read_number = 0
+        self.captured = 0
+        self.dropped = 0
+        self.frame_age = 0.0
+        self.start_time = 0.0
+        self.open()
+
+    def open(self) -> None:
+        capture = cv2.VideoCapture(self.camera_index)
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        capture.set(cv2.CAP_PROP_FPS, self.fps)
+        # keep as few frames as possible buffered in the driver, not every backend supports it
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.capture = capture
+
+    def set_resolution(self, width: int, height: int) -> None:
+        with self.capture_lock:
+            self.width = width
+            self.height = height
+            if self.capture is not None:
+                self.capture.release()
+            self.open()
+
+    def isOpened(self) -> bool:
+        return self.capture is not None and self.capture.isOpened()
+
+    def start(self) -> 'CameraCapture':
+        if self.thread is None:
+            self.running = True
+            self.start_time = time.perf_counter()
+            self.thread = threading.Thread(target=self.serve, name='camera-capture', daemon=True)
+            self.thread.start()
+        return self
+
+    def serve(self) -> None:
+        while self.running:
+            with self.capture_lock:
+                has_frame, frame = self.capture.read() if self.isOpened() else (False, None)
+            with self.condition:
+                if not has_frame:
+                    self.running = False
+                    self.condition.notify_all()
+                    break
+                if self.frame_number > self.read_number:
+                    self.dropped += 1
+                self.frame = frame
+                self.frame_number += 1
+                self.frame_time = time.perf_counter()
+                self.captured += 1
+                self.condition.notify_all()
+
+    def read(self, timeout: float = 1.0) -> Tuple[bool, Any]:
+        """
+        Returns the newest frame that was not read yet, waiting up to timeout seconds for one.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_number > self.read_number or not self.running, timeout)
+            if self.frame_number <= self.read_number:
+                return False, None
+            self.read_number = self.frame_number
+            self.frame_age = time.perf_counter() - self.frame_time
+            return True, self.frame
+
+    def release(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.capture_lock:
+            if self.capture is not None:
+                self.capture.release()
+                self.capture = None
+
+    def get_stats(self) -> Dict[str, float]:
+        with self.condition:
+            elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+            return {
+                'captured': self.captured,
+                'dropped': self.dropped,
+                'capture_fps': self.captured / elapsed if elapsed > 0 else 0.0,
+                'frame_age_ms': self.frame_age * 1000
+            }
@@ -18,9 +18,12 @@ import tensorflow
 import modules.globals
 import modules.metadata
 import modules.ui as ui
-from modules.processors.frame.core import get_frame_processors_modules
+from modules.processors.frame.core import get_frame_processors_modules, process_video_stream, process_video_fused
 from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
 from modules.face_analyser import initialize_face_analyser
+from modules.analysis_cache import open_target_analysis, close_target_analysis
+from modules.inference_batcher import get_batchers_metrics, format_batcher_metrics, stop_batchers
+from modules.mask_cache import get_mask_cache_stats, format_mask_cache_stats
 
 if 'ROCMExecutionProvider' in modules.globals.execution_providers:
     del torch
@@ -38,6 +41,11 @@ def parse_args() -> None:
     program.add_argument('--keep-fps', help='keep original fps', dest='keep_fps', action='store_true', default=True)
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=False)
+    program.add_argument('--stream-frames', help='decode, process and encode frames in memory without writing temporary frames', dest='stream_frames', action='store_true', default=False)
+    program.add_argument('--separate-processor-passes', help='run every frame processor in its own pass over the temporary frames', dest='separate_processor_passes', action='store_true', default=False)
+    program.add_argument('--source-face-cache', help='directory to persist detected source faces between runs', dest='source_face_cache_path')
+    program.add_argument('--target-analysis-cache', help='directory to persist per frame face analysis of target videos between runs', dest='target_analysis_cache_path')
+    program.add_argument('--identity-gallery', help='file to keep the identities of many faces tracking in between runs', dest='identity_gallery_path')
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
     program.add_argument('--nsfw-filter', help='filter the NSFW image or video', dest='nsfw_filter', action='store_true', default=False)
     program.add_argument('--video-encoder', help='adjust output video encoder', dest='video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9'])
@@ -45,9 +53,19 @@ def parse_args() -> None:
     program.add_argument('--flip-x', help='The live camera display flipped on x axis', dest='flip_x', action='store_true', default=False)
     program.add_argument('--flip-y', help='The live camera display flipped on y axis', dest='flip_y', action='store_true', default=False)
     program.add_argument('--live-resizable', help='The live camera frame is resizable', dest='live_resizable', action='store_true', default=True)
+    program.add_argument('--live-pipeline-depth', help='frames each stage of the live pipeline may queue', dest='live_pipeline_depth', type=int, default=2)
+    program.add_argument('--live-latency-budget', help='milliseconds after which a live frame is skipped when a newer one is waiting', dest='live_latency_budget', type=float, default=150.0)
+    program.add_argument('--live-target-fps', help='lower the live quality step by step to hold this frame rate (0 keeps full quality)', dest='live_target_fps', type=float, default=0.0)
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--keyframe-interval', help='detect faces every this many frames and follow them with optical flow in between (1 detects every frame)', dest='keyframe_interval', type=int, default=1)
+    program.add_argument('--roi-detection', help='detect faces in crops around the faces of the last frame, the whole frame only every --roi-refresh-interval frames or when a face got lost', dest='roi_detection', action='store_true', default=False)
+    program.add_argument('--roi-refresh-interval', help='frames between detections on the whole frame with --roi-detection', dest='roi_refresh_interval', type=int, default=30)
+    program.add_argument('--session-pool-size', help='model sessions per model on the CPU, every one limited to its share of the cores (0 gives every execution thread its own)', dest='session_pool_size', type=int, default=0)
+    program.add_argument('--frame-batch-size', help='consecutive frames handed at once to frame processors that process batches', dest='frame_batch_size', type=int, default=1)
+    program.add_argument('--inference-batch-size', help='batch model calls from the execution threads up to this size (1 disables batching)', dest='inference_batch_size', type=int, default=1)
+    program.add_argument('--inference-batch-wait', help='milliseconds a model call waits for others to join its batch', dest='inference_batch_wait', type=float, default=2.0)
     program.add_argument('-v', '--version', action='version', version=f'{modules.metadata.name} {modules.metadata.version}')
 
     program.add_argument('--both-faces', help='use two faces in source image', dest='both_faces', action='store_true', default=False)
@@ -74,6 +92,10 @@ def parse_args() -> None:
     modules.globals.keep_fps = args.keep_fps
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
+    modules.globals.stream_frames = args.stream_frames
+    modules.globals.separate_processor_passes = args.separate_processor_passes
+    modules.globals.source_face_cache_path = args.source_face_cache_path
+    modules.globals.target_analysis_cache_path = args.target_analysis_cache_path
     modules.globals.many_faces = args.many_faces
     modules.globals.nsfw_filter = args.nsfw_filter
     modules.globals.video_encoder = args.video_encoder
@@ -84,6 +106,17 @@ def parse_args() -> None:
     modules.globals.max_memory = args.max_memory
     modules.globals.execution_providers = decode_execution_providers(args.execution_provider)
     modules.globals.execution_threads = args.execution_threads
+    modules.globals.keyframe_interval = args.keyframe_interval
+    modules.globals.roi_detection = args.roi_detection
+    modules.globals.roi_refresh_interval = args.roi_refresh_interval
+    modules.globals.identity_gallery_path = args.identity_gallery_path
+    modules.globals.frame_batch_size = args.frame_batch_size
+    modules.globals.session_pool_size = args.session_pool_size
+    modules.globals.inference_batch_size = args.inference_batch_size
+    modules.globals.inference_batch_wait = args.inference_batch_wait
+    modules.globals.live_pipeline_depth = args.live_pipeline_depth
+    modules.globals.live_latency_budget = args.live_latency_budget
+    modules.globals.live_target_fps = args.live_target_fps
 
     modules.globals.both_faces = args.both_faces
     modules.globals.flip_faces = args.flip_faces
@@ -168,6 +201,15 @@ def limit_resources() -> None:
 
 
 def release_resources() -> None:
+    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+        if hasattr(frame_processor, 'save_face_tracking'):
+            frame_processor.save_face_tracking()
+    for name, metrics in get_batchers_metrics().items():
+        update_status(format_batcher_metrics(name, metrics), 'DLC.BATCHER')
+    stop_batchers()
+    mask_cache_stats = get_mask_cache_stats()
+    if mask_cache_stats['hits'] or mask_cache_stats['misses']:
+        update_status(format_mask_cache_stats(mask_cache_stats), 'DLC.MASKS')
     if 'CUDAExecutionProvider' in modules.globals.execution_providers:
         torch.cuda.empty_cache()
 
@@ -214,22 +256,46 @@ def start() -> None:
         return
     update_status('Creating temp resources...')
     create_temp(modules.globals.target_path)
-    update_status('Extracting frames...')
-    extract_frames(modules.globals.target_path)
-    temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-        update_status('Progressing...', frame_processor.NAME)
-        frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
+    if modules.globals.stream_frames:
+        fps = 30.0
+        if modules.globals.keep_fps:
+            update_status('Detecting fps...')
+            fps = detect_fps(modules.globals.target_path)
+        update_status(f'Streaming video with {fps} fps...')
+        open_target_analysis(modules.globals.target_path)
+        done = process_video_stream(modules.globals.source_path, modules.globals.target_path, get_frame_processors_modules(modules.globals.frame_processors), fps)
+        close_target_analysis()
         release_resources()
-    # handles fps
-    if modules.globals.keep_fps:
-        update_status('Detecting fps...')
-        fps = detect_fps(modules.globals.target_path)
-        update_status(f'Creating video with {fps} fps...')
-        create_video(modules.globals.target_path, fps)
+        if not done:
+            clean_temp(modules.globals.target_path)
+            update_status('Processing to video failed!')
+            return
     else:
-        update_status('Creating video with 30.0 fps...')
-        create_video(modules.globals.target_path)
+        update_status('Extracting frames...')
+        extract_frames(modules.globals.target_path)
+        temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+        open_target_analysis(modules.globals.target_path)
+        if modules.globals.separate_processor_passes:
+            # only the first frame processor sees the untouched frames the target analysis describes
+            for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+                update_status('Progressing...', frame_processor.NAME)
+                frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
+                close_target_analysis()
+                release_resources()
+        else:
+            update_status('Progressing...')
+            process_video_fused(modules.globals.source_path, temp_frame_paths, get_frame_processors_modules(modules.globals.frame_processors))
+            close_target_analysis()
+            release_resources()
+        # handles fps
+        if modules.globals.keep_fps:
+            update_status('Detecting fps...')
+            fps = detect_fps(modules.globals.target_path)
+            update_status(f'Creating video with {fps} fps...')
+            create_video(modules.globals.target_path, fps)
+        else:
+            update_status('Creating video with 30.0 fps...')
+            create_video(modules.globals.target_path)
     # handle audio
     if modules.globals.keep_audio:
         if modules.globals.keep_fps:
@@ -1,10 +1,31 @@
-from typing import Any, List, Optional
+import os
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import cv2
+import numpy
 import insightface
+from insightface.utils import face_align
 
 import modules.globals
 from modules.typing import Frame, Face
+from modules.inference_batcher import get_batcher, is_batching_enabled
+from modules.session_pool import pool_model_session
 
 FACE_ANALYSER = None
+FACE_ANALYSER_NAME = 'buffalo_l'
+FACE_ANALYSER_DET_SIZE = 640
+SOURCE_FACES_CACHE: Dict[Tuple[Any, ...], List[Face]] = {}
+SOURCE_FACES_LOCK = threading.Lock()
+SOURCE_FACE_FIELDS = ['bbox', 'kps', 'landmark_2d_106', 'landmark_3d_68', 'embedding', 'det_score', 'gender', 'age']
+FACE_DETECTOR_NAME = 'DLC.FACE-DETECTOR'
+FACE_RECOGNIZER_NAME = 'DLC.FACE-RECOGNIZER'
+# Frames letterboxed into one detector input, larger batches are split
+DETECTION_BATCH_SIZE = 16
+# Aligned faces embedded with one run of the recognition model
+RECOGNITION_BATCH_SIZE = 32
+ANCHOR_CENTERS: Dict[Tuple[int, int, int, int], numpy.ndarray] = {}
 
 
 def get_face_analyser() -> Any:
@@ -14,6 +35,275 @@ def get_face_analyser() -> Any:
     return FACE_ANALYSER
 
 
+class FrameSequencer:
+    """Runs one step per frame of a parallel job strictly in frame order."""
+
+    def __init__(self, timeout: float = 30.0) -> None:
+        self.next_frame_index = 0
+        self.timeout = timeout
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def turn(self, frame_index: int) -> Iterator[None]:
+        with self.condition:
+            # a frame that never arrives (e.g. dropped after an error) must not stall the job forever
+            if not self.condition.wait_for(lambda: self.next_frame_index >= frame_index, self.timeout):
+                print(f'Frame {frame_index} stopped waiting for frame {self.next_frame_index}')
+            try:
+                yield
+            finally:
+                self.next_frame_index = max(self.next_frame_index, frame_index + 1)
+                self.condition.notify_all()
+
+    def complete(self, frame_index: int) -> None:
+        # a frame that failed before its turn must still let the frames after it go ahead
+        with self.turn(frame_index):
+            pass
+
+
+class FrameContext:
+    """
+    Analysis of one frame, computed once and shared by every frame processor.
+
+    When the frame is an untouched frame of the target video, analysis is the
+    target's stored analysis (see modules.analysis_cache): faces are read from
+    it instead of detected, or recorded into it for the next run. A job that
+    renders several source faces from one decode gives every output its own
+    context and output_index, sharing the detected faces between them.
+    """
+
+    def __init__(self, frame_index: int = 0, faces: Optional[List[Face]] = None, sequencer: Optional[FrameSequencer] = None, analysis: Any = None, output_index: int = 0) -> None:
+        self.frame_index = frame_index
+        self.faces = faces
+        self.sequencer = sequencer
+        self.analysis = analysis
+        self.output_index = output_index
+        self.lock = threading.Lock()
+
+    def get_faces(self, frame: Frame) -> List[Face]:
+        with self.lock:
+            if self.faces is None and self.analysis is not None:
+                self.faces = self.analysis.get_faces(self.frame_index)
+            if self.faces is None:
+                self.faces = detect_faces(frame)
+                if self.analysis is not None:
+                    self.analysis.add_faces(self.frame_index, self.faces)
+            return self.faces
+
+    def clear(self) -> None:
+        # the frame changed, so the stored analysis no longer describes it
+        with self.lock:
+            self.faces = None
+            self.analysis = None
+
+
+def detect_faces(frame: Frame) -> List[Face]:
+    try:
+        # detections asked for by several threads at once share one run of the detector
+        if is_batching_enabled():
+            return get_batcher(FACE_DETECTOR_NAME, get_many_faces_batch).run([frame])[0]
+        return get_many_faces_batch([frame])[0]
+    except Exception as exception:
+        print(f'Error detecting faces: {exception}')
+    return []
+
+
+def detect_faces_batch(frames: List[Frame]) -> List[List[Face]]:
+    try:
+        return get_many_faces_batch(frames)
+    except Exception as exception:
+        print(f'Error detecting faces: {exception}')
+    return [detect_faces(frame) for frame in frames]
+
+
+def detect_frames_faces(frames: List[Frame], contexts: List['FrameContext']) -> None:
+    """
+    Fills in the faces of every context that has none yet, reading the stored analysis
+    first and detecting the remaining frames with one batched detection.
+    """
+    missing = []
+    for frame, context in zip(frames, contexts):
+        with context.lock:
+            if context.faces is None and context.analysis is not None:
+                context.faces = context.analysis.get_faces(context.frame_index)
+            if context.faces is None and frame is not None:
+                missing.append((frame, context))
+    if not missing:
+        return
+    for (frame, context), faces in zip(missing, detect_faces_batch([frame for frame, _ in missing])):
+        with context.lock:
+            if context.faces is None:
+                context.faces = faces
+                if context.analysis is not None:
+                    context.analysis.add_faces(context.frame_index, faces)
+
+
+def get_many_faces_batch(frames: List[Frame]) -> List[List[Face]]:
+    """
+    Like get_many_faces for several frames, running the detector once per DETECTION_BATCH_SIZE frames
+    and the recognition model once for the faces of all frames (see embed_faces).
+    """
+    det_model = get_face_analyser().det_model
+    input_size = get_detection_size()
+    detections: List[Tuple[numpy.ndarray, Optional[numpy.ndarray]]] = []
+    for start in range(0, len(frames), DETECTION_BATCH_SIZE):
+        batch_frames = frames[start:start + DETECTION_BATCH_SIZE]
+        detections.extend(detect_batch(det_model, batch_frames, input_size) or [det_model.detect(frame, input_size=input_size, max_num=0, metric='default') for frame in batch_frames])
+    return create_faces(frames, detections)
+
+
+def detect_faces_in_regions(frame: Frame, regions: List[Tuple[int, int, int, int]]) -> List[List[Face]]:
+    """
+    Detects the faces in every region (x1, y1, x2, y2) of one frame, returned in frame coordinates.
+
+    The crops go through the detector together at an input size that fits
+    the largest crop instead of the full detection size, so a small region
+    costs a fraction of a detection on the whole frame.
+    """
+    det_model = get_face_analyser().det_model
+    frame_detections: List[Tuple[numpy.ndarray, Optional[numpy.ndarray]]] = [(numpy.zeros((0, 5), dtype=numpy.float32), None) for _ in regions]
+    crops = [(index, frame[y1:y2, x1:x2]) for index, (x1, y1, x2, y2) in enumerate(regions)]
+    crops = [(index, crop) for index, crop in crops if crop.size]
+    if crops:
+        crop_size = max(max(crop.shape[:2]) for _, crop in crops)
+        # the detector takes input sizes in steps of its largest stride
+        size = min(max(get_detection_size()), -(-crop_size // 32) * 32)
+        input_size = (size, size)
+        crop_frames = [crop for _, crop in crops]
+        detections = detect_batch(det_model, crop_frames, input_size) or [det_model.detect(crop, input_size=input_size, max_num=0, metric='default') for crop in crop_frames]
+        for (index, _), (det, kpss) in zip(crops, detections):
+            x1, y1 = regions[index][:2]
+            det = det + numpy.array([x1, y1, x1, y1, 0], dtype=det.dtype)
+            if kpss is not None:
+                kpss = kpss + numpy.array([x1, y1], dtype=kpss.dtype)
+            frame_detections[index] = (det, kpss)
+    return create_faces([frame] * len(regions), frame_detections)
+
+
+def create_faces(frames: List[Frame], detections: List[Tuple[numpy.ndarray, Optional[numpy.ndarray]]]) -> List[List[Face]]:
+    """
+    Turns the detections of every frame into faces, completed by every other model of the face analyser.
+    """
+    face_analyser = get_face_analyser()
+    frames_faces: List[List[Face]] = []
+    for frame, (det, kpss) in zip(frames, detections):
+        faces = []
+        for index in range(det.shape[0]):
+            face = Face(bbox=det[index, 0:4], kps=kpss[index] if kpss is not None else None, det_score=det[index, 4])
+            for taskname, model in face_analyser.models.items():
+                if taskname not in ('detection', 'recognition'):
+                    model.get(frame, face)
+            faces.append(face)
+        frames_faces.append(faces)
+    embed_faces([(frame, face) for frame, faces in zip(frames, frames_faces) for face in faces])
+    return frames_faces
+
+
+def embed_faces(frame_faces: List[Tuple[Frame, Face]]) -> None:
+    """
+    Aligns every face and computes all their embeddings in batches of RECOGNITION_BATCH_SIZE.
+    Every face gets its embedding and, once, the embedding scaled to unit length as unit_embedding.
+    """
+    rec_model = get_face_analyser().models.get('recognition')
+    frame_faces = [(frame, face) for frame, face in frame_faces if face.kps is not None]
+    if rec_model is None or not frame_faces:
+        return
+    crops = [face_align.norm_crop(frame, landmark=face.kps, image_size=rec_model.input_size[0]) for frame, face in frame_faces]
+    if is_batching_enabled():
+        # faces of several threads share a run as well
+        embeddings = numpy.asarray(get_batcher(FACE_RECOGNIZER_NAME, lambda batch_crops: list(get_embeddings(batch_crops))).run(crops))
+    else:
+        embeddings = get_embeddings(crops)
+    unit_embeddings = embeddings / numpy.maximum(numpy.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    for (_, face), embedding, unit_embedding in zip(frame_faces, embeddings, unit_embeddings):
+        face.embedding = embedding
+        face.unit_embedding = unit_embedding
+
+
+def get_embeddings(crops: List[Frame]) -> numpy.ndarray:
+    rec_model = get_face_analyser().models['recognition']
+    return numpy.concatenate([rec_model.get_feat(crops[start:start + RECOGNITION_BATCH_SIZE]) for start in range(0, len(crops), RECOGNITION_BATCH_SIZE)]).reshape(len(crops), -1)
+
+
+def detect_batch(det_model: Any, frames: List[Frame], input_size: Optional[Tuple[int, int]] = None) -> Optional[List[Tuple[numpy.ndarray, Optional[numpy.ndarray]]]]:
+    """
+    Runs the SCRFD detector on several frames with one session call and returns the boxes
+    (with scores) and keypoints of every frame, the same as det_model.detect(frame, input_size) would.
+    None when the frames should be detected one by one.
+    """
+    input_size = input_size or det_model.input_size
+    if len(frames) < 2 or input_size is None or not takes_batches(det_model):
+        return None
+    input_size = tuple(input_size)
+    letterboxed = [letterbox_frame(frame, input_size) for frame in frames]
+    blob = cv2.dnn.blobFromImages([det_frame for det_frame, _ in letterboxed], 1.0 / det_model.input_std, input_size, (det_model.input_mean, det_model.input_mean, det_model.input_mean), swapRB=True)
+    try:
+        net_outs = det_model.session.run(det_model.output_names, {det_model.input_name: blob})
+        # batched exports put the frame first, the others stack the anchors of all frames
+        net_outs = [net_out if det_model.batched else net_out.reshape(len(frames), -1, net_out.shape[-1]) for net_out in net_outs]
+    except Exception as exception:
+        # a failed run says nothing about the next one, only these frames fall back
+        print(f'Detecting these faces frame by frame, the batched detection failed: {exception}')
+        return None
+    return [decode_detections(det_model, [net_out[index] for net_out in net_outs], input_size, det_scale) for index, (_, det_scale) in enumerate(letterboxed)]
+
+
+def takes_batches(det_model: Any) -> bool:
+    # an export with a fixed batch of one frame never takes more, a named or missing batch dimension may
+    input_shape = getattr(det_model, 'input_shape', None)
+    return not (input_shape and isinstance(input_shape[0], int) and input_shape[0] == 1)
+
+
+def letterbox_frame(frame: Frame, input_size: Tuple[int, int]) -> Tuple[Frame, float]:
+    # scaled to fit into the top left corner of the detector input, like SCRFD.detect does
+    input_width, input_height = input_size
+    frame_ratio = float(frame.shape[0]) / frame.shape[1]
+    if frame_ratio > float(input_height) / input_width:
+        new_height = input_height
+        new_width = int(new_height / frame_ratio)
+    else:
+        new_width = input_width
+        new_height = int(new_width * frame_ratio)
+    det_frame = numpy.zeros((input_height, input_width, 3), dtype=numpy.uint8)
+    det_frame[:new_height, :new_width] = cv2.resize(frame, (new_width, new_height))
+    return det_frame, float(new_height) / frame.shape[0]
+
+
+def decode_detections(det_model: Any, net_outs: List[numpy.ndarray], input_size: Tuple[int, int], det_scale: float) -> Tuple[numpy.ndarray, Optional[numpy.ndarray]]:
+    input_width, input_height = input_size
+    fmc = det_model.fmc
+    scores_list, bboxes_list, kpss_list = [], [], []
+    for index, stride in enumerate(det_model._feat_stride_fpn):
+        scores = net_outs[index].reshape(-1)
+        positive = numpy.flatnonzero(scores >= det_model.det_thresh)
+        centers = get_anchor_centers(input_height // stride, input_width // stride, stride, det_model._num_anchors)[positive]
+        distances = net_outs[index + fmc][positive] * stride
+        scores_list.append(scores[positive])
+        bboxes_list.append(numpy.hstack([centers - distances[:, 0:2], centers + distances[:, 2:4]]))
+        if det_model.use_kps:
+            kps_distances = net_outs[index + fmc * 2][positive] * stride
+            kpss_list.append(centers[:, numpy.newaxis, :] + kps_distances.reshape(-1, kps_distances.shape[1] // 2, 2))
+    scores = numpy.concatenate(scores_list)
+    order = scores.argsort()[::-1]
+    pre_det = numpy.hstack([numpy.vstack(bboxes_list) / det_scale, scores[:, numpy.newaxis]]).astype(numpy.float32, copy=False)[order]
+    keep = det_model.nms(pre_det)
+    kpss = None
+    if det_model.use_kps:
+        kpss = (numpy.vstack(kpss_list) / det_scale)[order][keep]
+    return pre_det[keep], kpss
+
+
+def get_anchor_centers(height: int, width: int, stride: int, num_anchors: int) -> numpy.ndarray:
+    key = (height, width, stride, num_anchors)
+    anchor_centers = ANCHOR_CENTERS.get(key)
+    if anchor_centers is None:
+        anchor_centers = (numpy.stack(numpy.mgrid[:height, :width][::-1], axis=-1).astype(numpy.float32) * stride).reshape(-1, 2)
+        if num_anchors > 1:
+            anchor_centers = numpy.repeat(anchor_centers, num_anchors, axis=0)
+        ANCHOR_CENTERS[key] = anchor_centers
+    return anchor_centers
+
+
 def get_one_face(frame: Frame) -> Optional[Face]:
     faces = FACE_ANALYSER.get(frame, max_num=1)
     return faces[0] if faces else None
@@ -30,24 +320,40 @@ def initialize_face_analyser():
         try:
             # 使用与GUI版本相同的初始化方式
             FACE_ANALYSER = insightface.app.FaceAnalysis(
-                name="buffalo_l", providers=modules.globals.execution_providers
+                name=FACE_ANALYSER_NAME, providers=modules.globals.execution_providers
             )
             print("✅ 使用自定义执行提供者初始化成功")
         except Exception as e:
             print(f"⚠️  使用自定义执行提供者失败: {str(e)}")
             try:
                 # 尝试使用默认设置
-                FACE_ANALYSER = insightface.app.FaceAnalysis(name="buffalo_l")
+                FACE_ANALYSER = insightface.app.FaceAnalysis(name=FACE_ANALYSER_NAME)
                 print("✅ 使用默认设置初始化成功")
             except Exception as e2:
                 print(f"❌ 面部分析器初始化失败: {str(e2)}")
                 print("📥 请确保模型文件已正确下载")
                 raise e2
 
-        FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
+        FACE_ANALYSER.prepare(ctx_id=0, det_size=(FACE_ANALYSER_DET_SIZE, FACE_ANALYSER_DET_SIZE))
+        # detector, recognizer and the other models run in one session per execution thread
+        # every embedding goes through the recognizer batcher, but the detector is also run straight
+        # from the compute workers (frame batches) and the decode stage (ROI crops)
+        for taskname, model in FACE_ANALYSER.models.items():
+            pool_model_session(model, batched=taskname == 'recognition')
         print("🎯 面部分析器准备完成")
 
 
+def set_detection_size(size: int = FACE_ANALYSER_DET_SIZE) -> None:
+    # the detector takes any input size, a smaller one is faster but misses small faces;
+    # the model itself is left alone, detections running right now keep the size they started with
+    get_face_analyser().det_size = (size, size)
+
+
+def get_detection_size() -> Tuple[int, int]:
+    # read once per detection call and passed on, so every frame of a call is detected at the same size
+    return tuple(getattr(get_face_analyser(), 'det_size', None) or (FACE_ANALYSER_DET_SIZE, FACE_ANALYSER_DET_SIZE))
+
+
 def get_one_face_left(frame: Frame) -> Optional[Face]:
     faces = FACE_ANALYSER.get(frame)
     return min(faces, key=lambda x: x.bbox[0]) if faces else None
@@ -61,3 +367,69 @@ def get_one_face_right(frame: Frame) -> Optional[Face]:
 def get_two_faces(frame: Frame) -> List[Face]:
     faces = FACE_ANALYSER.get(frame, max_num=2)
     return sorted(faces, key=lambda x: x.bbox[0])
+
+
+def get_source_faces_key(source_path: str) -> Tuple[Any, ...]:
+    face_analyser = get_face_analyser()
+    stat = os.stat(source_path)
+    # source images are detected at the size the detector was prepared with, not the live detection size
+    det_size = tuple(getattr(face_analyser.det_model, 'input_size', None) or ())
+    det_thresh = getattr(face_analyser, 'det_thresh', None)
+    return os.path.abspath(source_path), stat.st_mtime_ns, stat.st_size, FACE_ANALYSER_NAME, det_size, det_thresh
+
+
+def get_source_faces(source_path: str) -> List[Face]:
+    if not source_path or not os.path.isfile(source_path):
+        return []
+    key = get_source_faces_key(source_path)
+    with SOURCE_FACES_LOCK:
+        source_faces = SOURCE_FACES_CACHE.get(key)
+        if source_faces is None:
+            source_faces = load_source_faces(key)
+            if source_faces is None:
+                faces = get_many_faces(cv2.imread(source_path)) or []
+                source_faces = sorted(faces, key=lambda face: face.bbox[0])[:10]
+                save_source_faces(key, source_faces)
+            SOURCE_FACES_CACHE[key] = source_faces
+    return list(source_faces)
+
+
+def clear_source_faces() -> None:
+    with SOURCE_FACES_LOCK:
+        SOURCE_FACES_CACHE.clear()
+
+
+def get_source_faces_cache_path(key: Tuple[Any, ...]) -> Optional[str]:
+    if not modules.globals.source_face_cache_path:
+        return None
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(modules.globals.source_face_cache_path, digest + '.npz')
+
+
+def load_source_faces(key: Tuple[Any, ...]) -> Optional[List[Face]]:
+    cache_path = get_source_faces_cache_path(key)
+    if not cache_path or not os.path.isfile(cache_path):
+        return None
+    try:
+        with numpy.load(cache_path) as data:
+            fields = {name: data[name] for name in SOURCE_FACE_FIELDS if name in data.files}
+        return [Face(**{name: values[index] for name, values in fields.items()}) for index in range(len(fields['bbox']))]
+    except Exception as exception:
+        print(f'Failed to load source face cache {cache_path}: {exception}')
+    return None
+
+
+def save_source_faces(key: Tuple[Any, ...], source_faces: List[Face]) -> None:
+    cache_path = get_source_faces_cache_path(key)
+    if not cache_path or not source_faces:
+        return
+    fields = {}
+    for name in SOURCE_FACE_FIELDS:
+        values = [face.get(name) for face in source_faces]
+        if all(value is not None for value in values):
+            fields[name] = numpy.stack([numpy.asarray(value) for value in values])
+    try:
+        os.makedirs(modules.globals.source_face_cache_path, exist_ok=True)
+        numpy.savez(cache_path, **fields)
+    except Exception as exception:
+        print(f'Failed to save source face cache {cache_path}: {exception}')
@@ -0,0 +1,522 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import modules.globals
+from modules.face_analyser import FrameContext
+from modules.typing import Face
+from modules.motion_filter import MotionFilter, MOTION_GATE
+from modules.identity_gallery import get_identity_gallery_path, load_identity_gallery
+
+# How "sticky" the tracking is, meaning how likely it is to stick with the same face
+STICKINESS_FACTOR = 0.8  # Adjust this to change how "sticky" the tracking is
+# Tracks lost for longer than this many frames stop moving along their last motion
+MOTION_MAX_LOST_FRAMES = 30
+# How many tracks many faces mode keeps before reusing the one lost the longest
+MAX_TRACKED_FACES = 256
+# How many frames a face can be lost for before we stop tracking it (assuming 30 frames per second, this is 60 seconds)
+MAX_LOST_COUNT = 1800
+# How similar a face that no track matched must be to a known identity to get its track back
+REID_MIN_SIMILARITY = 0.4
+# How many known identities are looked at for every face that no track matched
+REID_CANDIDATES = 5
+# How many track scores the UI shows (target_face1_score .. target_face10_score)
+UI_TRACKED_FACES = 10
+
+
+class FaceTracker:
+    """
+    Tracking state for one job: the one or two tracked faces and the many faces tracks.
+
+    Association must see the frames in order, so it runs inside turn(), which
+    waits for the previous frame when the frame context carries a sequencer.
+    Swapping and blending happen outside of turn() and stay parallel.
+    """
+
+    def __init__(self, output_index: int = 0) -> None:
+        self.lock = threading.RLock()
+        self.output_index = output_index # Which output of the job this tracker belongs to, each has its own snapshot
+        self.gallery = None
+        self.gallery_path: Optional[str] = None
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forgets every tracked face. The known identities are kept, so a reset in the middle of a session
+        doesn't lose the ones learned since the snapshot was loaded.
+        """
+        with self.lock:
+            self.tracks = [create_track(), create_track()] # The first and second tracked faces
+            self.many_tracks: Dict[int, Dict[str, Any]] = {} # The tracked faces in many faces mode, by gallery key
+            # The embeddings of every identity seen in many faces mode, restored from the snapshot only when it is first set
+            gallery_path = get_identity_gallery_path(modules.globals.identity_gallery_path, self.output_index)
+            if self.gallery is None or gallery_path != self.gallery_path:
+                self.gallery = load_identity_gallery(gallery_path, MAX_TRACKED_FACES, MAX_LOST_COUNT)
+                self.gallery_path = gallery_path
+            self.face_lost_count = 0 # How many frames in a row the single tracked face has been lost
+
+    @contextmanager
+    def turn(self, context: Optional[FrameContext] = None) -> Iterator[None]:
+        """
+        Holds the tracker for one frame, in frame order when the frame belongs to a sequenced job.
+        """
+        if context is not None and context.sequencer is not None:
+            with context.sequencer.turn(context.frame_index), self.lock:
+                yield
+        else:
+            with self.lock:
+                yield
+
+    @property
+    def first_face_embedding(self) -> Optional[np.ndarray]:
+        return self.tracks[0]['embedding']
+
+    def track_single(self, target_face: Face, detected_faces: List[Face]) -> Optional[Face]:
+        """
+        Follows one face using distance and embedding matching.
+        Returns the face to swap, a pseudo face, or None when nothing should be swapped.
+        """
+        track = self.tracks[0]
+
+        if track['embedding'] is None:
+            # Initialization
+            target_position = get_face_center(target_face)
+            track.update(embedding=extract_face_embedding(target_face), position=target_position, id=id(target_face), motion=MotionFilter(target_face.bbox))
+            self.face_lost_count = 0
+            return target_face
+
+        predict_tracks([track])
+
+        _, _, old_weight, new_weight, _ = get_match_weights()
+        best_match_score = 0
+        best_match_face = None
+        if detected_faces:
+            # Score every detected face against the track at once, the first face wins ties like before
+            scores = score_tracks([track], detected_faces)[:, 0]
+            best_index = int(np.argmax(scores))
+            if scores[best_index] > 0:
+                best_match_score = float(scores[best_index])
+                best_match_face = detected_faces[best_index]
+            modules.globals.target_face1_score = best_match_score
+
+        if best_match_face is not None and best_match_score > modules.globals.sticky_face_value:
+            self.face_lost_count = 0
+            # Update the embedding using weighted average
+            track['embedding'] = old_weight * track['embedding'] + new_weight * extract_face_embedding(best_match_face)
+            track['motion'].update(best_match_face.bbox)
+            track['position'] = tuple(track['motion'].center)
+            track['id'] = id(best_match_face)
+            track['lost'] = 0
+            return best_match_face
+
+        self.face_lost_count += 1
+        track['lost'] += 1
+        if modules.globals.use_pseudo_face and best_match_score < modules.globals.pseudo_face_threshold:
+            # Put the pseudo face where the face is expected to be by now
+            return create_pseudo_face(get_track_position(track))
+        return None
+
+    def track_both(self, target_faces: List[Face], source_indices: List[int], source_face_order: List[int]) -> List[Tuple[Optional[Face], int]]:
+        """
+        Follows two faces, filtering their positions to reduce flickering.
+        Returns the face to swap (or None) and the source face index to use, for each target face.
+        """
+        if any(track['embedding'] is None for track in self.tracks):
+            # Initialization of one or both faces
+            results = []
+            for target_face, source_index in zip(target_faces, source_indices):
+                source_index = source_face_order[source_index % 2]
+                track = self.tracks[0 if source_index % 2 == 0 else 1]
+                target_position = get_face_center(target_face)
+                track.update(embedding=extract_face_embedding(target_face), position=target_position, id=id(target_face), motion=MotionFilter(target_face.bbox), lost=0)
+                results.append((target_face, source_index))
+            return results
+
+        predict_tracks(self.tracks)
+        embeddings = [extract_face_embedding(face) for face in target_faces]
+        scores = score_tracks(self.tracks, target_faces, embeddings)
+        matches = assign_tracks(scores)
+        results = []
+        matched_tracks = set()
+        for face_index, (target_face, source_index) in enumerate(zip(target_faces, source_indices)):
+            track_index = matches.get(face_index, -1)
+            score = scores[face_index, track_index] if track_index != -1 else -1
+            if track_index != -1 and score > modules.globals.sticky_face_value:
+                self.update_track(self.tracks[track_index], target_face, embeddings[face_index])
+                self.tracks[track_index]['lost'] = 0
+                matched_tracks.add(track_index)
+                setattr(modules.globals, f'target_face{track_index + 1}_score', score)
+                results.append((target_face, source_face_order[track_index]))
+                continue
+            if modules.globals.use_pseudo_face and score < modules.globals.pseudo_face_threshold:
+                if track_index == -1:
+                    avg_position = get_face_center(target_face)
+                else:
+                    avg_position = get_track_position(self.tracks[track_index])
+                results.append((create_pseudo_face(avg_position), source_index))
+                continue
+            results.append((None, source_index))
+
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched_tracks:
+                track['lost'] += 1
+        return results
+
+    def track_many(self, target_faces: List[Face], source_face_count: int) -> List[Tuple[Optional[Face], int]]:
+        """
+        Follows any number of faces, matching all of them to the tracks at once.
+        A face no track matched is looked up in the identity gallery, so a person who comes back gets their old track.
+        Returns the face to swap (or None) and the source face index to use, for each target face.
+        """
+        keys = [key for key, track in self.many_tracks.items() if track['embedding'] is not None and track['position'] is not None]
+        tracks = [self.many_tracks[key] for key in keys]
+        predict_tracks(tracks)
+        embeddings = [extract_face_embedding(face) for face in target_faces]
+        scores = score_tracks(tracks, target_faces, embeddings, self.gallery.embeddings[keys])
+        matches = assign_tracks(scores)
+        # Faces close enough to a track, face index -> track key
+        matched_keys = {face_index: keys[track_index] for face_index, track_index in matches.items() if scores[face_index, track_index] > modules.globals.sticky_face_value}
+        reid_keys = self.reidentify([face_index for face_index in range(len(target_faces)) if face_index not in matched_keys], embeddings, set(matched_keys.values()))
+
+        results = []
+        seen_keys = set(matched_keys.values())
+        for face_index, target_face in enumerate(target_faces):
+            track_index = matches.get(face_index, -1)
+            score = scores[face_index, track_index] if track_index != -1 else -1
+            if face_index in matched_keys:
+                key = matched_keys[face_index]
+                track = self.many_tracks[key]
+                self.update_track(track, target_face, embeddings[face_index])
+                self.gallery.set(key, track['embedding'])
+                track['lost'] = 0
+                if key < UI_TRACKED_FACES:
+                    setattr(modules.globals, f'target_face{key + 1}_score', score)
+                results.append((target_face, key % source_face_count))
+                continue
+
+            if face_index in reid_keys:
+                # A face we saw before, its track starts over where the face is now
+                key, similarity = reid_keys[face_index]
+                seen_keys.add(key)
+                old_embedding = self.many_tracks[key]['embedding'] if key in self.many_tracks else self.gallery.embeddings[key]
+                _, _, old_weight, new_weight, _ = get_match_weights()
+                self.many_tracks[key] = create_track(old_weight * old_embedding + new_weight * embeddings[face_index], get_face_center(target_face), id(target_face), target_face.bbox)
+                self.gallery.set(key, self.many_tracks[key]['embedding'])
+                if key < UI_TRACKED_FACES:
+                    setattr(modules.globals, f'target_face{key + 1}_score', similarity)
+                results.append((target_face, key % source_face_count))
+                continue
+
+            if modules.globals.use_pseudo_face and score < modules.globals.pseudo_face_threshold:
+                if track_index == -1:
+                    avg_position = get_face_center(target_face)
+                else:
+                    avg_position = get_track_position(self.many_tracks[keys[track_index]])
+                results.append((create_pseudo_face(avg_position), 0))
+                continue
+
+            # A face we haven't seen yet starts a new identity, reusing the one lost the longest when the gallery is full
+            new_key = self.gallery.add(embeddings[face_index], exclude=seen_keys)
+            if new_key == -1:
+                # Every identity is taken by a face of this frame, there is no track left for this one
+                results.append((None, 0))
+                continue
+            seen_keys.add(new_key)
+            self.many_tracks[new_key] = create_track(embeddings[face_index], get_face_center(target_face), id(target_face), target_face.bbox)
+            if new_key < UI_TRACKED_FACES:
+                setattr(modules.globals, f'target_face{new_key + 1}_score', 0.00)
+            results.append((target_face, new_key % source_face_count))
+
+        for key, track in self.many_tracks.items():
+            if key not in seen_keys:
+                track['lost'] += 1
+        # Identities lost for longer than MAX_LOST_COUNT frames are forgotten
+        for key in self.gallery.age(seen_keys):
+            self.many_tracks.pop(key, None)
+        return results
+
+    def reidentify(self, face_indices: List[int], embeddings: List[np.ndarray], taken_keys: set) -> Dict[int, Tuple[int, float]]:
+        """
+        Finds the known identity of every face that no track matched, each identity at most once.
+        Returns a dict of face index -> (gallery key, similarity).
+        """
+        if not face_indices or not len(self.gallery):
+            return {}
+        candidate_keys, similarities = self.gallery.search(np.asarray([embeddings[face_index] for face_index in face_indices]), REID_CANDIDATES, exclude=taken_keys)
+        # Most similar pairs first, so two faces can't both claim the same identity
+        pairs = sorted(((similarity, face_index, int(key)) for face_index, row_keys, row_similarities in zip(face_indices, candidate_keys, similarities)
+                        for key, similarity in zip(row_keys, row_similarities) if key != -1 and similarity >= REID_MIN_SIMILARITY), reverse=True)
+        reid_keys: Dict[int, Tuple[int, float]] = {}
+        used_keys = set()
+        for similarity, face_index, key in pairs:
+            if face_index not in reid_keys and key not in used_keys:
+                reid_keys[face_index] = (key, float(similarity))
+                used_keys.add(key)
+        return reid_keys
+
+    def save_gallery(self) -> None:
+        """
+        Writes the known identities to the snapshot, if one is set and there is anything to write.
+        """
+        with self.lock:
+            if self.gallery_path and len(self.gallery):
+                self.gallery.save(self.gallery_path)
+
+    def update_track(self, track: Dict[str, Any], face: Face, embedding: np.ndarray) -> None:
+        """
+        Moves a track onto the face it was matched with.
+        """
+        _, _, old_weight, new_weight, _ = get_match_weights()
+        # Update the tracked face with a weighted average of the new embedding
+        track['embedding'] = old_weight * track['embedding'] + new_weight * embedding
+        # Correct the predicted position with where the face was found
+        if track['motion'] is None:
+            track['motion'] = MotionFilter(face.bbox)
+        else:
+            track['motion'].update(face.bbox)
+        track['position'] = tuple(track['motion'].center)
+        track['id'] = id(face)
+
+
+def score_tracks(tracks: List[Dict[str, Any]], faces: List[Face], embeddings: Optional[List[np.ndarray]] = None, track_embeddings: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Scores every face against every track in one go.
+    track_embeddings are the tracks' embeddings scaled to unit length, when the caller already has them.
+    Returns an N x M matrix (faces x tracks) of weighted embedding and position scores.
+    """
+    if not tracks or not faces:
+        return np.zeros((len(faces), len(tracks)), dtype=np.float32)
+    embedding_weight, position_weight, _, _, total_weight = get_match_weights()
+    if embeddings is None:
+        embeddings = [extract_face_embedding(face) for face in faces]
+
+    # Cosine similarity of every face to every track, the face embeddings already have unit length (see extract_face_embedding)
+    face_embeddings = np.asarray(embeddings, dtype=np.float32)
+    if track_embeddings is None:
+        track_embeddings = normalize_rows(np.asarray([track['embedding'] for track in tracks], dtype=np.float32))
+    similarity = face_embeddings @ track_embeddings.T
+
+    # How far every face is from where every track is expected to be
+    face_positions = np.asarray([get_face_center(face) for face in faces], dtype=np.float32)
+    track_positions = np.asarray([get_track_position(track) for track in tracks], dtype=np.float32)
+    distance = np.linalg.norm(face_positions[:, None, :] - track_positions[None, :, :], axis=2)
+    position_consistency = 1 / (1 + distance)
+    # A face outside the gate of a track's motion can only be matched by its embedding
+    for track_index, track in enumerate(tracks):
+        if track.get('motion') is not None:
+            position_consistency[track['motion'].get_gating_distances(face_positions) > MOTION_GATE, track_index] = 0
+
+    scores = (embedding_weight * similarity + position_weight * position_consistency) / total_weight
+    # Stick with the face each track followed last frame
+    same_face = np.asarray([id(face) for face in faces])[:, None] == np.asarray([track['id'] if track['id'] is not None else -1 for track in tracks])[None, :]
+    scores[same_face] *= (1 + STICKINESS_FACTOR)
+    return scores
+
+
+def assign_tracks(scores: np.ndarray) -> Dict[int, int]:
+    """
+    Pairs faces with tracks so the total score is as high as possible, each track used at most once.
+    Returns a dict of face index -> track index.
+    """
+    if scores.size == 0:
+        return {}
+    face_indices, track_indices = linear_sum_assignment(scores, maximize=True)
+    return {int(face_index): int(track_index) for face_index, track_index in zip(face_indices, track_indices)}
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scales every row to a length of 1, leaving all zero rows alone.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def create_track(embedding: Optional[np.ndarray] = None, position: Optional[Tuple[float, float]] = None, face_id: Optional[int] = None, bbox: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    Creates the state of one tracked face.
+    """
+    motion = MotionFilter(bbox) if bbox is not None else None
+    return {'embedding': embedding, 'position': position, 'id': face_id, 'motion': motion, 'lost': 0}
+
+
+def predict_tracks(tracks: List[Dict[str, Any]]) -> None:
+    """
+    Moves every track one frame ahead along its motion.
+    """
+    for track in tracks:
+        if track.get('motion') is not None and track['lost'] <= MOTION_MAX_LOST_FRAMES:
+            track['motion'].predict()
+
+
+def get_track_position(track: Dict[str, Any]) -> Tuple[float, float]:
+    """
+    Gets where the tracked face is expected to be in the current frame.
+    """
+    if track.get('motion') is not None:
+        return tuple(track['motion'].center)
+    return track['position']
+
+
+def get_match_weights() -> Tuple[float, float, float, float, float]:
+    """
+    Reads the tracking weights from the settings.
+    Returns the embedding, position, old embedding, new embedding and total weights.
+    """
+    embedding_weight = modules.globals.embedding_weight_size
+    position_weight = modules.globals.position_size
+    total = modules.globals.old_embedding_weight + modules.globals.new_embedding_weight
+    old_weight = modules.globals.old_embedding_weight / total
+    new_weight = modules.globals.new_embedding_weight / total
+    total_weight = embedding_weight * modules.globals.weight_distribution_size + position_weight
+    return embedding_weight, position_weight, old_weight, new_weight, total_weight
+
+
+def get_face_center(face: Face) -> Tuple[float, float]:
+    """
+    Gets the center of the face.
+    """
+    bbox = face.bbox # Get the bounding box for the face
+    return ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2) # Calculate the center using the bounding box
+
+
+def extract_face_embedding(face: Face) -> np.ndarray:
+    """
+    Extracts the face embedding (how the face looks).
+    """
+    try:
+        if face.get('unit_embedding') is not None: # If the face analyser already scaled the embedding to a length of 1
+            return face.unit_embedding # Use it as it is
+        if face.get('embedding') is None: # The embedding is computed with the faces, it can't be made up later
+            raise ValueError('the face has no embedding')
+
+        # Normalize the embedding once and keep it on the face
+        face.unit_embedding = face.embedding / np.linalg.norm(face.embedding) # Make the embedding have a length of 1
+        return face.unit_embedding
+    except Exception as e:
+        print(f"Error extracting face embedding: {e}") # Print an error message if something goes wrong
+        # Return a default embedding (all zeros) if extraction fails
+        return np.zeros(512, dtype=np.float32) # Return an empty embedding
+
+
+def find_best_match(embedding: np.ndarray, faces: List[Face]) -> Optional[Face]:
+    """
+    Finds the face that is most similar to the given embedding.
+    """
+    if embedding is None:
+        # Handle case where embedding is None, maybe log a message or skip processing
+        print("No embedding to match against, skipping face matching.") # If no embedding, we can't match
+        return None
+    best_match = None # Make a variable to store the best face
+    best_similarity = -1 # Make a variable to store the best similarity score
+
+    for face in faces: # Loop through all the faces
+        face_embedding = extract_face_embedding(face) # Get the embedding for this face
+        similarity = cosine_similarity(embedding, face_embedding) # Calculate how similar this face is
+
+        if similarity > best_similarity: # If this is the most similar face
+            best_similarity = similarity # Store the similarity score
+            best_match = face # Store the face
+
+    return best_match
+
+
+def cosine_similarity(a, b):
+    """
+    Calculates how similar two embeddings are.
+    """
+    if a is None or b is None:
+        # Log an error message or handle the None case appropriately
+        # print("Warning: One of the embeddings is None.")
+        return 0  # or handle it as needed # If either embedding doesn't exist, they are not similar
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)) # Calculate the cosine similarity
+
+
+def create_pseudo_face(position):
+    """
+    Creates a fake face object for face tracking when a real face is not detected.
+    """
+    class PseudoFace: # Create a new class for the fake face
+        def __init__(self, position):
+            x, y = position # Get the center of the face
+            width = height = 100  # Approximate face size # Choose a size for the fake face
+
+            # More realistic bbox
+            self.bbox = np.array([x - width / 2, y - height / 2, x + width / 2, y + height / 2]) # Create a bounding box for the face
+
+            # Generate landmarks
+            self.landmark_2d_106 = generate_anatomical_landmarks(position) # Create landmarks for the face
+
+            # Extract kps from landmarks
+            self.kps = np.array([
+                self.landmark_2d_106[36],  # Left eye
+                self.landmark_2d_106[90],  # Right eye
+                self.landmark_2d_106[80],  # Nose tip
+                self.landmark_2d_106[57],  # Left mouth corner
+                self.landmark_2d_106[66]  # Right mouth corner
+            ]) # Create key points from the landmarks
+
+            # Generate 3D landmarks (just add a random z-coordinate to 2D landmarks)
+            self.landmark_3d_68 = np.column_stack((self.landmark_2d_106[:68], np.random.normal(0, 5, 68))) # Create 3d landmarks
+
+            # Other attributes
+            self.det_score = 0.99 # Set a high detection score
+            self.embedding = np.random.rand(512)  # Random embedding # Create a random embedding
+            self.embedding_norm = np.linalg.norm(self.embedding) # Calculate the length of the embedding
+            self.gender = 0 # Set the gender to male
+            self.age = 25 # Set the age to 25
+            self.pose = np.zeros(3) # Set the pose to 0
+            self.normed_embedding = self.embedding / self.embedding_norm # Normalize the embedding
+
+    return PseudoFace(position) # Create a fake face at the given position
+
+
+def generate_anatomical_landmarks(position):
+    """
+    Generates fake face landmarks for the pseudo face.
+    """
+    x, y = position # Get the center position
+    landmarks = [] # List to store the landmarks
+
+    # Right side face (0-16)
+    for i in range(17):
+        landmarks.append([x - 40 + i * 2, y - 30 + i * 3]) # Create landmarks along the right side of the face
+
+    # Left side face (17-32)
+    for i in range(16):
+        landmarks.append([x + 40 - i * 2, y - 30 + i * 3]) # Create landmarks along the left side of the face
+
+    # Right eye (33-42)
+    eye_center = [x - 20, y - 10] # Set the position of the right eye
+    for i in range(10):
+        angle = i * (2 * np.pi / 10) # Calculate the angle around the eye
+        landmarks.append([eye_center[0] + 10 * np.cos(angle), eye_center[1] + 5 * np.sin(angle)]) # Create landmarks around the eye
+
+    # Right eyebrow (43-51)
+    for i in range(9):
+        landmarks.append([x - 35 + i * 5, y - 30]) # Create landmarks for the right eyebrow
+
+    # Mouth (52-71)
+    mouth_center = [x, y + 30] # Set the position of the mouth
+    for i in range(20):
+        angle = i * (2 * np.pi / 20) # Calculate the angle around the mouth
+        landmarks.append([mouth_center[0] + 15 * np.cos(angle), mouth_center[1] + 7 * np.sin(angle)]) # Create landmarks around the mouth
+
+    # Nose (72-86)
+    for i in range(15):
+        landmarks.append([x - 7 + i, y + 10 + i // 2]) # Create landmarks for the nose
+
+    # Left eye (87-96)
+    eye_center = [x + 20, y - 10] # Set the position of the left eye
+    for i in range(10):
+        angle = i * (2 * np.pi / 10) # Calculate the angle around the eye
+        landmarks.append([eye_center[0] + 10 * np.cos(angle), eye_center[1] + 5 * np.sin(angle)]) # Create landmarks around the eye
+
+    # Left eyebrow (97-105)
+    for i in range(9):
+        landmarks.append([x + 5 + i * 5, y - 30]) # Create landmarks for the left eyebrow
+
+    return np.array(landmarks, dtype=np.float32)
@@ -16,6 +16,10 @@ frame_processors: List[str] = []
 keep_fps = None
 keep_audio = None
 keep_frames = None
+stream_frames = False
+separate_processor_passes = False
+source_face_cache_path = None
+target_analysis_cache_path = None
 many_faces = None
 
 nsfw_filter = None
@@ -28,6 +32,18 @@ live_resizable = True
 max_memory = None
 execution_providers: List[str] = []
 execution_threads = None
+frame_batch_size = 1
+session_pool_size = 0
+inference_batch_size = 1
+inference_batch_wait = 2.0
+keyframe_interval = 1
+roi_detection = False
+roi_refresh_interval = 30
+identity_gallery_path = None
+live_pipeline_depth = 2
+live_latency_budget = 150.0
+live_target_fps = 0.0
+mouth_mask_allowed = True
 headless = None
 log_level = 'error'
 fp_ui: Dict[str, bool] = {}
@@ -0,0 +1,135 @@
+import os
+from typing import Iterable, List, Optional, Tuple
+import numpy
+
+EMBEDDING_SIZE = 512
+
+
+class IdentityGallery:
+    """
+    Embeddings of every identity a job has seen, one row of a float32 matrix per identity.
+
+    Rows are unit length, so one matrix product compares a batch of faces
+    with every identity and search() returns the k most similar ones. The
+    row index is the identity's key. Identities that were not seen for more
+    than max_lost frames are forgotten by age(); when all rows are taken the
+    identity lost the longest gives up its row. A gallery can be saved to
+    and loaded from a .npz snapshot.
+    """
+
+    def __init__(self, capacity: int = 256, max_lost: int = 1800, embedding_size: int = EMBEDDING_SIZE) -> None:
+        self.capacity = max(1, capacity)
+        self.max_lost = max_lost
+        self.embeddings = numpy.zeros((self.capacity, embedding_size), dtype=numpy.float32)
+        self.used = numpy.zeros(self.capacity, dtype=bool)
+        self.lost = numpy.zeros(self.capacity, dtype=numpy.int64)
+
+    def __len__(self) -> int:
+        return int(self.used.sum())
+
+    def keys(self) -> List[int]:
+        return numpy.flatnonzero(self.used).tolist()
+
+    def add(self, embedding: numpy.ndarray, exclude: Iterable[int] = ()) -> int:
+        """
+        Stores a new identity and returns its key, never one of the excluded keys.
+        Returns -1 when the gallery is full and every key is excluded.
+        """
+        exclude = list(exclude)
+        free_keys = numpy.flatnonzero(~self.used)
+        if len(free_keys):
+            key = int(free_keys[0])
+        else:
+            lost = self.lost.astype(numpy.float64)
+            lost[exclude] = -numpy.inf
+            key = int(numpy.argmax(lost))
+            if lost[key] == -numpy.inf:
+                return -1
+        self.used[key] = True
+        self.set(key, embedding)
+        return key
+
+    def set(self, key: int, embedding: numpy.ndarray) -> None:
+        embedding = numpy.asarray(embedding, dtype=numpy.float32).ravel()
+        self.embeddings[key] = embedding / max(float(numpy.linalg.norm(embedding)), 1e-12)
+        self.lost[key] = 0
+
+    def remove(self, key: int) -> None:
+        self.used[key] = False
+        self.embeddings[key] = 0
+        self.lost[key] = 0
+
+    def search(self, embeddings: numpy.ndarray, k: int = 1, exclude: Iterable[int] = ()) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Finds the k most similar identities for every embedding.
+        Returns keys and cosine similarities, both n x k and best first; missing matches have key -1.
+        """
+        embeddings = numpy.asarray(embeddings, dtype=numpy.float32).reshape(-1, self.embeddings.shape[1])
+        embeddings = embeddings / numpy.maximum(numpy.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        similarity = embeddings @ self.embeddings.T
+        available = self.used.copy()
+        available[list(exclude)] = False
+        similarity[:, ~available] = -numpy.inf
+        k = max(1, min(k, self.capacity))
+        keys = numpy.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        similarities = numpy.take_along_axis(similarity, keys, axis=1)
+        order = numpy.argsort(-similarities, axis=1)
+        keys = numpy.take_along_axis(keys, order, axis=1)
+        similarities = numpy.take_along_axis(similarities, order, axis=1)
+        keys[~numpy.isfinite(similarities)] = -1
+        return keys, similarities
+
+    def age(self, seen_keys: Iterable[int]) -> List[int]:
+        """
+        Counts one more lost frame for every identity that was not seen and forgets the ones lost too long.
+        Returns the forgotten keys.
+        """
+        unseen = self.used.copy()
+        unseen[list(seen_keys)] = False
+        self.lost[unseen] += 1
+        forgotten = numpy.flatnonzero(self.used & (self.lost > self.max_lost)).tolist()
+        for key in forgotten:
+            self.remove(key)
+        return forgotten
+
+    def save(self, path: str) -> None:
+        keys = numpy.flatnonzero(self.used)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = path + '.tmp.npz'
+        numpy.savez(temp_path, keys=keys, embeddings=self.embeddings[keys])
+        os.replace(temp_path, path)
+
+    def load(self, path: str) -> bool:
+        try:
+            with numpy.load(path) as snapshot:
+                keys, embeddings = snapshot['keys'], snapshot['embeddings']
+            if embeddings.shape[1:] != self.embeddings.shape[1:]:
+                raise ValueError(f'embeddings of size {embeddings.shape[1:]} instead of {self.embeddings.shape[1:]}')
+        except Exception as exception:
+            print(f'Failed to load identity gallery {path}: {exception}')
+            return False
+        fits = keys < self.capacity
+        # a restored identity gets the full max_lost frames to show up again
+        self.used[:] = False
+        self.used[keys[fits]] = True
+        self.embeddings[:] = 0
+        self.embeddings[keys[fits]] = embeddings[fits]
+        self.lost[:] = 0
+        return True
+
+
+def get_identity_gallery_path(path: Optional[str], output_index: int = 0) -> Optional[str]:
+    # every output of a job that renders several source faces keeps its own identities, numbered like its temp output
+    if not path or not output_index:
+        return path
+    name, extension = os.path.splitext(path)
+    return f'{name}-{output_index}{extension}'
+
+
+def load_identity_gallery(path: Optional[str], capacity: int = 256, max_lost: int = 1800) -> IdentityGallery:
+    gallery = IdentityGallery(capacity, max_lost)
+    if path and os.path.isfile(path):
+        gallery.load(path)
+    return gallery
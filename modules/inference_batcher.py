@@ -0,0 +1,160 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+import modules.globals
+
+BATCHERS: Dict[str, 'DynamicBatcher'] = {}
+BATCHERS_LOCK = threading.Lock()
+BATCHER_STOP = object()
+
+
+class DynamicBatcher:
+    """
+    Turns model calls made by many worker threads into batched calls.
+
+    Requests are queued and a single thread collects them until max_batch_size
+    are waiting or the oldest one waited max_wait_ms, then runs them through
+    run_batch at once. Each caller waits on the future of its own request.
+    run_batch takes a list of inputs and returns a list of outputs in the
+    same order.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait_ms: float = 2.0, name: str = 'batcher') -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+        self.name = name
+        self.queue: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.reset_metrics()
+
+    def submit(self, item: Any) -> Future:
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items: List[Any]) -> List[Future]:
+        self.start()
+        submitted = time.perf_counter()
+        futures = []
+        for item in items:
+            future: Future = Future()
+            self.queue.put((item, future, submitted))
+            futures.append(future)
+        return futures
+
+    def run(self, items: List[Any]) -> List[Any]:
+        return [future.result() for future in self.submit_many(items)]
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.serve, name=self.name, daemon=True)
+                self.thread.start()
+
+    def stop(self) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(BATCHER_STOP)
+            thread.join()
+
+    def serve(self) -> None:
+        stopping = False
+        while not stopping:
+            request = self.queue.get()
+            if request is BATCHER_STOP:
+                break
+            batch = [request]
+            deadline = request[2] + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is BATCHER_STOP:
+                    stopping = True
+                    break
+                batch.append(request)
+            self.run_requests(batch)
+
+    def run_requests(self, batch: List[Any]) -> None:
+        start_time = time.perf_counter()
+        try:
+            results = self.run_batch([item for item, _, _ in batch])
+            if len(results) != len(batch):
+                # a missing result would leave its caller waiting forever
+                raise ValueError(f'{self.name} returned {len(results)} results for {len(batch)} requests')
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        except BaseException as exception:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(exception)
+        end_time = time.perf_counter()
+        with self.lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.wait_seconds += sum(start_time - submitted for _, _, submitted in batch)
+            self.latency_seconds += sum(end_time - submitted for _, _, submitted in batch)
+            self.run_seconds += end_time - start_time
+            self.first_time = self.first_time or min(submitted for _, _, submitted in batch)
+            self.last_time = end_time
+
+    def reset_metrics(self) -> None:
+        with self.lock:
+            self.requests = 0
+            self.batches = 0
+            self.largest_batch = 0
+            self.wait_seconds = 0.0
+            self.latency_seconds = 0.0
+            self.run_seconds = 0.0
+            self.first_time = 0.0
+            self.last_time = 0.0
+
+    def get_metrics(self) -> Dict[str, float]:
+        with self.lock:
+            requests = max(1, self.requests)
+            elapsed = self.last_time - self.first_time
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'average_batch_size': self.requests / max(1, self.batches),
+                'largest_batch': self.largest_batch,
+                'average_wait_ms': self.wait_seconds / requests * 1000,
+                'average_latency_ms': self.latency_seconds / requests * 1000,
+                'average_run_ms': self.run_seconds / max(1, self.batches) * 1000,
+                'requests_per_second': self.requests / elapsed if elapsed > 0 else 0.0
+            }
+
+
+def is_batching_enabled() -> bool:
+    return modules.globals.inference_batch_size > 1
+
+
+def get_batcher(name: str, run_batch: Callable[[List[Any]], List[Any]]) -> DynamicBatcher:
+    with BATCHERS_LOCK:
+        if name not in BATCHERS:
+            BATCHERS[name] = DynamicBatcher(run_batch, modules.globals.inference_batch_size, modules.globals.inference_batch_wait, name)
+        return BATCHERS[name]
+
+
+def get_batchers_metrics() -> Dict[str, Dict[str, float]]:
+    with BATCHERS_LOCK:
+        batchers = dict(BATCHERS)
+    return {name: batcher.get_metrics() for name, batcher in batchers.items()}
+
+
+def format_batcher_metrics(name: str, metrics: Dict[str, float]) -> str:
+    return f"{name}: {metrics['requests']} requests in {metrics['batches']} batches (average {metrics['average_batch_size']:.1f}, largest {metrics['largest_batch']}), wait {metrics['average_wait_ms']:.1f} ms, latency {metrics['average_latency_ms']:.1f} ms, {metrics['requests_per_second']:.1f} requests/s"
+
+
+def stop_batchers() -> None:
+    with BATCHERS_LOCK:
+        batchers = list(BATCHERS.values())
+        BATCHERS.clear()
+    for batcher in batchers:
+        batcher.stop()
@@ -0,0 +1,158 @@
+from typing import Callable, List, Optional
+import cv2
+import numpy
+
+import modules.globals
+from modules.typing import Face, Frame
+from modules.face_analyser import detect_faces
+from modules.roi_detector import RoiDetector
+
+# A landmark counts as tracked when following it back lands within this many pixels of where it started
+KEYFRAME_MAX_BACK_ERROR = 1.5
+# Below this share of tracked landmarks on any face the faces are detected again
+KEYFRAME_MIN_TRACKED_SHARE = 0.6
+KEYFRAME_MIN_TRACKED_POINTS = 6
+# Histogram correlation between two frames below this is taken as a scene cut
+KEYFRAME_SCENE_CUT_CORRELATION = 0.7
+KEYFRAME_HISTOGRAM_SIZE = (64, 36)
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+
+class KeyframeTracker:
+    """
+    Detects faces on keyframes only and follows them in between.
+
+    A keyframe is every interval-th frame, the first frame after a scene cut
+    and any frame on which the faces could no longer be followed. On the
+    other frames the landmarks of every face are followed from the previous
+    frame with sparse optical flow, checked by following them back again,
+    and the face is moved by the similarity transform of its tracked
+    landmarks, which keep their own position. Embedding, age, gender and
+    detection score are kept, so the detector, landmark and recognition
+    models only run on keyframes. With a roi_detector keyframes are detected
+    around the faces of the last keyframe (see modules.roi_detector).
+    Frames must be passed in order.
+    """
+
+    def __init__(self, interval: int = 1, roi_detector: Optional[RoiDetector] = None) -> None:
+        self.interval = max(1, interval)
+        self.roi_detector = roi_detector
+        self.detect: Callable[[Frame], List[Face]] = roi_detector.detect if roi_detector else detect_faces
+        self.detections = 0
+        self.propagations = 0
+        self.reset()
+
+    def reset(self) -> None:
+        if self.roi_detector:
+            self.roi_detector.reset()
+        self.clear()
+
+    def clear(self) -> None:
+        self.previous_gray: Optional[numpy.ndarray] = None
+        self.previous_histogram: Optional[numpy.ndarray] = None
+        self.previous_index = -1
+        self.keyframe_index = -1
+        self.faces: List[Face] = []
+
+    def get_faces(self, frame_index: int, frame: Frame) -> List[Face]:
+        if self.interval == 1:
+            self.clear()
+            self.detections += 1
+            return self.detect(frame)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        histogram = get_histogram(gray)
+        faces = None
+        if not self.is_keyframe(frame_index, gray, histogram):
+            faces = self.propagate(gray)
+        if faces is None:
+            faces = self.detect(frame)
+            self.keyframe_index = frame_index
+            self.detections += 1
+        else:
+            self.propagations += 1
+        self.previous_gray = gray
+        self.previous_histogram = histogram
+        self.previous_index = frame_index
+        self.faces = faces
+        return faces
+
+    def is_keyframe(self, frame_index: int, gray: numpy.ndarray, histogram: numpy.ndarray) -> bool:
+        if self.previous_gray is None or self.previous_gray.shape != gray.shape:
+            return True
+        if frame_index <= self.previous_index or frame_index - self.keyframe_index >= self.interval:
+            return True
+        return cv2.compareHist(self.previous_histogram, histogram, cv2.HISTCMP_CORREL) < KEYFRAME_SCENE_CUT_CORRELATION
+
+    def propagate(self, gray: numpy.ndarray) -> Optional[List[Face]]:
+        """
+        Follows the faces of the previous frame into this one, None if any of them got lost.
+        """
+        if not self.faces:
+            return []
+        face_points = [get_face_points(face) for face in self.faces]
+        points = numpy.concatenate(face_points).reshape(-1, 1, 2)
+        moved_points, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, points, None, **LK_PARAMS)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous_gray, moved_points, None, **LK_PARAMS)
+        back_error = numpy.linalg.norm(back_points - points, axis=2).ravel()
+        tracked = (status.ravel() == 1) & (back_status.ravel() == 1) & (back_error < KEYFRAME_MAX_BACK_ERROR)
+        moved_points = moved_points.reshape(-1, 2)
+        faces = []
+        start = 0
+        for face, face_point in zip(self.faces, face_points):
+            end = start + len(face_point)
+            face_tracked = tracked[start:end]
+            if face_tracked.sum() < max(KEYFRAME_MIN_TRACKED_POINTS, KEYFRAME_MIN_TRACKED_SHARE * len(face_point)):
+                return None
+            matrix, _ = cv2.estimateAffinePartial2D(face_point[face_tracked], moved_points[start:end][face_tracked], method=cv2.RANSAC, ransacReprojThreshold=3.0)
+            if matrix is None:
+                return None
+            moved_face = move_face(face, matrix)
+            if face.get('landmark_2d_106') is not None:
+                # tracked landmarks keep their own motion, e.g. of the mouth, lost ones move with the face
+                moved_face.landmark_2d_106[face_tracked] = moved_points[start:end][face_tracked]
+            faces.append(moved_face)
+            start = end
+        return faces
+
+
+def create_keyframe_tracker() -> KeyframeTracker:
+    roi_detector = RoiDetector(modules.globals.roi_refresh_interval) if modules.globals.roi_detection else None
+    return KeyframeTracker(modules.globals.keyframe_interval, roi_detector)
+
+
+def get_histogram(gray: numpy.ndarray) -> numpy.ndarray:
+    small = cv2.resize(gray, KEYFRAME_HISTOGRAM_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.calcHist([small], [0], None, [32], [0, 256])
+
+
+def get_face_points(face: Face) -> numpy.ndarray:
+    # the dense landmarks follow the face best, detection keypoints are the fallback
+    points = face.get('landmark_2d_106')
+    if points is None:
+        points = face.kps
+    return numpy.asarray(points, dtype=numpy.float32).reshape(-1, 2)
+
+
+def move_face(face: Face, matrix: numpy.ndarray) -> Face:
+    """
+    Returns a copy of the face moved by a 2x3 similarity transform.
+    """
+    scale = float(numpy.sqrt(abs(numpy.linalg.det(matrix[:, :2]))))
+
+    def transform(points: numpy.ndarray) -> numpy.ndarray:
+        return (numpy.asarray(points, dtype=numpy.float32) @ matrix[:, :2].T + matrix[:, 2]).astype(numpy.float32)
+
+    moved = Face(**dict(face))
+    x1, y1, x2, y2 = numpy.asarray(face.bbox, dtype=numpy.float32)
+    center = transform(numpy.array([[(x1 + x2) / 2, (y1 + y2) / 2]]))[0]
+    half_size = numpy.array([x2 - x1, y2 - y1], dtype=numpy.float32) * scale / 2
+    moved.bbox = numpy.concatenate([center - half_size, center + half_size])
+    moved.kps = transform(face.kps)
+    if face.get('landmark_2d_106') is not None:
+        moved.landmark_2d_106 = transform(face.landmark_2d_106)
+    if face.get('landmark_3d_68') is not None:
+        landmark_3d_68 = numpy.array(face.landmark_3d_68, dtype=numpy.float32)
+        landmark_3d_68[:, :2] = transform(landmark_3d_68[:, :2])
+        landmark_3d_68[:, 2] *= scale
+        moved.landmark_3d_68 = landmark_3d_68
+    return moved
@@ -0,0 +1,139 @@
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import modules.globals
+
+
+class LiveFrame(NamedTuple):
+    frame_index: int
+    capture_time: float
+    value: Any
+
+
+class LivePipeline:
+    """
+    Runs live frames through a chain of stages, each on its own thread.
+
+    A reader thread pulls frames from read(), every stage takes the previous
+    stage's output from a bounded queue of depth frames and the caller takes
+    the last stage's output with get(). While the second stage works on frame
+    N the first one already works on frame N+1, so the frame rate is bound by
+    the slowest stage rather than the sum of all of them. Stages run one frame
+    at a time, in frame order.
+
+    A frame that is older than latency_budget_ms when a stage picks it up is
+    skipped if a newer frame already waits behind it, so a slow stage shows
+    the newest frame instead of working through a backlog.
+    """
+
+    def __init__(self, read: Callable[[], Tuple[bool, Any]], stages: List[Tuple[str, Callable[[int, Any], Any]]], depth: int = 2, latency_budget_ms: float = 150.0) -> None:
+        self.read = read
+        self.stages = stages
+        self.depth = max(1, depth)
+        self.latency_budget = max(0.0, latency_budget_ms) / 1000
+        self.queues = [queue.Queue(maxsize=self.depth) for _ in range(len(stages) + 1)]
+        self.threads: List[threading.Thread] = []
+        self.running = False
+        self.lock = threading.Lock()
+        self.reset_metrics()
+
+    def start(self) -> 'LivePipeline':
+        if self.threads:
+            return self
+        self.running = True
+        self.threads = [threading.Thread(target=self.read_stage, name='live-read', daemon=True)]
+        for stage_index, (name, _) in enumerate(self.stages):
+            self.threads.append(threading.Thread(target=self.run_stage, args=(stage_index,), name=f'live-{name}', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def read_stage(self) -> None:
+        frame_index = 0
+        while self.running:
+            has_frame, frame = self.read()
+            if has_frame:
+                self.put(self.queues[0], LiveFrame(frame_index, time.perf_counter(), frame))
+                frame_index += 1
+
+    def run_stage(self, stage_index: int) -> None:
+        name, run = self.stages[stage_index]
+        input_queue, output_queue = self.queues[stage_index], self.queues[stage_index + 1]
+        while self.running:
+            try:
+                item = input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if time.perf_counter() - item.capture_time > self.latency_budget and not input_queue.empty():
+                with self.lock:
+                    self.skipped[name] += 1
+                continue
+            start_time = time.perf_counter()
+            try:
+                value = run(item.frame_index, item.value)
+            except Exception as exception:
+                print(f'Live {name} failed: {exception}')
+                continue
+            with self.lock:
+                self.stage_seconds[name] += time.perf_counter() - start_time
+                self.stage_frames[name] += 1
+            self.put(output_queue, item._replace(value=value))
+
+    def put(self, output_queue: queue.Queue, item: LiveFrame) -> None:
+        # a full queue means the next stage is behind, wait for it unless the pipeline stops
+        while self.running:
+            try:
+                output_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, timeout: float = 0.05) -> Optional[LiveFrame]:
+        """
+        Returns the next output of the last stage, or None if there was none within timeout seconds.
+        """
+        try:
+            item = self.queues[-1].get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.lock:
+            self.frames += 1
+            self.latency_seconds += time.perf_counter() - item.capture_time
+        return item
+
+    def stop(self) -> None:
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for stage_queue in self.queues:
+            while not stage_queue.empty():
+                stage_queue.get_nowait()
+
+    def reset_metrics(self) -> None:
+        with self.lock:
+            self.frames = 0
+            self.latency_seconds = 0.0
+            self.stage_seconds: Dict[str, float] = {name: 0.0 for name, _ in self.stages}
+            self.stage_frames: Dict[str, int] = {name: 0 for name, _ in self.stages}
+            self.skipped: Dict[str, int] = {name: 0 for name, _ in self.stages}
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'frames': self.frames,
+                'average_latency_ms': self.latency_seconds / max(1, self.frames) * 1000,
+                'stage_ms': {name: self.stage_seconds[name] / max(1, self.stage_frames[name]) * 1000 for name, _ in self.stages},
+                'skipped': sum(self.skipped.values())
+            }
+
+
+def create_live_pipeline(read: Callable[[], Tuple[bool, Any]], stages: List[Tuple[str, Callable[[int, Any], Any]]]) -> LivePipeline:
+    return LivePipeline(read, stages, modules.globals.live_pipeline_depth, modules.globals.live_latency_budget)
+
+
+def format_live_metrics(metrics: Dict[str, Any]) -> str:
+    stages = ', '.join(f'{name} {stage_ms:.0f} ms' for name, stage_ms in metrics['stage_ms'].items())
+    return f"latency {metrics['average_latency_ms']:.0f} ms ({stages}), {metrics['skipped']} skipped"
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple
+import cv2
+import numpy
+
+# Masks are built for sizes rounded up to a multiple of this and resized to the exact size
+MASK_BUCKET_SIZE = 8
+MASK_CACHE_ENTRIES = 64
+
+
+class MaskCache:
+    """
+    Bounded, thread safe LRU cache for masks that only depend on their size and settings.
+
+    Sizes are rounded up to MASK_BUCKET_SIZE, so a tracked face whose crop
+    grows or shrinks by a few pixels keeps hitting the same entry. Cached
+    masks are read only, callers that need to change one work on a copy.
+    """
+
+    def __init__(self, max_entries: int = MASK_CACHE_ENTRIES, bucket_size: int = MASK_BUCKET_SIZE) -> None:
+        self.max_entries = max(1, max_entries)
+        self.bucket_size = max(1, bucket_size)
+        self.entries: 'OrderedDict[Tuple[str, Tuple[int, int], Tuple[Any, ...]], numpy.ndarray]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str, shape: Tuple[int, ...], settings: Tuple[Any, ...], create_mask: Callable[[Tuple[int, int]], numpy.ndarray]) -> numpy.ndarray:
+        height, width = shape[:2]
+        bucket_shape = (self.get_bucket(height), self.get_bucket(width))
+        key = (name, bucket_shape, settings)
+        with self.lock:
+            mask = self.entries.get(key)
+            if mask is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if mask is None:
+            mask = create_mask(bucket_shape)
+            mask.setflags(write=False)
+            with self.lock:
+                self.entries[key] = mask
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        if mask.shape[:2] != (height, width):
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+        return mask
+
+    def get_bucket(self, size: int) -> int:
+        return max(self.bucket_size, -(-size // self.bucket_size) * self.bucket_size)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+MASK_CACHE = MaskCache()
+
+
+def get_mask(name: str, shape: Tuple[int, ...], settings: Tuple[Any, ...], create_mask: Callable[[Tuple[int, int]], numpy.ndarray]) -> numpy.ndarray:
+    return MASK_CACHE.get(name, shape, settings, create_mask)
+
+
+def get_mask_cache_stats() -> Dict[str, float]:
+    return MASK_CACHE.get_stats()
+
+
+def format_mask_cache_stats(stats: Dict[str, float]) -> str:
+    return f"mask cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries"
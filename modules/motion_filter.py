@@ -0,0 +1,74 @@
+from typing import Any
+import numpy
+
+# Noise of the position and velocity, relative to the face size
+MOTION_POSITION_NOISE = 1 / 20
+MOTION_VELOCITY_NOISE = 1 / 160
+# 99% quantile of the chi-square distribution with 2 degrees of freedom, centres further away are outside the gate
+MOTION_GATE = 9.21
+MOTION_TRANSITION = numpy.eye(8, dtype=numpy.float64) + numpy.eye(8, 8, 4, dtype=numpy.float64)
+MOTION_MEASUREMENT = numpy.eye(4, 8, dtype=numpy.float64)
+
+
+class MotionFilter:
+    """
+    Constant velocity Kalman filter over a face box.
+
+    The state is centre, width and height plus their velocity per frame.
+    predict() moves the box one frame ahead, update() corrects it with the
+    box the face was found at. Noise scales with the face size, so near and
+    far faces are followed alike. Unlike an average over past positions the
+    prediction does not lag behind a moving face.
+    """
+
+    def __init__(self, bbox: Any) -> None:
+        measurement = to_measurement(bbox)
+        self.state = numpy.concatenate([measurement, numpy.zeros(4)])
+        size = get_size(measurement)
+        self.covariance = numpy.diag(numpy.square(numpy.array([2 * MOTION_POSITION_NOISE] * 4 + [10 * MOTION_VELOCITY_NOISE] * 4) * size))
+
+    @property
+    def center(self) -> numpy.ndarray:
+        return self.state[:2].copy()
+
+    @property
+    def bbox(self) -> numpy.ndarray:
+        center, half_size = self.state[:2], numpy.abs(self.state[2:4]) / 2
+        return numpy.concatenate([center - half_size, center + half_size])
+
+    def predict(self) -> numpy.ndarray:
+        size = get_size(self.state)
+        noise = numpy.diag(numpy.square(numpy.array([MOTION_POSITION_NOISE] * 4 + [MOTION_VELOCITY_NOISE] * 4) * size))
+        self.state = MOTION_TRANSITION @ self.state
+        self.covariance = MOTION_TRANSITION @ self.covariance @ MOTION_TRANSITION.T + noise
+        return self.bbox
+
+    def update(self, bbox: Any) -> numpy.ndarray:
+        measurement = to_measurement(bbox)
+        projected_covariance = self.get_projected_covariance()
+        gain = numpy.linalg.solve(projected_covariance, MOTION_MEASUREMENT @ self.covariance).T
+        self.state = self.state + gain @ (measurement - MOTION_MEASUREMENT @ self.state)
+        self.covariance = self.covariance - gain @ projected_covariance @ gain.T
+        return self.bbox
+
+    def get_projected_covariance(self) -> numpy.ndarray:
+        size = get_size(self.state)
+        noise = numpy.diag(numpy.square(numpy.full(4, MOTION_POSITION_NOISE) * size))
+        return MOTION_MEASUREMENT @ self.covariance @ MOTION_MEASUREMENT.T + noise
+
+    def get_gating_distances(self, centers: numpy.ndarray) -> numpy.ndarray:
+        """
+        Squared Mahalanobis distances of face centres to the predicted centre, compare with MOTION_GATE.
+        """
+        covariance = self.get_projected_covariance()[:2, :2]
+        offsets = numpy.asarray(centers, dtype=numpy.float64).reshape(-1, 2) - self.state[:2]
+        return numpy.einsum('ij,ij->i', offsets @ numpy.linalg.inv(covariance), offsets)
+
+
+def to_measurement(bbox: Any) -> numpy.ndarray:
+    x1, y1, x2, y2 = numpy.asarray(bbox, dtype=numpy.float64)[:4]
+    return numpy.array([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1])
+
+
+def get_size(state: numpy.ndarray) -> float:
+    return max(float(numpy.abs(state[2:4]).max()), 1.0)
@@ -1,12 +1,22 @@
 import sys
+import time
+import queue
+import threading
 import importlib
 from concurrent.futures import ThreadPoolExecutor
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Dict, Iterable, Iterator, Optional, Tuple
+import cv2
 from tqdm import tqdm
 
 import modules
-import modules.globals                   
+import modules.globals
+from modules.capturer import get_video_frame_total
+from modules.face_analyser import FrameContext, FrameSequencer
+from modules.analysis_cache import get_target_analysis
+from modules.keyframe_tracker import create_keyframe_tracker
+from modules.typing import Face, Frame
+from modules.utilities import read_video_frames, detect_resolution, open_video_writer, write_video_frame, close_video_writer
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
@@ -16,6 +26,13 @@ FRAME_PROCESSORS_INTERFACE = [
     'process_image',
     'process_video'
 ]
+# Frame processors may also define process_batch(source, temp_frames, contexts) -> temp_frames to process
+# a chunk of consecutive frames at once, the others are called with one frame at a time
+PROGRESS_BAR_FORMAT = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+# Chunks are sized so that one scheduler task takes roughly this long
+SCHEDULER_TARGET_CHUNK_SECONDS = 0.1
+SCHEDULER_MAX_CHUNK_SIZE = 16
+SCHEDULER_END = object()
 
 
 def load_frame_processor_module(frame_processor: str) -> Any:
@@ -55,19 +72,412 @@ def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
             except:
                 pass
 
+class FrameScheduler:
+    """
+    Runs frames through dedicated decode, compute and write stages.
+
+    The decode stage fills a bounded queue, the compute stage runs adaptively
+    sized chunks of consecutive frames on a thread pool, and the write stage
+    drains a reorder buffer so results leave in frame order. At most
+    max_in_flight chunks are decoded but not yet written, which keeps memory
+    flat no matter how long the video is. With compute_batch a whole chunk
+    is computed by one call, and chunks wait for at least min_chunk_size
+    frames unless the input ends. Chunks never grow beyond max_chunk_size.
+    """
+
+    def __init__(self, compute: Callable[[int, Any], Any], write: Optional[Callable[[int, Any], None]] = None, max_workers: int = 1, max_in_flight: int = 0, progress: Any = None, compute_batch: Optional[Callable[[List[int], List[Any]], List[Any]]] = None, min_chunk_size: int = 1, max_chunk_size: int = SCHEDULER_MAX_CHUNK_SIZE) -> None:
+        self.compute = compute
+        self.compute_batch = compute_batch
+        self.write = write
+        self.max_workers = max(1, max_workers or 1)
+        self.max_in_flight = max_in_flight or self.max_workers * 2
+        self.progress = progress
+        self.max_chunk_size = max(1, min(SCHEDULER_MAX_CHUNK_SIZE, max_chunk_size))
+        self.min_chunk_size = max(1, min(self.max_chunk_size, min_chunk_size))
+        self.chunk_size = self.min_chunk_size
+        self.frame_seconds = 0.0
+        self.error: Optional[BaseException] = None
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(self.max_in_flight)
+
+    def run(self, items: Iterable[Any]) -> None:
+        decoded: queue.Queue = queue.Queue(maxsize=max(self.max_in_flight, SCHEDULER_MAX_CHUNK_SIZE))
+        computed: queue.Queue = queue.Queue()
+        decoder = threading.Thread(target=self.decode_stage, args=(items, decoded), daemon=True)
+        writer = threading.Thread(target=self.write_stage, args=(computed,), daemon=True)
+        decoder.start()
+        writer.start()
+        chunk_index = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk in self.read_chunks(decoded):
+                self.slots.acquire()
+                future = executor.submit(self.compute_stage, chunk)
+                future.add_done_callback(lambda future, index=chunk_index: computed.put((index, future.result())))
+                chunk_index += 1
+        computed.put((chunk_index, SCHEDULER_END))
+        writer.join()
+        while decoder.is_alive():
+            try:
+                decoded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if self.error is not None:
+            raise self.error
+
+    def read_chunks(self, decoded: queue.Queue) -> Iterable[List[Tuple[int, Any]]]:
+        frame_index = 0
+        finished = False
+        while not finished and self.error is None:
+            item = decoded.get()
+            if item is SCHEDULER_END:
+                break
+            chunk = [(frame_index, item)]
+            frame_index += 1
+            while len(chunk) < self.chunk_size:
+                try:
+                    # a chunk below the minimum size waits for the decoder, a larger one takes what is there
+                    item = decoded.get() if len(chunk) < self.min_chunk_size else decoded.get_nowait()
+                except queue.Empty:
+                    break
+                if item is SCHEDULER_END:
+                    finished = True
+                    break
+                chunk.append((frame_index, item))
+                frame_index += 1
+            yield chunk
+
+    def decode_stage(self, items: Iterable[Any], decoded: queue.Queue) -> None:
+        try:
+            for item in items:
+                if self.error is not None:
+                    break
+                decoded.put(item)
+        except BaseException as exception:
+            self.set_error(exception)
+        finally:
+            decoded.put(SCHEDULER_END)
+
+    def compute_stage(self, chunk: List[Tuple[int, Any]]) -> List[Tuple[int, Any]]:
+        start_time = time.perf_counter()
+        results = []
+        try:
+            if self.compute_batch:
+                frame_indices = [frame_index for frame_index, _ in chunk]
+                results = list(zip(frame_indices, self.compute_batch(frame_indices, [item for _, item in chunk])))
+            for frame_index, item in chunk[len(results):]:
+                if self.error is not None:
+                    break
+                results.append((frame_index, self.compute(frame_index, item)))
+        except BaseException as exception:
+            self.set_error(exception)
+        self.update_chunk_size(time.perf_counter() - start_time, len(chunk))
+        return results
+
+    def write_stage(self, computed: queue.Queue) -> None:
+        pending: Dict[int, List[Tuple[int, Any]]] = {}
+        next_index = 0
+        total = None
+        while total is None or next_index < total:
+            chunk_index, results = computed.get()
+            if results is SCHEDULER_END:
+                total = chunk_index
+                continue
+            pending[chunk_index] = results
+            while next_index in pending:
+                results = pending.pop(next_index)
+                if self.write and self.error is None:
+                    try:
+                        for frame_index, result in results:
+                            self.write(frame_index, result)
+                    except BaseException as exception:
+                        self.set_error(exception)
+                if self.progress:
+                    self.progress.update(len(results))
+                next_index += 1
+                self.slots.release()
+
+    def update_chunk_size(self, seconds: float, frame_total: int) -> None:
+        with self.lock:
+            frame_seconds = seconds / max(1, frame_total)
+            self.frame_seconds = frame_seconds if not self.frame_seconds else self.frame_seconds * 0.8 + frame_seconds * 0.2
+            self.chunk_size = max(self.min_chunk_size, min(self.max_chunk_size, int(SCHEDULER_TARGET_CHUNK_SECONDS / max(self.frame_seconds, 1e-6))))
+
+    def set_error(self, exception: BaseException) -> None:
+        with self.lock:
+            if self.error is None:
+                self.error = exception
+
+
+def create_progress(total: int, desc: str = 'Processing') -> tqdm:
+    progress = tqdm(total=total, desc=desc, unit='frame', dynamic_ncols=True, bar_format=PROGRESS_BAR_FORMAT)
+    progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
+    return progress
+
+
 def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
-    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
-        futures = []
-        for path in temp_frame_paths:
-            future = executor.submit(process_frames, source_path, [path], progress)
-            futures.append(future)
-        for future in futures:
-            future.result()
+    scheduler = FrameScheduler(lambda frame_index, temp_frame_path: process_frames(source_path, [temp_frame_path], progress), max_workers=modules.globals.execution_threads)
+    scheduler.run(temp_frame_paths)
 
 
 def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
-    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
-    total = len(frame_paths)
-    with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
+    with create_progress(len(frame_paths)) as progress:
         multi_process_frame(source_path, frame_paths, process_frames, progress)
+
+
+def process_video_frames(source: Any, temp_frame_paths: List[str], process_frame: Callable[[Any, Frame, FrameContext], Frame], process_batch: Optional[Callable[[Any, List[Frame], List[FrameContext]], List[Frame]]] = None) -> None:
+    sequencer = create_frame_sequencer()
+    analysis = get_target_analysis()
+    # every frame is its own file, so the compute workers read and write them in parallel;
+    # only frames that keyframe or ROI detection follows are read in order by the decode stage
+    read_on_compute = not needs_frame_analysis(analysis)
+
+    def read(frame_index: int, analysed: Tuple[Optional[Frame], Optional[List[Face]]]) -> Tuple[Optional[Frame], Optional[List[Face]]]:
+        temp_frame, faces = analysed
+        return cv2.imread(temp_frame_paths[frame_index]) if read_on_compute else temp_frame, faces
+
+    def write(frame_index: int, temp_frame: Optional[Frame]) -> None:
+        # a frame that could not be read keeps its file
+        if temp_frame is not None:
+            cv2.imwrite(temp_frame_paths[frame_index], temp_frame)
+
+    def compute(frame_index: int, analysed: Tuple[Optional[Frame], Optional[List[Face]]]) -> None:
+        temp_frame, faces = read(frame_index, analysed)
+        try:
+            if temp_frame is not None:
+                temp_frame = process_frame(source, temp_frame, FrameContext(frame_index, faces=faces, sequencer=sequencer, analysis=analysis))
+        except Exception as exception:
+            print(exception)
+        finally:
+            complete_frames([sequencer], [frame_index])
+        write(frame_index, temp_frame)
+
+    def compute_batch(frame_indices: List[int], analysed_frames: List[Tuple[Optional[Frame], Optional[List[Face]]]]) -> List[None]:
+        analysed_frames = [read(frame_index, analysed) for frame_index, analysed in zip(frame_indices, analysed_frames)]
+        temp_frames = [temp_frame for temp_frame, _ in analysed_frames]
+        readable = [index for index, temp_frame in enumerate(temp_frames) if temp_frame is not None]
+        contexts = [FrameContext(frame_indices[index], faces=analysed_frames[index][1], sequencer=sequencer, analysis=analysis) for index in readable]
+        try:
+            if readable:
+                for index, temp_frame in zip(readable, process_batch(source, [temp_frames[index] for index in readable], contexts)):
+                    temp_frames[index] = temp_frame
+        except Exception as exception:
+            print(exception)
+        finally:
+            complete_frames([sequencer], frame_indices)
+        for frame_index, temp_frame in zip(frame_indices, temp_frames):
+            write(frame_index, temp_frame)
+        return [None] * len(frame_indices)
+
+    with create_progress(len(temp_frame_paths)) as progress:
+        scheduler = FrameScheduler(compute, max_workers=modules.globals.execution_threads, progress=progress, compute_batch=compute_batch if process_batch else None, min_chunk_size=modules.globals.frame_batch_size, max_chunk_size=get_max_chunk_size())
+        if read_on_compute:
+            scheduler.run((None, None) for _ in temp_frame_paths)
+        else:
+            scheduler.run(analyse_frames((cv2.imread(temp_frame_path) for temp_frame_path in temp_frame_paths), analysis))
+
+
+def process_video_fused(source_path: str, temp_frame_paths: List[str], frame_processors: List[ModuleType]) -> None:
+    """
+    Runs every frame processor on a frame before it is written, so each frame is read and written once
+    instead of once per processor.
+    """
+    for frame_processor in frame_processors:
+        if modules.globals.face_tracking and hasattr(frame_processor, 'reset_face_tracking'):
+            frame_processor.reset_face_tracking()
+    sources = get_frame_processors_sources(source_path, frame_processors)
+    process_video_frames(
+        sources,
+        temp_frame_paths,
+        lambda frame_sources, temp_frame, context: run_frame_processors(frame_processors, frame_sources, temp_frame, context),
+        (lambda frame_sources, temp_frames, contexts: run_frame_processors_batch(frame_processors, frame_sources, temp_frames, contexts)) if has_process_batch(frame_processors) else None
+    )
+
+
+def analyse_frames(frames: Iterable[Frame], analysis: Any = None) -> Iterator[Tuple[Frame, Optional[List[Face]]]]:
+    """
+    Pairs every frame with its faces when keyframe or ROI detection is enabled,
+    see modules.keyframe_tracker and modules.roi_detector.
+
+    Both follow faces from frame to frame, which needs the frames in order,
+    so this runs on the decode stage. Faces are None when every frame is
+    detected on its own or the target's stored analysis already has them,
+    otherwise they are recorded into the analysis like detected faces.
+    """
+    tracker = create_keyframe_tracker() if needs_frame_analysis(analysis) else None
+    for frame_index, frame in enumerate(frames):
+        faces = tracker.get_faces(frame_index, frame) if tracker and frame is not None else None
+        if faces is not None and analysis is not None:
+            analysis.add_faces(frame_index, faces)
+        yield frame, faces
+    if tracker:
+        print(f'Detected faces on {tracker.detections} of {tracker.detections + tracker.propagations} frames')
+
+
+def needs_frame_analysis(analysis: Any = None) -> bool:
+    # keyframe and ROI detection follow the faces on the decode stage, unless the stored analysis has them
+    return (modules.globals.keyframe_interval > 1 or modules.globals.roi_detection) and not (analysis is not None and analysis.frame_total)
+
+
+def create_frame_sequencer() -> Optional[FrameSequencer]:
+    # frames only take turns when faces are tracked from one frame to the next
+    return FrameSequencer() if modules.globals.face_tracking else None
+
+
+def complete_frames(sequencers: List[Optional[FrameSequencer]], frame_indices: List[int]) -> None:
+    for sequencer in sequencers:
+        if sequencer is not None:
+            for frame_index in frame_indices:
+                sequencer.complete(frame_index)
+
+
+def get_max_chunk_size() -> int:
+    # a chunk of tracked frames on one worker would hold up the turns of the next chunk, one frame per task keeps the workers busy
+    return 1 if modules.globals.face_tracking else SCHEDULER_MAX_CHUNK_SIZE
+
+
+def get_frame_processors_sources(source_path: str, frame_processors: List[ModuleType]) -> List[Any]:
+    return [frame_processor.get_source_faces(source_path) if hasattr(frame_processor, 'get_source_faces') else None for frame_processor in frame_processors]
+
+
+def process_stream_frame(frame_processors: List[ModuleType], sources: List[Any], temp_frame: Frame, frame_index: int = 0, sequencer: Optional[FrameSequencer] = None, analysis: Any = None, faces: Optional[List[Face]] = None) -> Frame:
+    try:
+        return run_frame_processors(frame_processors, sources, temp_frame, FrameContext(frame_index, faces=faces, sequencer=sequencer, analysis=analysis))
+    finally:
+        complete_frames([sequencer], [frame_index])
+
+
+def process_stream_batch(frame_processors: List[ModuleType], sources: List[Any], frame_indices: List[int], analysed_frames: List[Tuple[Frame, Optional[List[Face]]]], sequencer: Optional[FrameSequencer] = None, analysis: Any = None) -> List[Frame]:
+    contexts = [FrameContext(frame_index, faces=faces, sequencer=sequencer, analysis=analysis) for frame_index, (_, faces) in zip(frame_indices, analysed_frames)]
+    try:
+        return run_frame_processors_batch(frame_processors, sources, [temp_frame for temp_frame, _ in analysed_frames], contexts)
+    finally:
+        complete_frames([sequencer], frame_indices)
+
+
+def process_fan_out_frame(frame_processors: List[ModuleType], sources: List[List[Any]], temp_frame: Frame, frame_index: int, sequencers: List[Optional[FrameSequencer]], analysis: Any = None, faces: Optional[List[Face]] = None) -> List[Frame]:
+    try:
+        # every output starts from the faces detected once on the decoded frame
+        faces = FrameContext(frame_index, faces=faces, analysis=analysis).get_faces(temp_frame)
+        temp_frames = []
+        for output_index, (output_sources, sequencer) in enumerate(zip(sources, sequencers)):
+            context = FrameContext(frame_index, faces=list(faces), sequencer=sequencer, output_index=output_index)
+            temp_frames.append(run_frame_processors(frame_processors, output_sources, temp_frame.copy(), context))
+        return temp_frames
+    finally:
+        complete_frames(sequencers, [frame_index])
+
+
+def run_frame_processors(frame_processors: List[ModuleType], sources: List[Any], temp_frame: Frame, context: FrameContext) -> Frame:
+    for frame_processor, source in zip(frame_processors, sources):
+        process_frame = getattr(frame_processor, 'process_video_frame', frame_processor.process_frame)
+        try:
+            temp_frame = process_frame(source, temp_frame, context)
+        except Exception as exception:
+            print(exception)
+    return temp_frame
+
+
+def has_process_batch(frame_processors: List[ModuleType]) -> bool:
+    return any(hasattr(frame_processor, 'process_batch') for frame_processor in frame_processors)
+
+
+def run_frame_processors_batch(frame_processors: List[ModuleType], sources: List[Any], temp_frames: List[Frame], contexts: List[FrameContext]) -> List[Frame]:
+    """
+    Runs a chunk of consecutive frames through every frame processor, one processor after the other.
+    Processors without process_batch get the frames one at a time.
+    """
+    temp_frames = list(temp_frames)
+    for frame_processor, source in zip(frame_processors, sources):
+        if hasattr(frame_processor, 'process_batch'):
+            try:
+                temp_frames = list(frame_processor.process_batch(source, temp_frames, contexts))
+            except Exception as exception:
+                print(exception)
+            continue
+        process_frame = getattr(frame_processor, 'process_video_frame', frame_processor.process_frame)
+        for frame_position, (temp_frame, context) in enumerate(zip(temp_frames, contexts)):
+            try:
+                temp_frames[frame_position] = process_frame(source, temp_frame, context)
+            except Exception as exception:
+                print(exception)
+    return temp_frames
+
+
+def process_video_stream(source_path: str, target_path: str, frame_processors: List[ModuleType], fps: float = 30.0) -> bool:
+    for frame_processor in frame_processors:
+        if modules.globals.face_tracking and hasattr(frame_processor, 'reset_face_tracking'):
+            frame_processor.reset_face_tracking()
+    sources = get_frame_processors_sources(source_path, frame_processors)
+    sequencer = create_frame_sequencer()
+    analysis = get_target_analysis()
+    writer = open_video_writer(target_path, detect_resolution(target_path), fps)
+    done = True
+    try:
+        with create_progress(get_video_frame_total(target_path), 'Streaming') as progress:
+            scheduler = FrameScheduler(
+                lambda frame_index, analysed: process_stream_frame(frame_processors, sources, analysed[0], frame_index, sequencer, analysis, analysed[1]),
+                lambda frame_index, temp_frame: write_video_frame(writer, temp_frame),
+                max_workers=modules.globals.execution_threads,
+                progress=progress,
+                compute_batch=(lambda frame_indices, analysed_frames: process_stream_batch(frame_processors, sources, frame_indices, analysed_frames, sequencer, analysis)) if has_process_batch(frame_processors) else None,
+                min_chunk_size=modules.globals.frame_batch_size,
+                max_chunk_size=get_max_chunk_size()
+            )
+            scheduler.run(analyse_frames(read_video_frames(target_path), analysis))
+    except Exception as exception:
+        # a broken pipe when the encoder died, or any error of the scheduler
+        print(f'Streaming {target_path} failed: {exception}')
+        done = False
+    finally:
+        done = close_video_writer(writer) and done
+    return done
+
+
+def process_video_fan_out(source_paths: List[str], target_path: str, frame_processors: List[ModuleType], fps: float = 30.0) -> List[bool]:
+    """
+    Renders the target video once per source image from a single decode.
+
+    Every frame is decoded and analysed once, then each source gets its own
+    copy of the frame, its own face tracking and its own encoder, writing to
+    get_temp_output_path(target_path, output_index). An encoder that dies
+    fails only its own output, the others keep streaming.
+    """
+    for frame_processor in frame_processors:
+        if modules.globals.face_tracking and hasattr(frame_processor, 'reset_face_tracking'):
+            frame_processor.reset_face_tracking()
+    sources = [get_frame_processors_sources(source_path, frame_processors) for source_path in source_paths]
+    sequencers = [create_frame_sequencer() for _ in source_paths]
+    analysis = get_target_analysis()
+    resolution = detect_resolution(target_path)
+    writers = [open_video_writer(target_path, resolution, fps, output_index) for output_index in range(len(source_paths))]
+    failed = [False] * len(writers)
+
+    def write(frame_index: int, temp_frames: List[Frame]) -> None:
+        for output_index, (writer, temp_frame) in enumerate(zip(writers, temp_frames)):
+            if failed[output_index]:
+                continue
+            try:
+                write_video_frame(writer, temp_frame)
+            except Exception as exception:
+                print(f'Streaming output {output_index} of {target_path} failed: {exception}')
+                failed[output_index] = True
+        if all(failed):
+            raise RuntimeError(f'Every output of {target_path} failed')
+
+    try:
+        with create_progress(get_video_frame_total(target_path), 'Streaming') as progress:
+            scheduler = FrameScheduler(
+                lambda frame_index, analysed: process_fan_out_frame(frame_processors, sources, analysed[0], frame_index, sequencers, analysis, analysed[1]),
+                write,
+                max_workers=modules.globals.execution_threads,
+                progress=progress,
+                max_chunk_size=get_max_chunk_size()
+            )
+            scheduler.run(analyse_frames(read_video_frames(target_path), analysis))
+    except Exception as exception:
+        # the outputs still streaming when the scheduler failed are incomplete
+        print(f'Streaming {target_path} failed: {exception}')
+        failed = [True] * len(writers)
+    finally:
+        done = [close_video_writer(writer) and not output_failed for writer, output_failed in zip(writers, failed)]
+    return done
@@ -1,4 +1,4 @@
-from typing import Any, List
+from typing import Any, List, Optional
 import cv2
 import threading
 import gfpgan
@@ -10,7 +10,7 @@ from modules.core import update_status
 from modules.face_analyser import get_one_face
 from modules.typing import Frame, Face
 from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
-from modules.face_analyser import get_one_face, get_many_faces, get_one_face_left, get_one_face_right, get_face_analyser
+from modules.face_analyser import get_one_face, get_many_faces, get_one_face_left, get_one_face_right, get_face_analyser, FrameContext
 from modules.processors.frame.face_swapper import crop_face_region,create_adjusted_face,create_edge_blur_mask,blend_with_mask,reset_face_tracking
 
 FACE_ENHANCER = None
@@ -55,14 +55,12 @@ def enhance_face(temp_frame: Frame) -> Frame:
     return temp_frame
 
 
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
+def process_frame(source_face: Face, temp_frame: Frame, context: Optional[FrameContext] = None) -> Frame:
 
-    face_analyser = get_face_analyser()
-    try:
-        all_faces = face_analyser.get(temp_frame)
-    except Exception as e:
-        # If face detection fails, return the original frame without processing
-        return temp_frame
+    # Reuse the faces detected earlier in the processor chain, detecting them only if nobody has yet
+    if context is None:
+        context = FrameContext()
+    all_faces = context.get_faces(temp_frame)
     
         # Determine which faces to process based on user settings
     if modules.globals.many_faces:
@@ -130,4 +128,4 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 
 
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
-    modules.processors.frame.core.process_video(None, temp_frame_paths, process_frames)
+    modules.processors.frame.core.process_video_frames(None, temp_frame_paths, process_frame)
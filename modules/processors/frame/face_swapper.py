@@ -1,6 +1,7 @@
-from typing import Any, List, Optional, Tuple
+from typing import Any, List, NamedTuple, Optional, Tuple
 import cv2  # This is a library for working with images and videos
 import insightface  # This is a library for detecting and analyzing faces
+from insightface.utils import face_align # This aligns faces the way the face swapper model expects
 import threading  # This helps run parts of the program at the same time
 import math # This is for some math functions
 
@@ -8,14 +9,18 @@ import modules.globals # This lets us use settings that apply to the whole progr
 import modules.processors.frame.core # This is for processing video frames
 
 # These are functions from other parts of the program that help us find faces
-from modules.face_analyser import get_one_face, get_many_faces, get_one_face_left, get_one_face_right, get_face_analyser
+from modules.face_analyser import get_one_face, get_many_faces, get_one_face_left, get_one_face_right, get_face_analyser, get_source_faces as get_cached_source_faces, detect_faces, detect_frames_faces, FrameContext
 # These are special types for faces and frames (images or videos)
 from modules.typing import Face, Frame
 # These help us download models, find files, and check if something is an image or video
 from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
-from collections import deque # A special list where items are added to one end and removed from the other
+# This lets the threads share model runs
+from modules.inference_batcher import get_batcher, is_batching_enabled
+from modules.mask_cache import get_mask
+from modules.session_pool import pool_model_session
+# This keeps track of which face is which from frame to frame
+from modules.face_tracker import FaceTracker, STICKINESS_FACTOR, MAX_LOST_COUNT, get_face_center, extract_face_embedding, find_best_match, cosine_similarity, create_pseudo_face, generate_anatomical_landmarks
 import numpy as np # This is a library for math, especially with arrays
-import time # This is for keeping track of time
 
 # This is the thing that actually swaps the faces
 FACE_SWAPPER = None
@@ -32,43 +37,35 @@ POSITION_WEIGHT = 0.4
 EMBEDDING_WEIGHT = 0.6
 # How much to blur the edges of the face mask
 BLUR_AMOUNT = 12
-# How many frames a face can be lost for before we stop tracking it (assuming 30 frames per second, this is 60 seconds)
-MAX_LOST_COUNT = 1800  # Assuming 30 fps, this is 60 seconds
-# How "sticky" the tracking is, meaning how likely it is to stick with the same face
-STICKINESS_FACTOR = 0.8  # Adjust this to change how "sticky" the tracking is
-
-# How many frames in a row the first face has been lost
-first_face_lost_count: int = 0
-# How many frames in a row the second face has been lost
-second_face_lost_count: int = 0
-# A list that remembers the last 30 positions of a face
-face_position_history = deque(maxlen=30)  # Stores last 30 positions
-# When the last face swap happened
-last_swap_time = 0
-
-# The "ID" of the first face we are tracking
-first_face_id: Optional[int] = None
-# The "ID" of the second face we are tracking
-second_face_id: Optional[int] = None
-# A list of how the source faces look (their "embeddings")
-source_face_embeddings: List[np.ndarray] = []
-# How the first tracked face looks
-first_face_embedding: Optional[np.ndarray] = None
-# How the second tracked face looks
-second_face_embedding: Optional[np.ndarray] = None
-# Where the first tracked face is
-first_face_position: Optional[Tuple[float, float]] = None
-# Where the second tracked face is
-second_face_position: Optional[Tuple[float, float]] = None
-# How much the face position can change before we think it's a different face
-position_threshold = 0.2  # Adjust this value to change sensitivity to position changes
-# When we last assigned faces to the tracked faces
-last_assignment_time: float = 0
-# How long to wait before assigning faces again
-assignment_cooldown: float = 1.0  # 1 second cooldown
-
-# How many frames in a row a face has been lost (used in single-face tracking)
-face_lost_count = 0
+# The tracking state for the current job, one per output when a job renders several source faces at once
+FACE_TRACKER = FaceTracker()
+FACE_TRACKERS = {0: FACE_TRACKER}
+FACE_TRACKERS_LOCK = threading.Lock()
+# How much room to leave around a face mask so its blurred edges fit inside it
+FACE_MASK_MARGIN = 25
+
+
+class RegionMask(NamedTuple):
+    """
+    A mask that only covers the part of the frame it is needed for.
+    mask[0, 0] sits at (x, y) in the frame, everything outside the mask counts as 0.
+    """
+    mask: np.ndarray
+    x: int = 0
+    y: int = 0
+
+    def crop(self, x1: int, y1: int, x2: int, y2: int) -> np.ndarray:
+        """
+        Gets the mask values for the frame region from (x1, y1) to (x2, y2), like slicing a full frame mask.
+        """
+        region = np.zeros((max(0, y2 - y1), max(0, x2 - x1)), dtype=self.mask.dtype) # Start with an empty region
+        h, w = self.mask.shape[:2]
+        left, top = max(x1, self.x), max(y1, self.y) # Find where the mask and the region overlap
+        right, bottom = min(x2, self.x + w), min(y2, self.y + h)
+        if right > left and bottom > top:
+            region[top - y1:bottom - y1, left - x1:right - x1] = self.mask[top - self.y:bottom - self.y, left - self.x:right - self.x]
+        return region
+
 
 
 def pre_check() -> bool:
@@ -90,7 +87,7 @@ def pre_start() -> bool:
         update_status('Select an image for source path.', NAME) # Tells the user to select an image
         return False
     # Checks if there is a face in the source image
-    elif not get_one_face(cv2.imread(modules.globals.source_path)):
+    elif not get_source_faces(modules.globals.source_path):
         update_status('No face in source path detected.', NAME) # Tells the user that there is no face in the source
         return False
     # Checks if the target is an image or a video
@@ -108,34 +105,94 @@ def get_face_swapper() -> Any:
     with THREAD_LOCK: # This makes sure only one part of the program changes FACE_SWAPPER at a time
         if FACE_SWAPPER is None: # Checks if the face swapper hasn't been loaded yet
             model_path = resolve_relative_path('../models/inswapper_128_fp16.onnx') # Gets the path to the face swapper model
-            # Loads the face swapper model
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=modules.globals.execution_providers)
+            # Loads the face swapper model, every execution thread runs it in a session of its own
+            FACE_SWAPPER = pool_model_session(insightface.model_zoo.get_model(model_path, providers=modules.globals.execution_providers), batched=True)
     return FACE_SWAPPER
 
 def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
     """
     Swaps the source face onto the target face in the given frame.
     """
-    face_swapper = get_face_swapper() # Gets the face swapper model
-
-    # Apply the face swap
-    swapped_frame = face_swapper.get(temp_frame, target_face, source_face, paste_back=True)
-
-    # Create a mask for the target face
-    target_mask = create_face_mask(target_face, temp_frame)
+    # Same crop, paste and blend as the video frames get, on a copy of the frame
+    return _process_face_swap(temp_frame.copy(), [source_face], target_face, 0)
 
-    # Blur the edges of the mask
-    blurred_mask = blur_edges(target_mask)
-    blurred_mask = blurred_mask / 255.0 # Makes the mask values between 0 and 1
-
-    # Ensure the mask has 3 channels to match the frame
-    blurred_mask_3channel = np.repeat(blurred_mask[:, :, np.newaxis], 3, axis=2)
-
-    # Blend the swapped face with the original frame using the blurred mask
-    blended_frame = (swapped_frame * blurred_mask_3channel +
-                     temp_frame * (1 - blurred_mask_3channel))
+def get_swapped_faces(pairs: List[Tuple[Face, Face, Frame]]) -> List[Tuple[Frame, np.ndarray]]:
+    """
+    Runs the face swapper model on a batch of faces, like INSwapper.get with paste_back=False.
+    When batching is on, the faces join the ones other threads are swapping in a shared model run.
+    Returns the swapped face and its alignment matrix for each pair.
+    """
+    if is_batching_enabled():
+        return get_batcher(NAME, run_face_swapper).run(pairs)
+    return run_face_swapper(pairs)
 
-    return blended_frame.astype(np.uint8) # Converts the blended frame back to a regular image
+def run_face_swapper(pairs: List[Tuple[Face, Face, Frame]]) -> List[Tuple[Frame, np.ndarray]]:
+    """
+    Runs the face swapper model once for all the given faces.
+    """
+    face_swapper = get_face_swapper() # Gets the face swapper model
+    image_size = face_swapper.input_size[0]
+
+    # Align every target face into one [N, 3, 128, 128] tensor
+    aligned_faces = [face_align.norm_crop2(temp_frame, target_face.kps, image_size) for _, target_face, temp_frame in pairs]
+    blob = cv2.dnn.blobFromImages([aligned_face for aligned_face, _ in aligned_faces], 1.0 / face_swapper.input_std, face_swapper.input_size,
+                                  (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean), swapRB=True)
+
+    # Turn every source face into the latent the model expects, all at once
+    latent = np.stack([source_face.normed_embedding for source_face, _, _ in pairs]).astype(np.float32) @ face_swapper.emap
+    latent /= np.linalg.norm(latent, axis=1, keepdims=True)
+
+    # Models exported with a fixed batch size have to be run one batch at a time
+    batch_size = face_swapper.input_shape[0]
+    if not isinstance(batch_size, int) or batch_size < 1:
+        batch_size = len(pairs)
+    predictions = []
+    for start in range(0, len(pairs), batch_size):
+        predictions.append(face_swapper.session.run(face_swapper.output_names, {
+            face_swapper.input_names[0]: blob[start:start + batch_size],
+            face_swapper.input_names[1]: latent[start:start + batch_size]
+        })[0])
+    prediction = np.concatenate(predictions)
+    bgr_fakes = np.clip(255 * prediction.transpose((0, 2, 3, 1)), 0, 255).astype(np.uint8)[:, :, :, ::-1]
+    return [(bgr_fakes[index], M) for index, (_, M) in enumerate(aligned_faces)]
+
+def create_paste_mask(IM: np.ndarray, face_size: Tuple[int, int], frame_size: Tuple[int, int]) -> np.ndarray:
+    """
+    Creates the mask INSwapper uses to paste a swapped face back, with values between 0 and 1.
+    """
+    img_white = np.full(face_size, 255, dtype=np.float32)
+    img_mask = cv2.warpAffine(img_white, IM, frame_size, borderValue=0.0) # Mark where the swapped face landed
+    img_mask[img_mask > 20] = 255
+    _, _, mask_w, mask_h = cv2.boundingRect((img_mask == 255).astype(np.uint8)) # Find how big the pasted face is
+    mask_size = int(np.sqrt(max(0, mask_h - 1) * max(0, mask_w - 1)))
+    # Shrink and soften the edges of the mask
+    k = max(mask_size // 10, 10)
+    img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+    k = max(mask_size // 20, 5)
+    img_mask = cv2.GaussianBlur(img_mask, (2 * k + 1, 2 * k + 1), 0)
+    img_mask /= 255
+    return img_mask
+
+def paste_face_region(region: Frame, bgr_fake: Frame, M: np.ndarray, target_face: Face) -> Frame:
+    """
+    Pastes a swapped face into the region around the face in one go.
+    The paste mask, the face mask and the feathered edges of the region are multiplied into one mask,
+    so the region is only blended once.
+    """
+    h, w = region.shape[:2]
+    IM = cv2.invertAffineTransform(M) # Get the matrix that undoes the alignment
+    # Where the swapped face goes
+    mask = create_paste_mask(IM, bgr_fake.shape[:2], (w, h))
+    # Only inside the target face
+    face_mask = create_face_mask(target_face, region)
+    if face_mask.mask.size == 0:
+        return region
+    mask *= RegionMask(blur_edges(face_mask.mask), face_mask.x, face_mask.y).crop(0, 0, w, h) / np.float32(255.0)
+    # Fading out towards the edges of the region
+    mask *= create_edge_blur_mask(region.shape, blur_amount=BLUR_AMOUNT)
+    mask = mask[:, :, np.newaxis]
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, (w, h), borderValue=0.0) # Move the swapped face back into place
+    return (bgr_fake * mask + region * (1 - mask)).astype(np.uint8) # Blend the swapped face onto the region
 
 def _rotate_frame(frame: Frame, rotation_value: int) -> Frame:
     """Rotates the frame based on the rotation value and its inverse."""
@@ -151,14 +208,16 @@ def _rotate_frame(frame: Frame, rotation_value: int) -> Frame:
 
 def _detect_faces(frame: Frame) -> List[Face]:
     """Detects faces in the given frame, returns an empty list if detection fails."""
-    face_analyser = get_face_analyser() # Gets the face analyzer model
-    try:
-        return face_analyser.get(frame) # Tries to detect faces and returns them as a list
-    except Exception as e:
-        print(f"Error detecting faces: {e}") # If there's a problem, prints an error message
-        return [] # If there's an error, returns an empty list
+    return detect_faces(frame) # Detects faces and returns them as a list, or an empty list on error
 
-def _select_target_faces(all_faces: List[Face]) -> List[Face]:
+def get_face_tracker(output_index: int = 0) -> FaceTracker:
+    """Gets the tracking state for one output of the current job."""
+    with FACE_TRACKERS_LOCK:
+        if output_index not in FACE_TRACKERS:
+            FACE_TRACKERS[output_index] = FaceTracker(output_index)
+        return FACE_TRACKERS[output_index]
+
+def _select_target_faces(all_faces: List[Face], tracker: FaceTracker = FACE_TRACKER) -> List[Face]:
     """Selects which faces to process based on global settings."""
     if not all_faces: # If no faces were detected, returns an empty list
         return []
@@ -172,13 +231,13 @@ def _select_target_faces(all_faces: List[Face]) -> List[Face]:
             return sorted(all_faces, key=lambda face: face.bbox[0])[:2] # Returns the two leftmost faces
     else:  # Single face
         if modules.globals.face_tracking: # If we're tracking a single face
-            if first_face_embedding is None: # If we haven't started tracking yet
+            if tracker.first_face_embedding is None: # If we haven't started tracking yet
                 if modules.globals.detect_face_right: # If we want to track the rightmost face
                     return [max(all_faces, key=lambda face: face.bbox[0])] if all_faces else []
                 else:
                     return [min(all_faces, key=lambda face: face.bbox[0])] if all_faces else []
             else: # If we have started tracking
-                best_match = find_best_match(first_face_embedding, all_faces) # Finds the face that looks most like the one we're tracking
+                best_match = find_best_match(tracker.first_face_embedding, all_faces) # Finds the face that looks most like the one we're tracking
                 return [best_match] if best_match else []
         else: # If we're not tracking, just use the leftmost or rightmost face
             if modules.globals.detect_face_right:
@@ -197,7 +256,7 @@ def _compute_mouth_masks(target_faces: List[Face], frame: Frame) -> List[Tuple[n
     """Computes mouth masks for the target faces if needed."""
     mouth_masks = []
     face_masks = []
-    if modules.globals.mouth_mask: # If we're using mouth masks
+    if modules.globals.mouth_mask and modules.globals.mouth_mask_allowed: # If we're using mouth masks
         for face in target_faces: # For each face we're swapping
             face_mask = create_face_mask(face, frame) # Create the mask for the face
             face_masks.append(face_mask) # Add it to the list
@@ -214,24 +273,30 @@ def _get_source_index(i: int, source_face: List[Face], source_face_order: List[i
 
 def _process_face_swap(frame: Frame, source_face: List[Face], target_face: Face, source_index: int) -> Frame:
     """Performs face swapping and masking on a single face."""
-    # Crop the face region
-    cropped_frame, crop_info = crop_face_region(frame, target_face) # Crops out the face region
-    # Adjust the face bbox for the cropped frame
-    adjusted_target_face = create_adjusted_face(target_face, crop_info) # Adjust the face information to the new cropped frame
-    # Perform face swapping on the cropped region
-    swapped_region = swap_face(source_face[source_index], adjusted_target_face, cropped_frame) # Swaps the faces
-    # Create a mask for blending with blurred edges
-    mask = create_edge_blur_mask(swapped_region.shape, blur_amount=BLUR_AMOUNT) # Creates a mask with feathered edges
-    # Blend the swapped region with the original cropped region
-    blended_region = blend_with_mask(swapped_region, cropped_frame, mask) # Blends the swapped face onto the original face
-    # Paste the swapped region back into the original frame
-    x, y, w, h = crop_info # Gets the original position of the face
-    frame[y:y + h, x:x + w] = blended_region # Puts the blended region back into the original frame
+    return _process_face_swaps(frame, source_face, [(target_face, source_index)])
+
+def _process_face_swaps(frame: Frame, source_face: List[Face], assignments: List[Tuple[Face, int]]) -> Frame:
+    """Performs face swapping and masking on all the assigned faces, running the model once for all of them."""
+    if not assignments:
+        return frame
+    # Crop the face regions
+    crops = [crop_face_region(frame, target_face) for target_face, _ in assignments] # Crops out the face regions
+    # Adjust the face bboxes for the cropped frames
+    adjusted_target_faces = [create_adjusted_face(target_face, crop_info) for (target_face, _), (_, crop_info) in zip(assignments, crops)]
+    # Swap all the faces in one go
+    swapped_faces = get_swapped_faces([(source_face[source_index], adjusted_target_face, cropped_frame)
+                                       for (_, source_index), adjusted_target_face, (cropped_frame, _) in zip(assignments, adjusted_target_faces, crops)])
+    for adjusted_target_face, (_, crop_info), (bgr_fake, M) in zip(adjusted_target_faces, crops, swapped_faces):
+        x, y, w, h = crop_info # Gets the original position of the face
+        # Paste onto the region as it is now, so overlapping faces keep the faces swapped before them
+        cropped_frame = frame[y:y + h, x:x + w]
+        # Paste the swapped face back into the original frame, blending it once with all the masks combined
+        frame[y:y + h, x:x + w] = paste_face_region(cropped_frame, bgr_fake, M, adjusted_target_face)
     return frame
 
 def _apply_mouth_masks(frame: Frame, target_faces: List[Face], mouth_masks: List[Tuple[np.ndarray, np.ndarray, tuple, np.ndarray]], face_masks: List[np.ndarray]) -> Frame:
     """Applies mouth masks to the frame if enabled."""
-    if modules.globals.mouth_mask: # If we're using mouth masks
+    if modules.globals.mouth_mask and modules.globals.mouth_mask_allowed: # If we're using mouth masks
         for i, (mouth_mask, mouth_cutout, mouth_box, lower_lip_polygon) in enumerate(mouth_masks): # Loop through the mouth masks
             face_mask = face_masks[i] # Get the mask for the current face
             landmarks = target_faces[i].landmark_2d_106 # Get the face landmarks
@@ -243,402 +308,79 @@ def _apply_mouth_masks(frame: Frame, target_faces: List[Face], mouth_masks: List
                 frame = draw_mouth_mask_visualization(frame, target_faces[i], (mouth_mask, mouth_cutout, mouth_box, lower_lip_polygon)) # Draw the visualization
     return frame
 
-def _process_face_tracking_single(
-    frame: Frame, source_face: List[Face], target_face: Face, active_source_index: int
-) -> Frame:
-    """Handles single-face tracking logic using distance and embedding matching."""
-    global first_face_embedding, first_face_position, first_face_id, face_lost_count
-    global face_position_history, last_swap_time
-    
-    current_time = time.time()
-    target_embedding = extract_face_embedding(target_face)
-    target_position = get_face_center(target_face)
-    face_id = id(target_face)
-
-    if first_face_embedding is None:
-        # Initialization
-        first_face_embedding = target_embedding
-        first_face_position = target_position
-        first_face_id = face_id
-        face_lost_count = 0
-        face_position_history.clear()
-        face_position_history.append(target_position)
-        last_swap_time = current_time
-        return _process_face_swap(frame, source_face, target_face, active_source_index)
-    
-    else:
-        best_match_score = 0
-        best_match_face = None
-        avg_position = np.mean(face_position_history, axis=0) if face_position_history else first_face_position
-
-        detected_faces = _detect_faces(frame)
-        
-        if not detected_faces: # If no faces detected, increment lost count
-            face_lost_count +=1
-            if face_position_history and modules.globals.use_pseudo_face and best_match_score < modules.globals.pseudo_face_threshold:
-                avg_position = np.mean(face_position_history, axis=0)
-                pseudo_face = create_pseudo_face(avg_position)
-                return _process_face_swap(frame, source_face, pseudo_face, active_source_index)
-            else:
-                 return frame
-             
-        for face in detected_faces:
-            
-            target_embedding = extract_face_embedding(face)
-            target_position = get_face_center(face)
-
-            # Calculate embedding similarity
-            embedding_similarity = cosine_similarity(first_face_embedding, target_embedding)
-            # Calculate position consistency score 
-            position_consistency = 1 / (1 + np.linalg.norm(np.array(target_position) - np.array(avg_position)) + 1e-6)
-
-            # Calculate total match score
-            EMBEDDING_WEIGHT = modules.globals.embedding_weight_size
-            POSITION_WEIGHT = modules.globals.position_size
-            total = modules.globals.old_embedding_weight + modules.globals.new_embedding_weight
-            OLD_WEIGHT = modules.globals.old_embedding_weight / total
-            NEW_WEIGHT = modules.globals.new_embedding_weight / total
-            TOTAL_WEIGHT = EMBEDDING_WEIGHT * modules.globals.weight_distribution_size + POSITION_WEIGHT
-            match_score = ((EMBEDDING_WEIGHT * embedding_similarity +
-                            POSITION_WEIGHT * position_consistency) / TOTAL_WEIGHT)
-            
-            if id(face) == first_face_id:
-                match_score *= (1 + STICKINESS_FACTOR)
-
-            if match_score > best_match_score:
-                best_match_score = match_score
-                best_match_face = face
-
-        modules.globals.target_face1_score = best_match_score
-
-        if best_match_face is not None and best_match_score > modules.globals.sticky_face_value:
-            face_lost_count = 0
-            
-            # Update the embedding using weighted average
-            first_face_embedding = OLD_WEIGHT * first_face_embedding + NEW_WEIGHT * extract_face_embedding(best_match_face)
-            first_face_position = get_face_center(best_match_face)
-            first_face_id = id(best_match_face)
-            face_position_history.append(first_face_position)
-            
-            return _process_face_swap(frame, source_face, best_match_face, active_source_index)
+def _assign_source_faces(source_face: List[Face], target_faces: List[Face], all_faces: List[Face], active_source_index: int, source_face_order: List[int], tracker: FaceTracker = FACE_TRACKER) -> List[Tuple[Face, int]]:
+    """Decides which source face goes onto which target face, updating the face tracks."""
+    if modules.globals.many_faces: # If we should swap many faces
+        if modules.globals.face_index_range != -1:
+            source_indices = [modules.globals.face_index_range] * len(target_faces)
         else:
-            face_lost_count += 1
-            if face_position_history and modules.globals.use_pseudo_face and best_match_score < modules.globals.pseudo_face_threshold:
-                avg_position = np.mean(face_position_history, axis=0)
-                pseudo_face = create_pseudo_face(avg_position)
-                return _process_face_swap(frame, source_face, pseudo_face, active_source_index)
-
-    return frame
-
-def _process_face_tracking_both(
-    frame: Frame, source_face: List[Face], target_face: Face, source_index: int, source_face_order: List[int]
-) -> Frame:
-    """Handles two-face tracking logic with flickering reduction, focusing on smoothing."""
-    global first_face_embedding, second_face_embedding, first_face_position, second_face_position
-    global first_face_id, second_face_id
-    if 'first_face_position_history' not in globals():
-        globals()['first_face_position_history'] = deque(maxlen=30)
-    if 'second_face_position_history' not in globals():
-        globals()['second_face_position_history'] = deque(maxlen=30)
-    first_face_position_history = globals()['first_face_position_history']
-    second_face_position_history = globals()['second_face_position_history']
-
-    target_embedding = extract_face_embedding(target_face)
-    target_position = get_face_center(target_face)
-    face_id = id(target_face)
-    use_pseudo_face = False
-
-    # Store tracked face data as a dictionary
-    tracked_faces = {
-        0: {
-            "embedding": first_face_embedding,
-            "position": first_face_position,
-            "id": first_face_id,
-            "history": first_face_position_history
-        },
-        1: {
-            "embedding": second_face_embedding,
-            "position": second_face_position,
-            "id": second_face_id,
-            "history": second_face_position_history
-        },
-    }
-    
-    if all(data["embedding"] is not None for data in tracked_faces.values()):
-       
-        best_match_score = -1
-        best_match_index = -1
-        
-        for i, (track_id, track_data) in enumerate(tracked_faces.items()):
-            
-            track_embedding = track_data["embedding"]
-            track_position = track_data["position"]
-            track_history = track_data["history"]
-            
-            if track_embedding is not None and track_position is not None:
-            
-                similarity = cosine_similarity(track_embedding, target_embedding)
-                position_consistency = 1 / (1 + np.linalg.norm(np.array(target_position) - np.array(np.mean(track_history, axis=0) if track_history else track_position))) if track_position is not None else 0
-                
-                EMBEDDING_WEIGHT = modules.globals.embedding_weight_size
-                POSITION_WEIGHT = modules.globals.position_size
-                total = modules.globals.old_embedding_weight + modules.globals.new_embedding_weight
-                OLD_WEIGHT = modules.globals.old_embedding_weight / total
-                NEW_WEIGHT = modules.globals.new_embedding_weight / total
-                TOTAL_WEIGHT = EMBEDDING_WEIGHT * modules.globals.weight_distribution_size + POSITION_WEIGHT
-                
-                score = ((EMBEDDING_WEIGHT * similarity +
-                            POSITION_WEIGHT * position_consistency) / TOTAL_WEIGHT)
-                if track_data["id"] == face_id:
-                    score *= (1 + STICKINESS_FACTOR)
-                    
-                if score > best_match_score:
-                    best_match_score = score
-                    best_match_index = track_id
-        
-        
-        if best_match_index != -1 and best_match_score > modules.globals.sticky_face_value:
-            
-            tracked_face = tracked_faces[best_match_index]
-            
-            # Update the tracked face with a weighted average of the new embedding
-            tracked_face["embedding"] =  OLD_WEIGHT * tracked_face["embedding"] + NEW_WEIGHT * target_embedding
-            
-            #Update position with weighted average
-            avg_position = np.mean(tracked_face["history"], axis=0) if tracked_face["history"] else tracked_face["position"]
-            if avg_position is not None:
-                tracked_face["position"] = np.array(avg_position) * 0.8 + np.array(target_position) * 0.2
-            else:
-                tracked_face["position"] = np.array(target_position)
-            tracked_face["id"] = face_id
-            tracked_face["history"].append(target_position)
-            
-            if best_match_index == 0:
-                modules.globals.target_face1_score = best_match_score
-            elif best_match_index == 1:
-               modules.globals.target_face2_score = best_match_score
-               
-            source_index = source_face_order[best_match_index]
-            
-
-        elif modules.globals.use_pseudo_face and best_match_score < modules.globals.pseudo_face_threshold:
-            use_pseudo_face = True
-            if best_match_index == 0:
-                avg_position = np.mean(first_face_position_history, axis=0) if first_face_position_history else first_face_position
-            elif best_match_index == 1:
-                avg_position = np.mean(second_face_position_history, axis=0) if second_face_position_history else second_face_position
-            else:
-                avg_position = target_position
-            pseudo_face = create_pseudo_face(avg_position)
-            return _process_face_swap(frame, source_face, pseudo_face, source_index)    
+            source_indices = [i % len(source_face) for i in range(len(target_faces))] # Get the index of the source face to use
+        if modules.globals.face_tracking: # If we are tracking faces, match all of them to the tracks at once
+            tracked = tracker.track_many(target_faces, len(source_face))
         else:
-            return frame
-        
+            tracked = list(zip(target_faces, source_indices))
     else:
-        
-        # Initialization of one or both faces
-        source_index = source_face_order[source_index % 2]
-        if source_index % 2 == 0:
-            first_face_embedding = target_embedding
-            first_face_position = target_position
-            first_face_id = face_id
-            first_face_position_history.append(target_position)
-            
-        else:
-            second_face_embedding = target_embedding
-            second_face_position = target_position
-            second_face_id = face_id
-            second_face_position_history.append(target_position)
-    
-    if use_pseudo_face:
-        if source_index == source_face_order[0]:
-            avg_position = np.mean(first_face_position_history, axis=0) if first_face_position_history else first_face_position
-        else:
-            avg_position = np.mean(second_face_position_history, axis=0) if second_face_position_history else second_face_position
-        pseudo_face = create_pseudo_face(avg_position)
-        return _process_face_swap(frame, source_face, pseudo_face, source_index)
-    else:
-         return _process_face_swap(frame, source_face, target_face, source_index)
-
-def _process_face_tracking_many(
-    frame: Frame, source_face: List[Face], target_face: Face, source_index: int, source_face_order: List[int]
-) -> Frame:
-    """Handles multi-face tracking logic for up to 10 faces with dynamic score updates."""
-    global first_face_embedding, second_face_embedding, first_face_position, second_face_position
-    global first_face_id, second_face_id
-    
-    if 'tracked_faces_many' not in globals():
-        globals()['tracked_faces_many'] = {}
-    tracked_faces_many = globals()['tracked_faces_many']
-    
-    if 'position_histories_many' not in globals():
-         globals()['position_histories_many'] = {}
-    position_histories_many = globals()['position_histories_many']
-    
-    target_embedding = extract_face_embedding(target_face)
-    target_position = get_face_center(target_face)
-    face_id = id(target_face)
-    use_pseudo_face = False
-
-    
-    
-    best_match_score = -1
-    best_match_key = None
-        
-    for key, track_data in tracked_faces_many.items():
-           
-            track_embedding = track_data.get("embedding")
-            track_position = track_data.get("position")
-            track_history = position_histories_many.get(key, deque(maxlen=30))
-           
-            if track_embedding is not None and track_position is not None:
-               
-                similarity = cosine_similarity(track_embedding, target_embedding)
-                position_consistency = 1 / (1 + np.linalg.norm(np.array(target_position) - np.array(np.mean(track_history, axis=0) if track_history else track_position))) if track_position is not None else 0
-                
-                EMBEDDING_WEIGHT = modules.globals.embedding_weight_size
-                POSITION_WEIGHT = modules.globals.position_size
-                total = modules.globals.old_embedding_weight + modules.globals.new_embedding_weight
-                OLD_WEIGHT = modules.globals.old_embedding_weight / total
-                NEW_WEIGHT = modules.globals.new_embedding_weight / total
-                TOTAL_WEIGHT = EMBEDDING_WEIGHT * modules.globals.weight_distribution_size + POSITION_WEIGHT
-                
-                score = ((EMBEDDING_WEIGHT * similarity +
-                            POSITION_WEIGHT * position_consistency) / TOTAL_WEIGHT)
-                if track_data.get("id") == face_id:
-                    score *= (1 + STICKINESS_FACTOR)
-               
-                if score > best_match_score:
-                    best_match_score = score
-                    best_match_key = key
-
-
-    if best_match_key is not None and best_match_score > modules.globals.sticky_face_value:
-           
-        tracked_face = tracked_faces_many[best_match_key]
-        track_history = position_histories_many[best_match_key]
-
-        # Update the tracked face with a weighted average of the new embedding
-        tracked_face["embedding"] =  OLD_WEIGHT * tracked_face["embedding"] + NEW_WEIGHT * target_embedding
-
-        #Update position with weighted average
-        avg_position = np.mean(track_history, axis=0) if track_history else tracked_face["position"]
-        if avg_position is not None:
-            tracked_face["position"] = np.array(avg_position) * 0.8 + np.array(target_position) * 0.2
+        faces_to_process = 2 if modules.globals.both_faces and len(source_face) > 1 else 1 # If we're swapping two faces, process two faces, otherwise process one
+        target_faces = target_faces[:faces_to_process]
+        if modules.globals.face_index_range != -1:
+            source_indices = [modules.globals.face_index_range] * len(target_faces)
         else:
-            tracked_face["position"] = np.array(target_position)
-        tracked_face["id"] = face_id
-        track_history.append(target_position)
-        
-        if best_match_key < 10:
-            setattr(modules.globals, f"target_face{best_match_key + 1}_score", best_match_score)
-        
-        source_index = best_match_key % len(source_face) # Correctly get index for multi faces
-        
-        return _process_face_swap(frame, source_face, target_face, source_index)
-
-    elif modules.globals.use_pseudo_face and best_match_score < modules.globals.pseudo_face_threshold:
-           
-        use_pseudo_face = True
-        avg_position = np.mean(position_histories_many[best_match_key], axis=0) if position_histories_many.get(best_match_key) else tracked_faces_many[best_match_key].get("position") if tracked_faces_many.get(best_match_key) else target_position
-        pseudo_face = create_pseudo_face(avg_position)
-        source_index = 0 if not source_face else 0 % len(source_face)
-        return _process_face_swap(frame, source_face, pseudo_face, source_index)
-    else: # If no good match
-        
-        if len(tracked_faces_many) < 10: # If we have less than 10 tracked faces, lets add the new face if it does not exist
-           new_key = len(tracked_faces_many)
-           tracked_faces_many[new_key] = {
-             "embedding": target_embedding,
-             "position": target_position,
-             "id": face_id
-            }
-           position_histories_many[new_key] = deque(maxlen=30)
-           position_histories_many[new_key].append(target_position)
-           source_index = new_key % len(source_face)
-           
-           if new_key < 10:
-            setattr(modules.globals, f"target_face{new_key + 1}_score", 0.00)
-           return _process_face_swap(frame, source_face, target_face, source_index)
+            source_indices = [_get_source_index(i, source_face, source_face_order) for i in range(len(target_faces))] # Get the index of the source face to use
+        if modules.globals.face_tracking and modules.globals.both_faces: # If we're tracking two faces
+            tracked = tracker.track_both(target_faces, source_indices, source_face_order)
+        elif modules.globals.face_tracking: # If we're tracking one face
+            source_index = modules.globals.face_index_range if modules.globals.face_index_range != -1 else active_source_index
+            tracked = [(tracker.track_single(target_face, all_faces), source_index) for target_face in target_faces]
         else:
-            return frame # If we have max faces then do not update the faces
+            tracked = list(zip(target_faces, source_indices))
+    # Pairs of (face to swap, index of the source face to use)
+    return [(target_face, source_index) for target_face, source_index in tracked if target_face is not None]
 
-def process_frame(source_face: List[Face], temp_frame: Frame) -> Frame:
+def process_frame(source_face: List[Face], temp_frame: Frame, context: Optional[FrameContext] = None) -> Frame:
     """Main function to process a single frame."""
-    global first_face_embedding, second_face_embedding, first_face_position, second_face_position
-    global first_face_id, second_face_id
-    global first_face_lost_count, second_face_lost_count
-
     # Rotate the frame
-    temp_frame = _rotate_frame(temp_frame, modules.globals.face_rot_range)
-
-    # Detect faces in the frame
-    all_faces = _detect_faces(temp_frame)
-
-    # Handle face tracking reset logic
-    if modules.globals.face_tracking: # If we're using face tracking
-        if modules.globals.detect_face_right_value: # If the "detect right face" button was pressed
-            reset_face_tracking() # Reset the face tracking
-            modules.globals.detect_face_right_value = False # Set the button to false
-        if modules.globals.flip_faces_value: # If the "flip faces" button was pressed
-            reset_face_tracking() # Reset the face tracking
-            modules.globals.flip_faces_value = False # Set the button to false
-    elif modules.globals.face_tracking_value: # If the "turn on face tracking" button was pressed
-        reset_face_tracking() # Reset the face tracking
-        modules.globals.face_tracking_value = False # Set the button to false
-
-    # Select which faces to process
-    target_faces = _select_target_faces(all_faces)
-
-    # Limit number of faces
-    target_faces = _limit_target_faces(target_faces)
+    rotated_frame = _rotate_frame(temp_frame, modules.globals.face_rot_range)
+    # Faces found on a rotated frame can't be shared with the other processors
+    if context is None or rotated_frame is not temp_frame:
+        context = FrameContext(context.frame_index if context else 0, sequencer=context.sequencer if context else None, output_index=context.output_index if context else 0)
+    temp_frame = rotated_frame
 
-    # Pre-compute mouth masks if needed
-    mouth_masks, face_masks = _compute_mouth_masks(target_faces, temp_frame)
+    # Detect faces in the frame, or reuse the ones another processor already found
+    all_faces = context.get_faces(temp_frame)
 
     # Determine source face order
     active_source_index = 1 if modules.globals.flip_faces else 0 # If we should flip the source faces
     source_face_order = [1, 0] if modules.globals.flip_faces else [0, 1] # If we should flip the source faces
 
-    if modules.globals.many_faces: # If we should swap many faces
-         if modules.globals.face_tracking: # If we are tracking faces
-            for i, target_face in enumerate(target_faces): # Loop through all the faces
-                if modules.globals.face_index_range != -1:
-                    source_index= modules.globals.face_index_range
-                else: 
-                    source_index = i % len(source_face) # Get the index of the source face to use
-                temp_frame = _process_face_tracking_many(temp_frame, source_face, target_face, source_index, source_face_order )  # Track many faces
-         else: # If we are not tracking faces
-            for i, target_face in enumerate(target_faces): # Loop through all the faces
-                if modules.globals.face_index_range != -1:
-                    source_index= modules.globals.face_index_range
-                else: 
-                    source_index = i % len(source_face)  # Get the index of the source face to use
-                temp_frame = _process_face_swap(temp_frame, source_face, target_face, source_index) # Swap the face
-    else:
-        faces_to_process = 2 if modules.globals.both_faces and len(source_face) > 1 else 1 # If we're swapping two faces, process two faces, otherwise process one
-        for i in range(min(faces_to_process, len(target_faces))):
-            if modules.globals.face_index_range != -1:
-                source_index= modules.globals.face_index_range
-            else: 
-                source_index = _get_source_index(i, source_face, source_face_order) # Get the index of the source face to use
-            if modules.globals.face_tracking: # If we're tracking faces
-                if modules.globals.both_faces: # If we're tracking two faces
-                   temp_frame = _process_face_tracking_both(
-                        temp_frame, source_face, target_faces[i], source_index, source_face_order # Track both faces
-                    )
-                else:
-                    if modules.globals.face_index_range != -1:
-                        active_source_index= modules.globals.face_index_range
+    # Match the faces to the tracked faces. For videos this runs in frame order, the swapping below stays parallel
+    tracker = get_face_tracker(context.output_index)
+    with tracker.turn(context):
+        # Handle face tracking reset logic
+        if modules.globals.face_tracking: # If we're using face tracking
+            if modules.globals.detect_face_right_value: # If the "detect right face" button was pressed
+                reset_face_tracking(tracker) # Reset the face tracking
+                modules.globals.detect_face_right_value = False # Set the button to false
+            if modules.globals.flip_faces_value: # If the "flip faces" button was pressed
+                reset_face_tracking(tracker) # Reset the face tracking
+                modules.globals.flip_faces_value = False # Set the button to false
+        elif modules.globals.face_tracking_value: # If the "turn on face tracking" button was pressed
+            reset_face_tracking(tracker) # Reset the face tracking
+            modules.globals.face_tracking_value = False # Set the button to false
+
+        # Select which faces to process
+        target_faces = _select_target_faces(all_faces, tracker)
+
+        # Limit number of faces
+        target_faces = _limit_target_faces(target_faces)
+
+        # Decide which source face goes onto which target face
+        assignments = _assign_source_faces(source_face, target_faces, all_faces, active_source_index, source_face_order, tracker)
 
-                    temp_frame = _process_face_tracking_single(
-                        temp_frame, source_face, target_faces[i], active_source_index # Track one face
-                    )
+    # Pre-compute mouth masks if needed
+    mouth_masks, face_masks = _compute_mouth_masks(target_faces, temp_frame)
 
-            else: # If we're not tracking faces
-                if modules.globals.face_index_range != -1:
-                    source_index= modules.globals.face_index_range
-                temp_frame = _process_face_swap(temp_frame, source_face, target_faces[i], source_index) # Swap the faces without tracking
+    # Swap the faces, all of them with one run of the model
+    temp_frame = _process_face_swaps(temp_frame, source_face, assignments)
 
     # Apply mouth masks
     temp_frame = _apply_mouth_masks(temp_frame, target_faces, mouth_masks, face_masks)
@@ -703,25 +445,61 @@ def apply_ink_filter(frame: Frame) -> Frame:
     return edges
 
 
+def get_source_faces(source_path: str) -> List[Face]:
+    """
+    Gets the faces in the source image, sorted from left to right.
+    The faces are detected once per source file and cached for the whole job.
+    """
+    return get_cached_source_faces(source_path) # Detect the source faces or reuse the cached ones
+
+def flip_frame(temp_frame: Frame) -> Frame:
+    """
+    Flips the frame according to the flip settings.
+    """
+    if modules.globals.flip_x: # If we should flip the frame horizontally
+        temp_frame = cv2.flip(temp_frame, 1) # Flip it
+    if modules.globals.flip_y: # If we should flip the frame vertically
+        temp_frame = cv2.flip(temp_frame, 0) # Flip it
+    return temp_frame
+
+def process_video_frame(source_face: List[Face], temp_frame: Frame, context: Optional[FrameContext] = None) -> Frame:
+    """
+    Processes a single decoded video frame, flipping it first like the saved frames.
+    """
+    flipped_frame = flip_frame(temp_frame)
+    if context is not None and flipped_frame is not temp_frame:
+        context.clear() # Faces found before the flip no longer match the frame
+    return process_frame(source_face, flipped_frame, context)
+
+def process_batch(source_face: List[Face], temp_frames: List[Frame], contexts: List[FrameContext]) -> List[Frame]:
+    """
+    Processes consecutive video frames, detecting the faces of all of them at once.
+    """
+    flipped_frames = [flip_frame(temp_frame) for temp_frame in temp_frames] # Flip them like the saved frames
+    for temp_frame, flipped_frame, context in zip(temp_frames, flipped_frames, contexts):
+        if flipped_frame is not temp_frame:
+            context.clear() # Faces found before the flip no longer match the frame
+    if not modules.globals.face_rot_range: # Faces of rotated frames are detected by process_frame
+        detect_frames_faces(flipped_frames, contexts) # One run of the detector for every frame that has no faces yet
+    processed_frames = []
+    for flipped_frame, context in zip(flipped_frames, contexts):
+        try:
+            processed_frames.append(process_frame(source_face, flipped_frame, context)) # Swap the faces of the frame
+        except Exception as exception:
+            print(exception) # If there's an error, print it and keep the frame
+            processed_frames.append(flipped_frame)
+    return processed_frames
+
 def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
     """
     Processes all the frames for a video or a list of images.
     """
-    source_face: List[Face] = [] # A list to store the source faces
-    if source_path: # If we have a source image
-        source_image = cv2.imread(source_path) # Load the source image
-        faces = get_many_faces(source_image) # Detect the faces in the source image
-        if faces: # If there are any faces
-            source_face = sorted(faces, key=lambda face: face.bbox[0])[:10] # Sort the faces from left to right and take the first 10
+    source_face = get_source_faces(source_path) # Detect the source faces
 
     for temp_frame_path in temp_frame_paths: # Loop through all the frames
         temp_frame = cv2.imread(temp_frame_path) # Load the current frame
         try:
-            if modules.globals.flip_x: # If we should flip the frame horizontally
-                temp_frame = cv2.flip(temp_frame, 1) # Flip it
-            if modules.globals.flip_y: # If we should flip the frame vertically
-                temp_frame = cv2.flip(temp_frame, 0) # Flip it
-            result = process_frame(source_face, temp_frame) # Process the current frame
+            result = process_video_frame(source_face, temp_frame) # Process the current frame
             cv2.imwrite(temp_frame_path, result) # Save the processed frame
         except Exception as exception:
             print(exception) # If there's an error, print it
@@ -733,20 +511,9 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
     """
     Processes a single image.
     """
-    source_face: List[Face] = [] # A list to store the source faces
-    if source_path: # If we have a source image
-        source_image = cv2.imread(source_path) # Load the source image
-        faces = get_many_faces(source_image) # Detect the faces in the source image
-        if faces: # If there are any faces
-            source_face = sorted(faces, key=lambda face: face.bbox[0])[:10] # Sort the faces from left to right and take the first 10
+    source_face = get_source_faces(source_path) # Detect the source faces
     target_frame = cv2.imread(target_path) # Load the target image
-
-    if modules.globals.flip_x: # If we should flip the frame horizontally
-        target_frame = cv2.flip(target_frame, 1) # Flip it
-    if modules.globals.flip_y: # If we should flip the frame vertically
-        target_frame = cv2.flip(target_frame, 0) # Flip it
-
-    result = process_frame(source_face, target_frame) # Process the image
+    result = process_video_frame(source_face, target_frame) # Process the image
     cv2.imwrite(output_path, result) # Save the processed image
 
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
@@ -755,13 +522,13 @@ def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
     """
     if modules.globals.face_tracking: # If we're tracking faces
         reset_face_tracking() # Reset the face tracking
-    modules.processors.frame.core.process_video(source_path, temp_frame_paths, process_frames) # Use the built-in video processing function
+    modules.processors.frame.core.process_video_frames(get_source_faces(source_path), temp_frame_paths, process_video_frame) # Decode, process and write the frames in order
 
-def create_face_mask(face: Face, frame: Frame) -> np.ndarray:
+def create_face_mask(face: Face, frame: Frame) -> RegionMask:
     """
-    Creates a mask of the face.
+    Creates a mask of the face, covering only the area around the face.
     """
-    mask = np.zeros(frame.shape[:2], dtype=np.uint8) # Create a black mask with the same size as the frame
+    mask = RegionMask(np.zeros((0, 0), dtype=np.uint8)) # An empty mask if there are no landmarks
     landmarks = face.landmark_2d_106 # Get the face landmarks
     if landmarks is not None: # If landmarks exist
         face_outline_indices = [1, 43, 48, 49, 104, 105, 17, 25, 26, 27, 28, 29, 30, 31, 32, 18, 19, 20, 21, 22, 23, 24, 0, 8,
@@ -804,8 +571,15 @@ def create_face_mask(face: Face, frame: Frame) -> np.ndarray:
                 hull_padded.append(padded_point) # Add the padded point to the list
 
         hull_padded = np.array(hull_padded, dtype=np.int32) # Convert the list of padded points to a numpy array
-        cv2.fillConvexPoly(mask, hull_padded, 255) # Fill the mask with white using the padded points
-        mask = cv2.GaussianBlur(mask, (5, 5), 3) # Blur the edges of the mask
+        # Only make the mask as big as the face plus room for blurring its edges
+        x, y, w, h = cv2.boundingRect(hull_padded)
+        x1, y1 = max(0, x - FACE_MASK_MARGIN), max(0, y - FACE_MASK_MARGIN)
+        x2, y2 = min(frame.shape[1], x + w + FACE_MASK_MARGIN), min(frame.shape[0], y + h + FACE_MASK_MARGIN)
+        mask_roi = np.zeros((max(0, y2 - y1), max(0, x2 - x1)), dtype=np.uint8) # Create a black mask around the face
+        if mask_roi.size:
+            cv2.fillConvexPoly(mask_roi, hull_padded - [x1, y1], 255) # Fill the mask with white using the padded points
+            mask_roi = cv2.GaussianBlur(mask_roi, (5, 5), 3) # Blur the edges of the mask
+        mask = RegionMask(mask_roi, x1, y1)
     return mask
 
 def blur_edges(mask: np.ndarray, blur_amount: int = 40) -> np.ndarray:
@@ -838,7 +612,13 @@ def apply_color_transfer(source, target):
 
 def create_feathered_mask(shape, feather_amount):
     """
-    Creates a circular mask with blurred edges.
+    Creates a circular mask with blurred edges, cached per size bucket.
+    """
+    return get_mask('feathered', shape, (feather_amount,), lambda size: build_feathered_mask(size, feather_amount))
+
+def build_feathered_mask(shape, feather_amount):
+    """
+    Builds the circular mask for create_feathered_mask.
     """
     mask = np.zeros(shape[:2], dtype=np.float32) # Create a black mask with the same size as the frame
     center = (shape[1] // 2, shape[0] // 2) # Find the center of the mask
@@ -862,9 +642,9 @@ def create_feathered_mask(shape, feather_amount):
 
 def create_mouth_mask(face: Face, frame: Frame) -> (np.ndarray, np.ndarray, tuple):
     """
-    Creates a mask for the mouth.
+    Creates a mask for the mouth. The mask only covers the mouth box, mask[0, 0] sits at (min_x, min_y).
     """
-    mask = np.zeros(frame.shape[:2], dtype=np.uint8) # Create a black mask with the same size as the frame
+    mask = np.zeros((0, 0), dtype=np.uint8) # An empty mask if there are no landmarks
     mouth_cutout = None # Make a variable to hold the cropped mouth
     landmarks = face.landmark_2d_106 # Get the face landmarks
     if landmarks is not None:
@@ -899,13 +679,14 @@ def create_mouth_mask(face: Face, frame: Frame) -> (np.ndarray, np.ndarray, tupl
         # mask_polygon[:, 0] = np.clip(mask_polygon[:, 0], 0, frame.shape[1] - 1)
         # mask_polygon[:, 1] = np.clip(mask_polygon[:, 1], 0, frame.shape[0] - 1)
 
-        # Draw the mask
-        cv2.fillPoly(mask, [mask_polygon], 255) # Fill the mask with white
-
         # Calculate bounding box for the mouth cutout
         min_x, min_y = np.min(mask_polygon, axis=0) # Find the top-left corner of the mask
         max_x, max_y = np.max(mask_polygon, axis=0) # Find the bottom-right corner of the mask
 
+        # Draw the mask
+        mask = np.zeros((max_y - min_y, max_x - min_x), dtype=np.uint8) # Create a black mask the size of the mouth box
+        cv2.fillPoly(mask, [mask_polygon - [min_x, min_y]], 255) # Fill the mask with white
+
         # Extract the masked area from the frame
         mouth_cutout = frame[min_y:max_y, min_x:max_x].copy() # Crop out the mouth
 
@@ -913,9 +694,9 @@ def create_mouth_mask(face: Face, frame: Frame) -> (np.ndarray, np.ndarray, tupl
 
 def create_lower_mouth_mask(face: Face, frame: Frame) -> (np.ndarray, np.ndarray, tuple, np.ndarray):
     """
-    Creates a mask for the lower part of the mouth.
+    Creates a mask for the lower part of the mouth. The mask only covers the mouth box, mask[0, 0] sits at (min_x, min_y).
     """
-    mask = np.zeros(frame.shape[:2], dtype=np.uint8) # Create a black mask with the same size as the frame
+    mask = np.zeros((0, 0), dtype=np.uint8) # An empty mask if there are no landmarks
     mouth_cutout = None # Make a variable to hold the cropped mouth
     landmarks = face.landmark_2d_106 # Get the face landmarks
     if landmarks is not None:
@@ -970,10 +751,7 @@ def create_lower_mouth_mask(face: Face, frame: Frame) -> (np.ndarray, np.ndarray
         cv2.fillPoly(mask_roi, [expanded_landmarks - [min_x, min_y]], 255) # Fill the mask with white
 
         # Apply Gaussian blur to soften the mask edges
-        mask_roi = cv2.GaussianBlur(mask_roi, (15, 15), 5) # Blur the edges of the mask
-
-        # Place the mask ROI in the full-sized mask
-        mask[min_y:max_y, min_x:max_x] = mask_roi # Put the mouth mask into the larger mask
+        mask = cv2.GaussianBlur(mask_roi, (15, 15), 5) # Blur the edges of the mask
 
         # Extract the masked area from the frame
         mouth_cutout = frame[min_y:max_y, min_x:max_x].copy() # Crop out the mouth
@@ -990,6 +768,7 @@ def draw_mouth_mask_visualization(frame: Frame, face: Face, mouth_mask_data: tup
     landmarks = face.landmark_2d_106 # Get the face landmarks
     if landmarks is not None and mouth_mask_data is not None: # If landmarks and mask data exist
         mask, mouth_cutout, (min_x, min_y, max_x, max_y), lower_lip_polygon = mouth_mask_data # Get all the mask data
+        mask_x, mask_y = min_x, min_y # The mask covers the mouth box, starting at its top-left corner
 
         vis_frame = frame.copy() # Copy the original frame
 
@@ -999,7 +778,7 @@ def draw_mouth_mask_visualization(frame: Frame, face: Face, mouth_mask_data: tup
         max_x, max_y = min(width, max_x), min(height, max_y) # Make sure the bottom-right corner is inside the frame
 
         # Adjust mask to match the region size
-        mask_region = mask[0:max_y - min_y, 0:max_x - min_x]
+        mask_region = mask[min_y - mask_y:max_y - mask_y, min_x - mask_x:max_x - mask_x]
 
         # Remove the color mask overlay
         # color_mask = cv2.applyColorMap((mask_region * 255).astype(np.uint8), cv2.COLORMAP_JET)
@@ -1039,7 +818,7 @@ def draw_mouth_mask_visualization(frame: Frame, face: Face, mouth_mask_data: tup
         return vis_frame
     return frame
 
-def apply_mouth_area(frame: np.ndarray, mouth_cutout: np.ndarray, mouth_box: tuple, face_mask: np.ndarray,
+def apply_mouth_area(frame: np.ndarray, mouth_cutout: np.ndarray, mouth_box: tuple, face_mask: RegionMask,
                     mouth_polygon: np.ndarray) -> np.ndarray:
     """
     Applies the mouth area to the frame.
@@ -1068,18 +847,18 @@ def apply_mouth_area(frame: np.ndarray, mouth_cutout: np.ndarray, mouth_box: tup
         # Apply feathering to the polygon mask
         feather_amount = min(30, box_width // modules.globals.mask_feather_ratio,
                             box_height // modules.globals.mask_feather_ratio) # Calculate how much to feather the mask
-        feathered_mask = cv2.GaussianBlur(polygon_mask.astype(float), (0, 0), feather_amount) # Feather the mask
+        feathered_mask = cv2.GaussianBlur(polygon_mask.astype(np.float32), (0, 0), feather_amount) # Feather the mask
         feathered_mask = feathered_mask / feathered_mask.max() # Convert values between 0 and 1
 
-        face_mask_roi = face_mask[min_y:max_y, min_x:max_x] # Get the portion of the face mask
-        combined_mask = feathered_mask * (face_mask_roi / 255.0) # Multiply the feathered mask with the face mask
+        face_mask_roi = face_mask.crop(min_x, min_y, min_x + roi.shape[1], min_y + roi.shape[0]) / np.float32(255.0) # Get the portion of the face mask
+        combined_mask = feathered_mask * face_mask_roi # Multiply the feathered mask with the face mask
 
         combined_mask = combined_mask[:, :, np.newaxis] # Add a dimension to the mask to make it work with the color channels
         blended = (color_corrected_mouth * combined_mask + roi * (1 - combined_mask)).astype(np.uint8) # Blend the mouth onto the original frame
 
         # Apply face mask to blended result
-        face_mask_3channel = np.repeat(face_mask_roi[:, :, np.newaxis], 3, axis=2) / 255.0 # Add color channels to the face mask
-        final_blend = blended * face_mask_3channel + roi * (1 - face_mask_3channel) # Blend the face onto the frame
+        face_mask_roi = face_mask_roi[:, :, np.newaxis] # One face mask value for all 3 color channels
+        final_blend = blended * face_mask_roi + roi * (1 - face_mask_roi) # Blend the face onto the frame
 
         frame[min_y:max_y, min_x:max_x] = final_blend.astype(np.uint8) # Put the result back into the frame
     except Exception as e:
@@ -1087,34 +866,16 @@ def apply_mouth_area(frame: np.ndarray, mouth_cutout: np.ndarray, mouth_box: tup
 
     return frame
 
-def reset_face_tracking():
+def reset_face_tracking(tracker: Optional[FaceTracker] = None):
     """
     Resets all face tracking variables, including multi-face tracking data.
+    Only the given tracker is reset when one is passed, otherwise every output's tracker is.
     """
-    global first_face_embedding, second_face_embedding
-    global first_face_position, second_face_position
-    global first_face_id, second_face_id
-    global first_face_lost_count, second_face_lost_count
-    global face_position_history
-    
-    if 'tracked_faces_many' in globals():
-        tracked_faces_many = globals()['tracked_faces_many']
-        tracked_faces_many.clear()
-    
-    if 'position_histories_many' in globals():
-        position_histories_many = globals()['position_histories_many']
-        position_histories_many.clear()
-
-    first_face_embedding = None
-    second_face_embedding = None
-    first_face_position = None
-    second_face_position = None
-    first_face_id = None
-    second_face_id = None
-    first_face_lost_count = 0
-    second_face_lost_count = 0
-    face_position_history.clear()
-    
+    with FACE_TRACKERS_LOCK:
+        trackers = [tracker] if tracker is not None else list(FACE_TRACKERS.values())
+    for face_tracker in trackers:
+        face_tracker.reset()
+
     modules.globals.target_face1_score = 0.00
     modules.globals.target_face2_score = 0.00
     modules.globals.target_face3_score = 0.00
@@ -1126,131 +887,15 @@ def reset_face_tracking():
     modules.globals.target_face9_score = 0.00
     modules.globals.target_face10_score = 0.00
 
-def get_face_center(face: Face) -> Tuple[float, float]:
+def save_face_tracking() -> None:
     """
-    Gets the center of the face.
+    Saves the identities many faces tracking knows, see --identity-gallery.
+    Every output's tracker writes its own snapshot, output n next to it with a -n suffix.
     """
-    bbox = face.bbox # Get the bounding box for the face
-    return ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2) # Calculate the center using the bounding box
-
-def extract_face_embedding(face: Face) -> np.ndarray:
-    """
-    Extracts the face embedding (how the face looks).
-    """
-    try:
-        if hasattr(face, 'embedding') and face.embedding is not None: # If the face already has an embedding
-            embedding = face.embedding # Get the existing embedding
-        else:
-            # If the face doesn't have an embedding, we need to generate one
-            embedding = get_face_analyser().get(face) # Generate an embedding for the face
-
-        # Normalize the embedding
-        return embedding / np.linalg.norm(embedding) # Make the embedding have a length of 1
-    except Exception as e:
-        print(f"Error extracting face embedding: {e}") # Print an error message if something goes wrong
-        # Return a default embedding (all zeros) if extraction fails
-        return np.zeros(512, dtype=np.float32) # Return an empty embedding
-
-def find_best_match(embedding: np.ndarray, faces: List[Face]) -> Face:
-    """
-    Finds the face that is most similar to the given embedding.
-    """
-    if embedding is None:
-        # Handle case where embedding is None, maybe log a message or skip processing
-        print("No embedding to match against, skipping face matching.") # If no embedding, we can't match
-        return None
-    best_match = None # Make a variable to store the best face
-    best_similarity = -1 # Make a variable to store the best similarity score
-
-    for face in faces: # Loop through all the faces
-        face_embedding = extract_face_embedding(face) # Get the embedding for this face
-        similarity = cosine_similarity(embedding, face_embedding) # Calculate how similar this face is
-
-        if similarity > best_similarity: # If this is the most similar face
-            best_similarity = similarity # Store the similarity score
-            best_match = face # Store the face
-
-    return best_match
-
-def update_face_assignments(target_faces: List[Face]):
-    """
-    Updates which faces are assigned to the tracked faces.
-    """
-    global first_face_embedding, second_face_embedding, first_face_position, second_face_position, last_assignment_time
-
-    if len(target_faces) == 0: # If there are no faces to assign, don't do anything
-        return
-
-    current_time = time.time() # Get the current time
-    if current_time - last_assignment_time < assignment_cooldown: # If it's too soon to update face assignments, don't do anything
-        return  # Don't update assignments during cooldown period
-
-    try:
-        face_embeddings = [extract_face_embedding(face) for face in target_faces] # Get the embeddings for all the faces
-        face_positions = [get_face_center(face) for face in target_faces] # Get the positions for all the faces
-
-        if first_face_embedding is None and face_embeddings: # If we haven't assigned a first face yet
-            first_face_embedding = face_embeddings[0] # Assign the first detected face to be the first tracked face
-            first_face_position = face_positions[0] # Remember where the first face is
-            last_assignment_time = current_time # Remember when we did this
-
-        if modules.globals.both_faces and second_face_embedding is None and len(face_embeddings) > 1: # If we haven't assigned a second face yet and we should
-            second_face_embedding = face_embeddings[1] # Assign the second detected face to be the second tracked face
-            second_face_position = face_positions[1] # Remember where the second face is
-            last_assignment_time = current_time # Remember when we did this
-
-        if first_face_embedding is not None: # If we have a first tracked face
-            best_match_index = -1
-            best_match_score = -1
-            for i, (embedding, position) in enumerate(zip(face_embeddings, face_positions)): # Loop through all the faces
-                embedding_similarity = cosine_similarity(first_face_embedding, embedding) # How similar this face is to the first tracked face
-                position_consistency = 1 / (
-                            1 + np.linalg.norm(np.array(position) - np.array(first_face_position))) if first_face_position else 0 # How close this face is to the first tracked face
-                combined_score = embedding_similarity * 0.7 + position_consistency * 0.3 # Calculate a combined score for similarity and position
-
-                if combined_score > best_match_score and combined_score > 0.8:  # Increased threshold
-                    best_match_score = combined_score # Remember the score
-                    best_match_index = i # Remember the face index
-
-            if best_match_index != -1: # If we found a good match
-                first_face_embedding = face_embeddings[best_match_index] # Assign this face to the first tracked face
-                first_face_position = face_positions[best_match_index] # Remember where the face is
-                last_assignment_time = current_time # Remember when we did this
-
-        if modules.globals.both_faces and second_face_embedding is not None: # If we are using two faces and we already have a second face assigned
-            remaining_embeddings = face_embeddings[:best_match_index] + face_embeddings[best_match_index + 1:] # Get the embeddings of all faces that are NOT the first face
-            remaining_positions = face_positions[:best_match_index] + face_positions[best_match_index + 1:] # Get the positions of all faces that are NOT the first face
-
-            if remaining_embeddings: # If there are any other faces
-                best_match_index = -1
-                best_match_score = -1
-                for i, (embedding, position) in enumerate(zip(remaining_embeddings, remaining_positions)): # Loop through all other faces
-                    embedding_similarity = cosine_similarity(second_face_embedding, embedding) # How similar this face is to the second tracked face
-                    position_consistency = 1 / (
-                                1 + np.linalg.norm(np.array(position) - np.array(second_face_position))) if second_face_position else 0 # How close this face is to the second tracked face
-                    combined_score = embedding_similarity * 0.7 + position_consistency * 0.3 # Calculate the combined score
-
-                    if combined_score > best_match_score and combined_score > 0.8:  # Increased threshold
-                        best_match_score = combined_score # Remember the score
-                        best_match_index = i # Remember the face index
-
-                if best_match_index != -1: # If we found a good match
-                    second_face_embedding = remaining_embeddings[best_match_index] # Assign the best match to the second face
-                    second_face_position = remaining_positions[best_match_index] # Remember where the face is
-                    last_assignment_time = current_time # Remember when we did this
-
-    except Exception as e:
-        print(f"Error in update_face_assignments: {e}") # Print an error message if something goes wrong
-
-def cosine_similarity(a, b):
-    """
-    Calculates how similar two embeddings are.
-    """
-    if a is None or b is None:
-        # Log an error message or handle the None case appropriately
-        # print("Warning: One of the embeddings is None.")
-        return 0  # or handle it as needed # If either embedding doesn't exist, they are not similar
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)) # Calculate the cosine similarity
+    with FACE_TRACKERS_LOCK:
+        trackers = list(FACE_TRACKERS.values())
+    for face_tracker in trackers:
+        face_tracker.save_gallery()
 
 def get_best_match(embedding: np.ndarray, face_embeddings: List[np.ndarray]) -> int:
     """
@@ -1313,7 +958,13 @@ def create_adjusted_face(face: Face, crop_info: Tuple[int, int, int, int]) -> Fa
 
 def create_ellipse_mask(shape, feather_amount=5):
     """
-    Creates an ellipse mask.
+    Creates an ellipse mask, cached per size bucket.
+    """
+    return get_mask('ellipse', shape, (feather_amount,), lambda size: build_ellipse_mask(size, feather_amount))
+
+def build_ellipse_mask(shape, feather_amount=5):
+    """
+    Builds the ellipse mask for create_ellipse_mask.
     """
     mask = np.zeros(shape[:2], dtype=np.float32) # Create a black mask
     center = (shape[1] // 2, shape[0] // 2) # Find the center of the mask
@@ -1324,7 +975,14 @@ def create_ellipse_mask(shape, feather_amount=5):
 
 def create_edge_blur_mask(shape, blur_amount=40):
     """
-    Creates a mask with blurred edges.
+    Creates a mask with blurred edges, cached per size bucket.
+    The returned mask may be shared, so never change it in place.
+    """
+    return get_mask('edge_blur', shape, (blur_amount,), lambda size: build_edge_blur_mask(size, blur_amount))
+
+def build_edge_blur_mask(shape, blur_amount=40):
+    """
+    Builds the mask with blurred edges for create_edge_blur_mask.
     """
     h, w = shape[:2] # Get the frame height and width
     mask = np.ones((h, w), dtype=np.float32) # Create a white mask
@@ -1353,91 +1011,6 @@ def blend_with_mask(swapped_region, original_region, mask):
     mask_3d = np.expand_dims(mask, axis=2).repeat(3, axis=2) # Add color channels to the mask
     return (swapped_region * mask_3d + original_region * (1 - mask_3d)).astype(np.uint8) # Blend the images using the mask
 
-def create_pseudo_face(position):
-    """
-    Creates a fake face object for face tracking when a real face is not detected.
-    """
-    class PseudoFace: # Create a new class for the fake face
-        def __init__(self, position):
-            x, y = position # Get the center of the face
-            width = height = 100  # Approximate face size # Choose a size for the fake face
-
-            # More realistic bbox
-            self.bbox = np.array([x - width / 2, y - height / 2, x + width / 2, y + height / 2]) # Create a bounding box for the face
-
-            # Generate landmarks
-            self.landmark_2d_106 = generate_anatomical_landmarks(position) # Create landmarks for the face
-
-            # Extract kps from landmarks
-            self.kps = np.array([
-                self.landmark_2d_106[36],  # Left eye
-                self.landmark_2d_106[90],  # Right eye
-                self.landmark_2d_106[80],  # Nose tip
-                self.landmark_2d_106[57],  # Left mouth corner
-                self.landmark_2d_106[66]  # Right mouth corner
-            ]) # Create key points from the landmarks
-
-            # Generate 3D landmarks (just add a random z-coordinate to 2D landmarks)
-            self.landmark_3d_68 = np.column_stack((self.landmark_2d_106[:68], np.random.normal(0, 5, 68))) # Create 3d landmarks
-
-            # Other attributes
-            self.det_score = 0.99 # Set a high detection score
-            self.embedding = np.random.rand(512)  # Random embedding # Create a random embedding
-            self.embedding_norm = np.linalg.norm(self.embedding) # Calculate the length of the embedding
-            self.gender = 0 # Set the gender to male
-            self.age = 25 # Set the age to 25
-            self.pose = np.zeros(3) # Set the pose to 0
-            self.normed_embedding = self.embedding / self.embedding_norm # Normalize the embedding
-
-    return PseudoFace(position) # Create a fake face at the given position
-
-def generate_anatomical_landmarks(position):
-    """
-    Generates fake face landmarks for the pseudo face.
-    """
-    x, y = position # Get the center position
-    landmarks = [] # List to store the landmarks
-
-    # Right side face (0-16)
-    for i in range(17):
-        landmarks.append([x - 40 + i * 2, y - 30 + i * 3]) # Create landmarks along the right side of the face
-
-    # Left side face (17-32)
-    for i in range(16):
-        landmarks.append([x + 40 - i * 2, y - 30 + i * 3]) # Create landmarks along the left side of the face
-
-    # Right eye (33-42)
-    eye_center = [x - 20, y - 10] # Set the position of the right eye
-    for i in range(10):
-        angle = i * (2 * np.pi / 10) # Calculate the angle around the eye
-        landmarks.append([eye_center[0] + 10 * np.cos(angle), eye_center[1] + 5 * np.sin(angle)]) # Create landmarks around the eye
-
-    # Right eyebrow (43-51)
-    for i in range(9):
-        landmarks.append([x - 35 + i * 5, y - 30]) # Create landmarks for the right eyebrow
-
-    # Mouth (52-71)
-    mouth_center = [x, y + 30] # Set the position of the mouth
-    for i in range(20):
-        angle = i * (2 * np.pi / 20) # Calculate the angle around the mouth
-        landmarks.append([mouth_center[0] + 15 * np.cos(angle), mouth_center[1] + 7 * np.sin(angle)]) # Create landmarks around the mouth
-
-    # Nose (72-86)
-    for i in range(15):
-        landmarks.append([x - 7 + i, y + 10 + i // 2]) # Create landmarks for the nose
-
-    # Left eye (87-96)
-    eye_center = [x + 20, y - 10] # Set the position of the left eye
-    for i in range(10):
-        angle = i * (2 * np.pi / 10) # Calculate the angle around the eye
-        landmarks.append([eye_center[0] + 10 * np.cos(angle), eye_center[1] + 5 * np.sin(angle)]) # Create landmarks around the eye
-
-    # Left eyebrow (97-105)
-    for i in range(9):
-        landmarks.append([x + 5 + i * 5, y - 30]) # Create landmarks for the left eyebrow
-
-    return np.array(landmarks, dtype=np.float32)
-
 def draw_all_landmarks(frame: Frame, face: Face) -> Frame:
     """
     Draws all face landmarks on the frame.
@@ -0,0 +1,104 @@
+import time
+import threading
+from typing import List, NamedTuple, Optional
+
+import modules.globals
+
+
+class QualityLevel(NamedTuple):
+    # detection_interval is the keyframe interval of modules.keyframe_tracker
+    det_size: int
+    detection_interval: int
+    face_enhancer: bool
+    mouth_mask: bool
+    processing_scale: float
+
+
+# From best to fastest, every step gives up a little more quality for speed
+QUALITY_LEVELS: List[QualityLevel] = [
+    QualityLevel(640, 1, True, True, 1.0),
+    QualityLevel(640, 2, True, True, 1.0),
+    QualityLevel(480, 2, False, True, 1.0),
+    QualityLevel(480, 3, False, False, 1.0),
+    QualityLevel(320, 3, False, False, 0.75),
+    QualityLevel(320, 4, False, False, 0.5)
+]
+# Below this share of the target FPS the quality steps down, above the upper share it steps up again
+QUALITY_LOWER_SHARE = 0.9
+QUALITY_UPPER_SHARE = 1.2
+QUALITY_DOWN_SECONDS = 1.0
+QUALITY_UP_SECONDS = 3.0
+QUALITY_SMOOTHING = 0.1
+
+
+class QualityController:
+    """
+    Holds the live preview at a target frame rate by trading quality for speed.
+
+    update() is called for every displayed frame. The controller keeps a
+    smoothed frame rate and moves one step along QUALITY_LEVELS when the
+    rate stayed below QUALITY_LOWER_SHARE of the target for
+    QUALITY_DOWN_SECONDS, or above QUALITY_UPPER_SHARE of it for the longer
+    QUALITY_UP_SECONDS, so the quality does not flip back and forth. After a
+    step the measurement starts over, the new level needs time to show.
+    A target of 0 keeps the best level.
+    """
+
+    def __init__(self, target_fps: float = 0.0, levels: Optional[List[QualityLevel]] = None) -> None:
+        self.target_fps = max(0.0, target_fps)
+        self.levels = levels or QUALITY_LEVELS
+        self.level_index = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def level(self) -> QualityLevel:
+        return self.levels[self.level_index]
+
+    def reset(self) -> None:
+        with self.lock:
+            self.level_index = 0
+            self.restart()
+
+    def restart(self) -> None:
+        self.fps = 0.0
+        self.last_time = 0.0
+        self.since_time = 0.0
+        self.direction = 0
+
+    def update(self, frame_time: Optional[float] = None) -> QualityLevel:
+        frame_time = time.perf_counter() if frame_time is None else frame_time
+        with self.lock:
+            if not self.target_fps:
+                return self.level
+            if self.last_time:
+                frame_seconds = frame_time - self.last_time
+                if frame_seconds > 0:
+                    fps = 1 / frame_seconds
+                    self.fps = fps if not self.fps else self.fps + (fps - self.fps) * QUALITY_SMOOTHING
+            else:
+                self.since_time = frame_time
+            self.last_time = frame_time
+            if not self.fps:
+                return self.level
+            direction = 0
+            if self.fps < self.target_fps * QUALITY_LOWER_SHARE and self.level_index < len(self.levels) - 1:
+                direction = 1
+            if self.fps > self.target_fps * QUALITY_UPPER_SHARE and self.level_index > 0:
+                direction = -1
+            if direction != self.direction:
+                self.direction = direction
+                self.since_time = frame_time
+            hold_seconds = QUALITY_DOWN_SECONDS if direction > 0 else QUALITY_UP_SECONDS
+            if direction and frame_time - self.since_time >= hold_seconds:
+                self.level_index += direction
+                self.restart()
+            return self.level
+
+    def describe(self) -> str:
+        level = self.level
+        return f"quality {self.level_index}/{len(self.levels) - 1} (detect {level.det_size}px every {level.detection_interval}, scale {level.processing_scale:.2f})"
+
+
+def create_quality_controller() -> QualityController:
+    return QualityController(modules.globals.live_target_fps)
@@ -0,0 +1,100 @@
+from typing import Any, Callable, List, Optional, Tuple
+import numpy
+
+from modules.typing import Face, Frame
+from modules.face_analyser import detect_faces, detect_faces_in_regions
+from modules.motion_filter import MotionFilter
+
+# Crops reach this many face sizes beyond the predicted face on every side
+ROI_MARGIN = 0.75
+ROI_MIN_SIZE = 128
+# With more faces than this one pass over the whole frame is cheaper than one per face
+ROI_MAX_FACES = 4
+# Two detections from overlapping crops with more overlap than this are the same face
+ROI_DUPLICATE_IOU = 0.5
+
+
+class RoiDetector:
+    """
+    Detects faces in crops around where the faces of the last frame are expected.
+
+    Every face of the previous frame is moved ahead by its motion filter
+    (see modules.motion_filter) and the detector runs on a square crop around
+    it, all crops in one run at an input size that fits them (see
+    modules.face_analyser.detect_faces_in_regions), so it neither scans the
+    empty rest of the frame nor shrinks small faces of large frames down to
+    the detector size. The whole frame is detected again on the first frame,
+    every refresh_interval frames (to pick up faces that came in) and as
+    soon as a face is not found again in its crop. Frames must be passed in
+    order.
+    """
+
+    def __init__(self, refresh_interval: int = 30, detect: Callable[[Frame], List[Face]] = detect_faces, detect_in_regions: Callable[[Frame, List[Tuple[int, int, int, int]]], List[List[Face]]] = detect_faces_in_regions) -> None:
+        self.refresh_interval = max(1, refresh_interval)
+        self.detect_frame = detect
+        self.detect_in_regions = detect_in_regions
+        self.full_detections = 0
+        self.roi_detections = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.faces: List[Face] = []
+        self.motions: List[MotionFilter] = []
+        self.frames_since_full = 0
+
+    def detect(self, frame: Frame) -> List[Face]:
+        faces = None
+        if self.faces and len(self.faces) <= ROI_MAX_FACES and self.frames_since_full < self.refresh_interval:
+            faces = self.detect_regions(frame)
+        if faces is None:
+            faces = self.detect_frame(frame)
+            self.motions = [MotionFilter(face.bbox) for face in faces]
+            self.frames_since_full = 0
+            self.full_detections += 1
+        else:
+            self.roi_detections += 1
+        self.frames_since_full += 1
+        self.faces = faces
+        return faces
+
+    def detect_regions(self, frame: Frame) -> Optional[List[Face]]:
+        """
+        Detects every face of the last frame in its crop, None when any of them was not found.
+        """
+        height, width = frame.shape[:2]
+        predicted_bboxes = [motion.predict().astype(numpy.float32) for motion in self.motions]
+        regions_faces = self.detect_in_regions(frame, [get_roi(predicted_bbox, width, height) for predicted_bbox in predicted_bboxes])
+        faces: List[Face] = []
+        for motion, predicted_bbox, region_faces in zip(self.motions, predicted_bboxes, regions_faces):
+            crop_faces = [crop_face for crop_face in region_faces if get_iou(crop_face.bbox, predicted_bbox) > 0]
+            if not crop_faces:
+                return None
+            found_face = max(crop_faces, key=lambda crop_face: get_iou(crop_face.bbox, predicted_bbox))
+            if any(get_iou(found_face.bbox, other_face.bbox) > ROI_DUPLICATE_IOU for other_face in faces):
+                # two faces of the last frame ended up on one face, let the whole frame sort it out
+                return None
+            faces.append(found_face)
+            motion.update(found_face.bbox)
+        return faces
+
+
+def get_roi(bbox: numpy.ndarray, width: int, height: int) -> Tuple[int, int, int, int]:
+    center = get_center(bbox)
+    size = max(bbox[2] - bbox[0], bbox[3] - bbox[1]) * (1 + 2 * ROI_MARGIN)
+    half_size = max(size, ROI_MIN_SIZE) / 2
+    x1, y1 = numpy.clip((center - half_size).astype(int), 0, [width, height])
+    x2, y2 = numpy.clip((center + half_size).astype(int), 0, [width, height])
+    return int(x1), int(y1), int(x2), int(y2)
+
+
+def get_center(bbox: Any) -> numpy.ndarray:
+    bbox = numpy.asarray(bbox, dtype=numpy.float32)
+    return (bbox[:2] + bbox[2:4]) / 2
+
+
+def get_iou(bbox_a: Any, bbox_b: Any) -> float:
+    ax1, ay1, ax2, ay2 = numpy.asarray(bbox_a, dtype=numpy.float32)[:4]
+    bx1, by1, bx2, by2 = numpy.asarray(bbox_b, dtype=numpy.float32)[:4]
+    overlap = max(0.0, min(ax2, bx2) - max(ax1, bx1)) * max(0.0, min(ay2, by2) - max(ay1, by1))
+    union = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1) - overlap
+    return float(overlap / union) if union > 0 else 0.0
@@ -0,0 +1,131 @@
+import os
+import threading
+from typing import Any, List, Optional
+import onnxruntime
+
+import modules.globals
+from modules.inference_batcher import is_batching_enabled
+
+CPU_EXECUTION_PROVIDER = 'CPUExecutionProvider'
+# with inference batching the detector, recognizer and swapper each run on the thread of their batcher
+MODEL_BATCHERS = 3
+
+
+class SessionPool:
+    """
+    ONNX Runtime sessions of one model, one per calling thread.
+
+    Stands in for the session of an insightface model: run() goes to the
+    session of the calling thread, so the execution threads don't queue up
+    on one session and its thread pool. Threads are spread round robin over
+    size sessions, which are created on first use with explicit session
+    options, every one limited to intra_op_threads so that all of them
+    together stay within the CPU cores (see get_thread_budget).
+    """
+
+    def __init__(self, model_path: str, providers: List[str], size: int = 1, intra_op_threads: int = 1, inter_op_threads: int = 1, session: Optional[onnxruntime.InferenceSession] = None) -> None:
+        self.model_path = model_path
+        self.providers = providers
+        self.size = max(1, size)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.sessions: List[Optional[onnxruntime.InferenceSession]] = [None] * self.size
+        self.sessions[0] = session
+        self.next_slot = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_session(self) -> onnxruntime.InferenceSession:
+        slot = getattr(self.local, 'slot', None)
+        if slot is None:
+            with self.lock:
+                slot = self.local.slot = self.next_slot % self.size
+                self.next_slot += 1
+        session = self.sessions[slot]
+        if session is None:
+            with self.lock:
+                if self.sessions[slot] is None:
+                    self.sessions[slot] = self.create_session(slot)
+                session = self.sessions[slot]
+        return session
+
+    def create_session(self, slot: int) -> onnxruntime.InferenceSession:
+        try:
+            return onnxruntime.InferenceSession(self.model_path, sess_options=create_session_options(self.intra_op_threads, self.inter_op_threads), providers=self.providers)
+        except Exception as exception:
+            if slot == 0 or self.sessions[0] is None:
+                raise
+            # out of memory for another copy of the model, share the first one
+            print(f'Failed to create session {slot} of {self.model_path}, sharing the first one: {exception}')
+            return self.sessions[0]
+
+    def run(self, output_names: Any, input_feed: Any, run_options: Any = None) -> List[Any]:
+        return self.get_session().run(output_names, input_feed, run_options)
+
+    def __getattr__(self, name: str) -> Any:
+        # everything else, e.g. get_inputs() or set_providers(), goes to the thread's session
+        if name.startswith('__') or name in ('sessions', 'local', 'lock'):
+            raise AttributeError(name)
+        return getattr(self.get_session(), name)
+
+
+def create_session_options(intra_op_threads: int, inter_op_threads: int = 1) -> onnxruntime.SessionOptions:
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = intra_op_threads
+    session_options.inter_op_num_threads = inter_op_threads
+    session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.enable_cpu_mem_arena = True
+    session_options.enable_mem_pattern = True
+    session_options.log_severity_level = 3
+    return session_options
+
+
+def is_cpu_only(providers: List[str]) -> bool:
+    return all(provider == CPU_EXECUTION_PROVIDER for provider in providers)
+
+
+def get_execution_threads() -> int:
+    return max(1, modules.globals.execution_threads or 1)
+
+
+def get_model_callers(batched: bool = False) -> int:
+    # a batched model is run by the thread of its batcher, every other model by every execution thread
+    if batched and is_batching_enabled():
+        return 1
+    return get_execution_threads()
+
+
+def get_session_pool_size(providers: List[str], batched: bool = False) -> int:
+    # a GPU holds one copy of every model, its kernels are not limited by CPU threads
+    if not is_cpu_only(providers):
+        return 1
+    if modules.globals.session_pool_size > 0:
+        return modules.globals.session_pool_size
+    return get_model_callers(batched)
+
+
+def get_thread_budget() -> int:
+    """
+    Intra op threads of every session, the CPU cores split between the threads that run models at once:
+    the execution threads and, with inference batching, the threads of the batchers.
+    """
+    callers = get_execution_threads() + (MODEL_BATCHERS if is_batching_enabled() else 0)
+    return max(1, (os.cpu_count() or 1) // callers)
+
+
+def pool_model_session(model: Any, providers: Optional[List[str]] = None, batched: bool = False) -> Any:
+    """
+    Replaces the session of an insightface model with a SessionPool of the same model file.
+
+    batched tells whether the model is run through an inference batcher. A
+    single GPU session is kept as it is. Otherwise the pool loads its own
+    sessions on first use, so the model is never held twice.
+    """
+    providers = providers or modules.globals.execution_providers or [CPU_EXECUTION_PROVIDER]
+    size = get_session_pool_size(providers, batched)
+    if size == 1 and not is_cpu_only(providers):
+        return model
+    model_path = getattr(model.session, 'model_path', None) or model.model_file
+    model.session = SessionPool(model_path, providers, size, get_thread_budget())
+    return model
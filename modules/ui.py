@@ -12,8 +12,14 @@ from modules.face_analyser import (
     get_one_face_left,
     get_one_face_right,
     get_many_faces,
+    get_source_faces,
+    set_detection_size,
+    FrameContext,
 )
-from modules.capturer import get_video_frame, get_video_frame_total
+from modules.capturer import get_video_frame, get_video_frame_total, CameraCapture
+from modules.live_pipeline import create_live_pipeline, format_live_metrics
+from modules.quality_controller import create_quality_controller
+from modules.keyframe_tracker import create_keyframe_tracker
 from modules.processors.frame.core import get_frame_processors_modules
 
 
@@ -1608,14 +1614,8 @@ def update_preview(frame_number: int = 0) -> None:
         # Initialize variables for the selected face/s image.
         # Source image can have one face or two faces we simply detect face from left of frame
         # then right of frame. This insures we always have a face to work with
-        source_images: List[Face] = []
-        if modules.globals.source_path:
-
-            source_image = cv2.imread(modules.globals.source_path)
-            faces = get_many_faces(source_image)
-            if faces:
-                # sort faces from left to right then slice max 10
-                source_images = sorted(faces, key=lambda face: face.bbox[0])[:10]
+        # Faces are sorted from left to right, sliced to max 10 and cached per source file
+        source_images: List[Face] = get_source_faces(modules.globals.source_path)
 
         # no face found
         if not source_images:
@@ -1627,10 +1627,14 @@ def update_preview(frame_number: int = 0) -> None:
         if modules.globals.flip_y:
             temp_frame = cv2.flip(temp_frame, 0)
 
+        # Faces are detected once and shared by every frame processor
+        context = FrameContext(frame_number)
         for frame_processor in get_frame_processors_modules(
             modules.globals.frame_processors
         ):
-            temp_frame = frame_processor.process_frame(source_images, temp_frame)
+            temp_frame = frame_processor.process_frame(
+                source_images, temp_frame, context
+            )
         # Get current preview window size
         # current_width = PREVIEW_IMAGE.winfo_width()
         # current_height = PREVIEW_IMAGE.winfo_height()
@@ -1671,8 +1675,8 @@ def webcam_preview():
     PREVIEW_WIDTH = 1030
     PREVIEW_HEIGHT = 620
     camera_index = modules.globals.camera_index
-    camera = cv2.VideoCapture(camera_index)
-    update_camera_resolution()
+    # Frames are read on their own thread, the loop below always gets the newest one
+    camera = CameraCapture(camera_index, PREVIEW_DEFAULT_WIDTH, PREVIEW_DEFAULT_HEIGHT)
     # Configure the preview window
     PREVIEW.deiconify()
     PREVIEW.geometry(f"{PREVIEW_WIDTH}x{PREVIEW_HEIGHT}")
@@ -1685,13 +1689,8 @@ def webcam_preview():
                 frame_processor.reset_face_tracking()
 
     # Initialize source_images as a list to store faces
-    source_images: List[Face] = []
-    if modules.globals.source_path:
-        source_image = cv2.imread(modules.globals.source_path)
-        faces = get_many_faces(source_image)
-        if faces:
-            # sort faces from left to right then slice max 6
-            source_images = sorted(faces, key=lambda face: face.bbox[0])[:10]
+    # Faces are sorted from left to right, sliced to max 10 and cached per source file
+    source_images: List[Face] = get_source_faces(modules.globals.source_path)
 
     if not source_images:
         print("No face found in source image")
@@ -1727,19 +1726,71 @@ def webcam_preview():
     start_time = time.time()
     fps = 0
     frame_processor.frame_auto_rotation = 0
-    while camera.isOpened():
-        ret, frame = camera.read()
-        if not ret:
-            break
+    # Size the display stage fits frames to, only the Tk thread may ask the window for it
+    preview_size = [PREVIEW.winfo_width(), PREVIEW.winfo_height()]
+    # Trades detection size, detection interval, enhancer, mouth mask and resolution for speed to hold the target FPS
+    quality = create_quality_controller()
+    # Detects faces on keyframes, around the last faces with --roi-detection, and follows them with optical flow in between
+    keyframes = create_keyframe_tracker()
+    analysed_level = [None]
+
+    def analyse_frame(frame_index, frame):
+        level = quality.level
         temp_frame = frame.copy()
-
+        if level.processing_scale < 1:
+            temp_frame = cv2.resize(temp_frame, None, fx=level.processing_scale, fy=level.processing_scale, interpolation=cv2.INTER_AREA)
         if modules.globals.flip_x:
             temp_frame = cv2.flip(temp_frame, 1)
         if modules.globals.flip_y:
             temp_frame = cv2.flip(temp_frame, 0)
-
+        # Faces are detected once and shared by every frame processor
+        if analysed_level[0] != level:
+            # Faces found at another size or scale can't be followed
+            set_detection_size(level.det_size)
+            keyframes.reset()
+            analysed_level[0] = level
+        keyframes.interval = max(modules.globals.keyframe_interval, level.detection_interval)
+        context = FrameContext(frame_index, faces=keyframes.get_faces(frame_index, temp_frame))
+        return temp_frame, context
+
+    def swap_frame(frame_index, analysed):
+        temp_frame, context = analysed
+        level = quality.level
+        modules.globals.mouth_mask_allowed = level.mouth_mask
         for frame_processor in frame_processors:
-            temp_frame = frame_processor.process_frame(source_images, temp_frame)
+            if frame_processor.NAME == "DLC.FACE-ENHANCER" and not level.face_enhancer:
+                continue
+            temp_frame = frame_processor.process_frame(
+                source_images, temp_frame, context
+            )
+        return temp_frame
+
+    def display_frame(frame_index, temp_frame):
+        current_width, current_height = preview_size
+        # Resize the processed frame to fit the current preview window size
+        temp_frame = fit_image_to_preview(temp_frame, current_width, current_height)
+        image = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
+        return Image.fromarray(image), (current_width, current_height)
+
+    # Detection of frame N+1, swapping of frame N and display conversion of frame N-1 run at the same time
+    camera.start()
+    pipeline = create_live_pipeline(
+        camera.read,
+        [("analyse", analyse_frame), ("swap", swap_frame), ("display", display_frame)],
+    ).start()
+    pipeline_text = ""
+    while camera.isOpened():
+        output = pipeline.get()
+        if output is None:
+            if camera.running:
+                # No new frame yet, keep the window responsive
+                ROOT.update()
+                if PREVIEW.state() == "withdrawn":
+                    break
+                continue
+            break
+        image, (current_width, current_height) = output.value
+        quality.update()
 
         # # Calculate and display FPS
         frame_count += 1
@@ -1749,9 +1800,16 @@ def webcam_preview():
             fps = frame_count / elapsed_time
             frame_count = 0
             start_time = current_time
+            pipeline_text = format_live_metrics(pipeline.get_metrics())
+            if quality.target_fps:
+                pipeline_text += f" | {quality.describe()}"
+            pipeline.reset_metrics()
 
         # cv2.putText(temp_frame, f"FPS: {fps:.2f}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-        fps_label.configure(text=f"FPS: {fps:.2f}")
+        capture_stats = camera.get_stats()
+        fps_label.configure(
+            text=f"FPS: {fps:.2f} | Camera: {capture_stats['capture_fps']:.1f} FPS, {capture_stats['dropped']} dropped, {capture_stats['frame_age_ms']:.0f} ms old | {pipeline_text}"
+        )
         target_face1_value.configure(text=f": {modules.globals.target_face1_score:.2f}")
         target_face2_value.configure(text=f": {modules.globals.target_face2_score:.2f}")
         target_face3_value.configure(text=f": {modules.globals.target_face3_score:.2f}")
@@ -1764,20 +1822,19 @@ def webcam_preview():
         target_face10_value.configure(
             text=f": {modules.globals.target_face10_score:.2f}"
         )
-        # Get current preview window size
-        current_width = PREVIEW.winfo_width()
-        current_height = PREVIEW.winfo_height()
-        # Resize the processed frame to fit the current preview window size
-        temp_frame = fit_image_to_preview(temp_frame, current_width, current_height)
-        image = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
-        image = Image.fromarray(image)
         image = ctk.CTkImage(image, size=(current_width, current_height))
         preview_label_cam.configure(
             image=image, width=current_width, height=current_height
         )
         ROOT.update()
+        # Get current preview window size for the next frames
+        preview_size[:] = [PREVIEW.winfo_width(), PREVIEW.winfo_height()]
         if PREVIEW.state() == "withdrawn":
             break
+    pipeline.stop()
+    # Leave full quality behind for the next preview and for processing files
+    set_detection_size()
+    modules.globals.mouth_mask_allowed = True
     camera.release()
     PREVIEW.withdraw()
 
@@ -1828,22 +1885,9 @@ def update_preview_size(*args):
 def update_camera_resolution():
     global camera, PREVIEW_DEFAULT_WIDTH, PREVIEW_DEFAULT_HEIGHT
     if camera is not None and camera.isOpened():
-        camera.set(cv2.CAP_PROP_FRAME_WIDTH, PREVIEW_DEFAULT_WIDTH)
-        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, PREVIEW_DEFAULT_HEIGHT)
-        camera.set(
-            cv2.CAP_PROP_FPS, 60
-        )  # You may want to make FPS configurable as well
-
-        # set camera with new resolution
-
-        camera_index = modules.globals.camera_index
-        camera.release()
-        camera = cv2.VideoCapture(camera_index)
-        camera.set(cv2.CAP_PROP_FRAME_WIDTH, PREVIEW_DEFAULT_WIDTH)
-        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, PREVIEW_DEFAULT_HEIGHT)
-        camera.set(
-            cv2.CAP_PROP_FPS, 60
-        )  # You may want to make FPS configurable as well
+        # set camera with new resolution, the capture thread picks up the reopened camera
+        camera.camera_index = modules.globals.camera_index
+        camera.set_resolution(PREVIEW_DEFAULT_WIDTH, PREVIEW_DEFAULT_HEIGHT)
 
 
 def both_faces(*args):
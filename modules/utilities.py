@@ -7,10 +7,12 @@ import ssl
 import subprocess
 import urllib
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Iterator, Tuple
 from tqdm import tqdm
+import numpy
 
 import modules.globals
+from modules.typing import Frame
 
 TEMP_FILE = 'temp.mp4'
 TEMP_DIRECTORY = 'temp'
@@ -53,16 +55,75 @@ def create_video(target_path: str, fps: float = 30.0) -> None:
     run_ffmpeg(['-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.png'), '-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
 
 
-def restore_audio(target_path: str, output_path: str) -> None:
-    temp_output_path = get_temp_output_path(target_path)
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-of', 'csv=s=x:p=0', target_path]
+    output = subprocess.check_output(command).decode().strip().split('x')
+    width, height = map(int, output[:2])
+    # ffmpeg turns rotated videos upright while decoding, so their frames are as wide as the stored frames are high
+    if detect_rotation(target_path) in (90, 270):
+        width, height = height, width
+    return width, height
+
+
+def detect_rotation(target_path: str) -> int:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream_tags=rotate:stream_side_data=rotation', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
+    try:
+        output = subprocess.check_output(command).decode().split()
+        return int(float(output[0])) % 360 if output else 0
+    except Exception:
+        pass
+    return 0
+
+
+def read_video_frames(target_path: str) -> Iterator[Frame]:
+    width, height = detect_resolution(target_path)
+    frame_size = width * height * 3
+    commands = ['ffmpeg', '-hide_banner', '-hwaccel', 'auto', '-loglevel', modules.globals.log_level, '-i', target_path, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+    # ffmpeg reports its errors on the console, at log_level
+    process = subprocess.Popen(commands, stdout=subprocess.PIPE)
+    try:
+        while True:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            yield numpy.frombuffer(buffer, dtype=numpy.uint8).reshape((height, width, 3)).copy()
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def open_video_writer(target_path: str, resolution: Tuple[int, int], fps: float = 30.0, output_index: int = 0) -> subprocess.Popen:
+    temp_output_path = get_temp_output_path(target_path, output_index)
+    width, height = resolution
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', modules.globals.log_level, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-', '-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path]
+    return subprocess.Popen(commands, stdin=subprocess.PIPE)
+
+
+def write_video_frame(process: subprocess.Popen, frame: Frame) -> None:
+    process.stdin.write(numpy.ascontiguousarray(frame, dtype=numpy.uint8).tobytes())
+
+
+def close_video_writer(process: subprocess.Popen) -> bool:
+    try:
+        process.stdin.close()
+    except Exception:
+        pass
+    return process.wait() == 0
+
+
+def restore_audio(target_path: str, output_path: str, output_index: int = 0) -> None:
+    temp_output_path = get_temp_output_path(target_path, output_index)
     done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
     if not done:
-        move_temp(target_path, output_path)
+        move_temp(target_path, output_path, output_index)
 
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png')))
+    temp_frame_paths = glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png')))
+    return sorted(temp_frame_paths, key=lambda temp_frame_path: int(Path(temp_frame_path).stem) if Path(temp_frame_path).stem.isdigit() else 0)
 
 
 def get_temp_directory_path(target_path: str) -> str:
@@ -71,8 +132,11 @@ def get_temp_directory_path(target_path: str) -> str:
     return os.path.join(target_directory_path, TEMP_DIRECTORY, target_name)
 
 
-def get_temp_output_path(target_path: str) -> str:
+def get_temp_output_path(target_path: str, output_index: int = 0) -> str:
     temp_directory_path = get_temp_directory_path(target_path)
+    if output_index:
+        temp_name, temp_extension = os.path.splitext(TEMP_FILE)
+        return os.path.join(temp_directory_path, f'{temp_name}-{output_index}{temp_extension}')
     return os.path.join(temp_directory_path, TEMP_FILE)
 
 
@@ -90,8 +154,8 @@ def create_temp(target_path: str) -> None:
     Path(temp_directory_path).mkdir(parents=True, exist_ok=True)
 
 
-def move_temp(target_path: str, output_path: str) -> None:
-    temp_output_path = get_temp_output_path(target_path)
+def move_temp(target_path: str, output_path: str, output_index: int = 0) -> None:
+    temp_output_path = get_temp_output_path(target_path, output_index)
     if os.path.isfile(temp_output_path):
         if os.path.isfile(output_path):
             os.remove(output_path)